@@ -0,0 +1,259 @@
+import io
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, urlunparse, unquote
+import psycopg2
+import pymysql
+from pymongo import MongoClient
+from logger import setup_logger
+
+logger = setup_logger("benchmarks")
+
+# Rows per COPY / insert_many while seeding
+SEED_BATCH_SIZE = 10000
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TAGS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+
+
+class DatasetSpec:
+    """
+    Shape of a synthetic data set: `tables` tables (or collections) of `rows` rows each,
+    every row carrying `payload_size` bytes of hex text. The same spec and seed always
+    produce the same data, so runs on different commits back up identical databases.
+    """
+
+    def __init__(self, tables: int = 4, rows: int = 100000, payload_size: int = 200, seed: int = 42):
+        if tables <= 0 or rows <= 0 or payload_size < 0:
+            raise ValueError("Data set tables and rows must be positive and the payload size not negative.")
+        self.tables = tables
+        self.rows = rows
+        self.payload_size = payload_size
+        self.seed = seed
+
+    def table_names(self):
+        return [f"bench_{i}" for i in range(self.tables)]
+
+    def rows_of(self, table_index: int):
+        """
+        Yield (id, account, amount, created_at, payload, tags) for one table.
+        """
+        rng = random.Random(self.seed * 1000 + table_index)
+        for row_id in range(1, self.rows + 1):
+            yield (
+                row_id,
+                rng.randrange(100000),
+                round(rng.uniform(0, 10000), 2),
+                EPOCH + timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+                rng.randbytes(self.payload_size // 2).hex(),
+                rng.sample(TAGS, rng.randrange(1, 4)),
+            )
+
+    def to_dict(self):
+        return {"tables": self.tables, "rows": self.rows, "payload_size": self.payload_size, "seed": self.seed}
+
+
+def database_url(server_url: str, db_name: str):
+    """
+    Point a server URL at a database, keeping its query string (authSource, ...).
+    """
+    parsed = urlparse(server_url)
+    return urlunparse(parsed._replace(path=f"/{db_name}"))
+
+
+## POSTGRES
+def recreate_postgres_database(server_url: str, db_name: str):
+    conn = psycopg2.connect(database_url(server_url, "postgres"))
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{db_name}"')
+            cur.execute(f'CREATE DATABASE "{db_name}"')
+    finally:
+        conn.close()
+
+
+def drop_postgres_database(server_url: str, db_name: str):
+    conn = psycopg2.connect(database_url(server_url, "postgres"))
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{db_name}"')
+    finally:
+        conn.close()
+
+
+def seed_postgres(server_url: str, db_name: str, spec: DatasetSpec):
+    """
+    Create the database and load the data set with COPY. Returns the database size in bytes.
+    """
+    recreate_postgres_database(server_url, db_name)
+    conn = psycopg2.connect(database_url(server_url, db_name))
+    try:
+        with conn, conn.cursor() as cur:
+            for index, table in enumerate(spec.table_names()):
+                cur.execute(
+                    f"CREATE TABLE {table} (id bigint PRIMARY KEY, account integer NOT NULL, amount numeric(12, 2),"
+                    f" created_at timestamptz NOT NULL, payload text, attrs jsonb)"
+                )
+                buffer = io.StringIO()
+                for n, (row_id, account, amount, created_at, payload, tags) in enumerate(spec.rows_of(index), 1):
+                    attrs = json.dumps({"tags": tags, "active": account % 2 == 0})
+                    buffer.write(f"{row_id}\t{account}\t{amount}\t{created_at.isoformat()}\t{payload}\t{attrs}\n")
+                    if n % SEED_BATCH_SIZE == 0:
+                        buffer.seek(0)
+                        cur.copy_expert(f"COPY {table} FROM STDIN", buffer)
+                        buffer = io.StringIO()
+                buffer.seek(0)
+                cur.copy_expert(f"COPY {table} FROM STDIN", buffer)
+                cur.execute(f"CREATE INDEX ON {table} (account)")
+            cur.execute("ANALYZE")
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_database_size(current_database())")
+            size = cur.fetchone()[0]
+    finally:
+        conn.close()
+    logger.info(f"Seeded Postgres database '{db_name}' with {spec.tables} x {spec.rows} rows ({size / (1024 * 1024):.1f} MB).")
+    return size
+
+
+def count_postgres(server_url: str, db_name: str, spec: DatasetSpec):
+    conn = psycopg2.connect(database_url(server_url, db_name))
+    try:
+        with conn.cursor() as cur:
+            counts = {}
+            for table in spec.table_names():
+                cur.execute(f"SELECT count(*) FROM {table}")
+                counts[table] = cur.fetchone()[0]
+            return counts
+    finally:
+        conn.close()
+
+
+## MONGODB
+def seed_mongodb(server_url: str, db_name: str, spec: DatasetSpec):
+    """
+    Drop the database and load the data set with insert_many. Returns the data size in bytes.
+    """
+    client = MongoClient(server_url)
+    try:
+        client.drop_database(db_name)
+        db = client.get_database(db_name)
+        for index, name in enumerate(spec.table_names()):
+            collection = db.get_collection(name)
+            batch = []
+            for row_id, account, amount, created_at, payload, tags in spec.rows_of(index):
+                batch.append({"_id": row_id, "account": account, "amount": amount, "created_at": created_at,
+                              "payload": payload, "attrs": {"tags": tags, "active": account % 2 == 0}})
+                if len(batch) >= SEED_BATCH_SIZE:
+                    collection.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                collection.insert_many(batch, ordered=False)
+            collection.create_index("account")
+        size = db.command("dbStats")["dataSize"]
+    finally:
+        client.close()
+    logger.info(f"Seeded MongoDB database '{db_name}' with {spec.tables} x {spec.rows} documents ({size / (1024 * 1024):.1f} MB).")
+    return int(size)
+
+
+def drop_mongodb_database(server_url: str, db_name: str):
+    client = MongoClient(server_url)
+    try:
+        client.drop_database(db_name)
+    finally:
+        client.close()
+
+
+def count_mongodb(server_url: str, db_name: str, spec: DatasetSpec):
+    client = MongoClient(server_url)
+    try:
+        db = client.get_database(db_name)
+        return {name: db.get_collection(name).count_documents({}) for name in spec.table_names()}
+    finally:
+        client.close()
+
+
+## MYSQL
+def _connect_mysql(server_url: str, db_name: str = None):
+    parsed = urlparse(server_url)
+    return pymysql.connect(
+        host=parsed.hostname, port=parsed.port or 3306, user=unquote(parsed.username), password=unquote(parsed.password or ""),
+        database=db_name, charset="utf8mb4", autocommit=True,
+    )
+
+
+def recreate_mysql_database(server_url: str, db_name: str):
+    conn = _connect_mysql(server_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+            cur.execute(f"CREATE DATABASE `{db_name}`")
+    finally:
+        conn.close()
+
+
+def drop_mysql_database(server_url: str, db_name: str):
+    conn = _connect_mysql(server_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+    finally:
+        conn.close()
+
+
+def seed_mysql(server_url: str, db_name: str, spec: DatasetSpec):
+    """
+    Create the database and load the data set with multi-row INSERTs. The secondary index on
+    `account` is split off by the native backup and rebuilt after the load by the restore.
+    Returns the size of the tables in bytes.
+    """
+    recreate_mysql_database(server_url, db_name)
+    conn = _connect_mysql(server_url, db_name)
+    try:
+        with conn.cursor() as cur:
+            for index, table in enumerate(spec.table_names()):
+                cur.execute(
+                    f"CREATE TABLE {table} (id bigint PRIMARY KEY, account int NOT NULL, amount decimal(12, 2),"
+                    f" created_at datetime NOT NULL, payload text, attrs json, KEY account (account)) ENGINE=InnoDB"
+                )
+                statement = f"INSERT INTO {table} VALUES (%s, %s, %s, %s, %s, %s)"
+                batch = []
+                for row_id, account, amount, created_at, payload, tags in spec.rows_of(index):
+                    batch.append((row_id, account, amount, created_at.replace(tzinfo=None), payload, json.dumps({"tags": tags, "active": account % 2 == 0})))
+                    if len(batch) >= SEED_BATCH_SIZE:
+                        cur.executemany(statement, batch)
+                        batch = []
+                if batch:
+                    cur.executemany(statement, batch)
+                cur.execute(f"ANALYZE TABLE {table}")
+            cur.execute(
+                "SELECT COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s", (db_name,)
+            )
+            size = int(cur.fetchone()[0])
+    finally:
+        conn.close()
+    logger.info(f"Seeded MySQL database '{db_name}' with {spec.tables} x {spec.rows} rows ({size / (1024 * 1024):.1f} MB).")
+    return size
+
+
+def count_mysql(server_url: str, db_name: str, spec: DatasetSpec):
+    """
+    Rows and indexes per table, so a restore that did not rebuild its deferred indexes fails
+    the check as well.
+    """
+    conn = _connect_mysql(server_url, db_name)
+    try:
+        with conn.cursor() as cur:
+            counts = {}
+            for table in spec.table_names():
+                cur.execute(f"SELECT count(*) FROM {table}")
+                rows = cur.fetchone()[0]
+                cur.execute(
+                    "SELECT COUNT(DISTINCT INDEX_NAME) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,)
+                )
+                counts[table] = (rows, cur.fetchone()[0])
+            return counts
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+import click
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Driver of each database type. A run may only import the driver of its own --db-type.
+DRIVERS = {"postgres": "psycopg2", "mongodb": "pymongo", "mysql": "pymysql"}
+# Imported only by runs that use them
+OPTIONAL_MODULES = ["boto3", "cryptography"]
+MARKER = "STARTUP "
+
+# Runs in a fresh interpreter: the command line of the scenario, then the modules it loaded
+PROBE = """
+import json, sys
+sys.argv = {argv!r}
+try:
+    import cli
+    {action}
+except SystemExit:
+    pass
+print("\\n{marker}" + json.dumps(sorted(m for m in {modules!r} if m in sys.modules)))
+"""
+
+# name -> (cli.py arguments, what runs after importing cli, database types whose driver may load)
+SCENARIOS = {
+    "help": (["--help"], "cli.cli()", []),
+    "backup --help": (["backup", "--help"], "cli.cli()", []),
+    **{db_type: ([], f"cli.handlers.load_handler({db_type!r})", [db_type]) for db_type in ["postgres", "mongodb", "mysql", "sqlite"]},
+}
+
+
+def _run(code: str, importtime: bool = False):
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", code]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT_DIR, capture_output=True, text=True)
+    return time.perf_counter() - start, result
+
+
+def slowest_imports(code: str, limit: int = 10):
+    """
+    The top-level imports with the largest cumulative time, from `python -X importtime`.
+    """
+    _, result = _run(code, importtime=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def measure(name: str, repeat: int):
+    """
+    Median and minimum wall time of a scenario in fresh interpreters, and the drivers it
+    loaded that it should not have.
+    """
+    arguments, action, db_types = SCENARIOS[name]
+    modules = [*DRIVERS.values(), *OPTIONAL_MODULES]
+    code = PROBE.format(argv=["cli.py", *arguments], action=action, marker=MARKER, modules=modules)
+    timings, loaded = [], []
+    for _ in range(repeat):
+        elapsed, result = _run(code)
+        lines = [line for line in result.stdout.splitlines() if line.startswith(MARKER)]
+        if result.returncode != 0 or not lines:
+            error = (result.stderr.strip().splitlines() or [f"exit code {result.returncode}"])[-1]
+            return {"scenario": name, "status": "failed", "error": error}
+        timings.append(elapsed)
+        loaded = json.loads(lines[-1][len(MARKER):])
+    allowed = {DRIVERS[db_type] for db_type in db_types if db_type in DRIVERS}
+    return {
+        "scenario": name,
+        "status": "ok",
+        "median_ms": statistics.median(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "unexpected": [module for module in loaded if module not in allowed],
+        "code": code,
+    }
+
+
+@click.command()
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(SCENARIOS)), help='Only time these scenarios. Repeatable. Defaults to all of them.')
+@click.option('--repeat', type=int, default=10, show_default=True, help='Interpreter starts per scenario; the median is reported.')
+@click.option('--max-ms', type=float, help='Fail when a scenario takes more than this many milliseconds on top of a bare interpreter start.')
+def startup(scenarios, repeat, max_ms):
+    """Time cli.py start-up per scenario and check that only the needed drivers are imported"""
+    baseline_timings = [_run("pass")[0] for _ in range(repeat)]
+    baseline = statistics.median(baseline_timings) * 1000
+    click.echo(f"Bare interpreter start: {baseline:.1f} ms (median of {repeat})")
+    click.echo(f"{'SCENARIO':14}  {'MEDIAN (ms)':>11}  {'MIN (ms)':>9}  {'OVER BARE (ms)':>14}  STATUS")
+
+    failures = []
+    for name in scenarios or SCENARIOS:
+        result = measure(name, repeat)
+        if result["status"] == "failed":
+            click.echo(f"{name:14}  FAILED  {result['error']}")
+            failures.append(f"{name} failed: {result['error']}")
+            continue
+        over = result["median_ms"] - baseline
+        status = "ok"
+        if result["unexpected"]:
+            status = f"LOADED {', '.join(result['unexpected'])}"
+            failures.append(f"{name} imported {', '.join(result['unexpected'])}")
+        elif max_ms is not None and over > max_ms:
+            status = "SLOW"
+            failures.append(f"{name} took {over:.1f} ms over a bare interpreter start, above {max_ms} ms")
+        click.echo(f"{name:14}  {result['median_ms']:11.1f}  {result['min_ms']:9.1f}  {over:14.1f}  {status}")
+        if status != "ok":
+            for milliseconds, module in slowest_imports(result["code"]):
+                click.echo(f"    {milliseconds:8.1f} ms  {module}")
+
+    if failures:
+        raise click.ClickException("; ".join(failures))
+
+
+if __name__ == "__main__":
+    startup()
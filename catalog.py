@@ -0,0 +1,317 @@
+import json
+import os
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+from logger import setup_logger
+from chunk_store import ChunkStore
+from storage import is_storage_url, split_location
+from integrity import read_sidecar, record_checksums, hash_file, sidecar_path
+from db_handlers.postgres_handlers.selection import toc_cache_path
+from db_handlers.postgres_handlers.physical import WAL_ARCHIVE_DIR, base_backup_start_wal, prune_wal_archive
+from db_handlers.sqlite_handler.snapshot import deltas_path
+
+logger = setup_logger("catalog")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Every backup is recorded here; BACKUP_CATALOG points somewhere else, e.g. a shared volume
+DEFAULT_CATALOG_PATH = os.environ.get("BACKUP_CATALOG", os.path.join(BASE_DIR, "catalog.db"))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS backups (
+        id INTEGER PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        db_type TEXT NOT NULL,
+        db_name TEXT NOT NULL,
+        collection_name TEXT,
+        endpoint TEXT,
+        format TEXT,
+        engine TEXT,
+        compression TEXT,
+        path TEXT NOT NULL,
+        repo TEXT,
+        size INTEGER,
+        duration REAL,
+        checksum TEXT
+    );
+    CREATE INDEX IF NOT EXISTS backups_by_database ON backups (db_type, db_name, created_at);
+"""
+
+COLUMNS = ["id", "created_at", "db_type", "db_name", "collection_name", "endpoint", "format", "engine", "compression", "path", "repo", "size", "duration", "checksum"]
+
+
+def artifact_size(path):
+    """
+    Size in bytes of a backup artifact: a file, a directory, a repository snapshot manifest
+    or an object in a storage backend.
+    """
+    if is_storage_url(str(path)):
+        storage, key = split_location(str(path))
+        return storage.size(key)
+    path = Path(path)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+    if path.suffix == ".json" and path.parent.name == "snapshots":
+        return json.loads(path.read_text()).get("size", 0)
+    return path.stat().st_size
+
+
+def artifact_checksum(path):
+    """
+    Checksum of a backup artifact, from the sidecar written while it was taken. Artifacts
+    without one are hashed now; a repository snapshot is identified by its manifest, which
+    already lists the hash of every chunk.
+    """
+    path = Path(path)
+    sidecar = read_sidecar(path)
+    if sidecar:
+        return sidecar["checksum"]
+    if path.suffix == ".json" and path.parent.name == "snapshots":
+        return hash_file(path)[0]
+    return record_checksums(path)["checksum"]
+
+
+def endpoint_of(database_url: str = None, host: str = None, port: int = None):
+    """
+    host:port of a backup source, without credentials.
+    """
+    if database_url:
+        parsed = urlparse(database_url)
+        host, port = parsed.hostname, parsed.port
+    return f"{host}:{port}" if port else host
+
+
+class BackupEntry:
+    def __init__(self, row):
+        for column, value in zip(COLUMNS, row):
+            setattr(self, column, value)
+
+    @property
+    def created(self):
+        return datetime.fromisoformat(self.created_at)
+
+    @property
+    def snapshot(self):
+        """
+        Snapshot name when the backup lives in a chunk repository.
+        """
+        return Path(self.path).stem if self.repo else None
+
+
+class Catalog:
+    """
+    SQLite index of every backup taken, so finding, listing and pruning backups is a query
+    instead of a scan of the output directories.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = Path(path or DEFAULT_CATALOG_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Concurrent backups record from several threads and processes; WAL lets readers
+        # run while one of them writes, and the timeout waits out the write lock
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, db_type: str, db_name: str, path, endpoint: str = None, collection_name: str = None, format: str = None,
+               engine: str = None, compression: str = None, repo: str = None, duration: float = None, size: int = None, checksum: str = None):
+        """
+        Add a finished backup. Uploaded backups pass the size and checksum their writer
+        computed while streaming; local artifacts are measured here.
+        """
+        remote = is_storage_url(str(path))
+        if size is None:
+            size = artifact_size(path)
+        if checksum is None and not remote:
+            checksum = artifact_checksum(path)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO backups (created_at, db_type, db_name, collection_name, endpoint, format, engine, compression, path, repo, size, duration, checksum)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), db_type, db_name, collection_name, endpoint, format, engine,
+                 compression, str(path) if remote else str(Path(path).resolve()), str(Path(repo).resolve()) if repo else None, size, duration, checksum),
+            )
+        logger.info(f"Recorded backup #{cursor.lastrowid} of {db_type} database '{db_name}' in the catalog.")
+        return cursor.lastrowid
+
+    def list(self, db_type: str = None, db_name: str = None, limit: int = None):
+        """
+        Backups, newest first, optionally for one database type and/or database.
+        """
+        query = f"SELECT {', '.join(COLUMNS)} FROM backups"
+        conditions, params = [], []
+        if db_type:
+            conditions.append("db_type = ?")
+            params.append(db_type)
+        if db_name:
+            conditions.append("db_name = ?")
+            params.append(db_name)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC, id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._connect() as conn:
+            return [BackupEntry(row) for row in conn.execute(query, params)]
+
+    def latest(self, db_type: str, db_name: str, at: datetime = None, engine: str = None, collection_name: str = None):
+        """
+        The newest full backup of a database, or the newest one taken at or before `at`,
+        optionally only among backups of one engine. With `collection_name`, the newest backup
+        of that MongoDB collection or Postgres table selection instead.
+        """
+        query = f"SELECT {', '.join(COLUMNS)} FROM backups WHERE db_type = ? AND db_name = ?"
+        params = [db_type, db_name]
+        # A single-collection or partial backup cannot stand in for the whole database
+        if collection_name:
+            query += " AND collection_name = ?"
+            params.append(collection_name)
+        else:
+            query += " AND collection_name IS NULL"
+        if at:
+            query += " AND created_at <= ?"
+            params.append(at.isoformat(timespec="seconds"))
+        if engine:
+            query += " AND engine = ?"
+            params.append(engine)
+        query += " ORDER BY created_at DESC, id DESC LIMIT 1"
+        with self._connect() as conn:
+            row = conn.execute(query, params).fetchone()
+        if not row:
+            when = f" taken at or before {at}" if at else ""
+            kind = f" {engine}" if engine else ""
+            what = f"{db_name}.{collection_name}" if collection_name else db_name
+            raise FileNotFoundError(f"No{kind} {db_type} backup of '{what}'{when} in the catalog.")
+        return BackupEntry(row)
+
+    def remove(self, entries: list):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM backups WHERE id = ?", [(entry.id,) for entry in entries])
+
+    def prune(self, keep_last: int = 0, keep_daily: int = 0, keep_weekly: int = 0, keep_monthly: int = 0,
+              db_type: str = None, db_name: str = None, dry_run: bool = False):
+        """
+        Apply a grandfather-father-son retention policy to every database in the catalog (or
+        one of them) and delete the backups it does not keep. Returns the pruned entries.
+        """
+        if not any([keep_last, keep_daily, keep_weekly, keep_monthly]):
+            raise ValueError("Refusing to prune without a retention policy. Set at least one of keep_last, keep_daily, keep_weekly or keep_monthly.")
+        if min(keep_last, keep_daily, keep_weekly, keep_monthly) < 0:
+            raise ValueError("Retention counts cannot be negative.")
+
+        groups = {}
+        for entry in self.list(db_type=db_type, db_name=db_name):
+            groups.setdefault((entry.db_type, entry.db_name, entry.collection_name), []).append(entry)
+
+        pruned = []
+        for entries in groups.values():
+            keep = select_retained(entries, keep_last, keep_daily, keep_weekly, keep_monthly)
+            pruned.extend(entry for entry in entries if entry.id not in keep)
+        if dry_run or not pruned:
+            return pruned
+
+        repos = set()
+        for entry in pruned:
+            delete_artifact(entry.path)
+            if entry.repo:
+                repos.add(entry.repo)
+        self.remove(pruned)
+        for output_dir in {Path(entry.path).parent for entry in pruned if entry.engine == "physical" and not is_storage_url(entry.path)}:
+            self._prune_wal(output_dir)
+        for repo in repos:
+            removed = ChunkStore(repo).collect_garbage()
+            if removed is None:
+                logger.warning(f"Repository '{repo}' is in use by a backup; its unreferenced chunks are removed by the next prune.")
+            else:
+                logger.info(f"Removed {removed} unreferenced chunk(s) from repository '{repo}'.")
+        return pruned
+
+    def _prune_wal(self, output_dir: Path):
+        """
+        Trim the WAL archive next to physical base backups to what the oldest one still
+        kept needs for point-in-time recovery.
+        """
+        archive_dir = output_dir / WAL_ARCHIVE_DIR
+        if not archive_dir.is_dir():
+            return
+        kept = [entry for entry in self.list(db_type="postgres") if entry.engine == "physical" and Path(entry.path).parent == output_dir]
+        if not kept:
+            logger.info(f"No base backup is left in '{output_dir}'; its WAL archive is kept as it is.")
+            return
+        start_wal = base_backup_start_wal(kept[-1].path)
+        if not start_wal:
+            logger.warning(f"Base backup '{kept[-1].path}' does not record its first WAL segment; the WAL archive in '{output_dir}' is not trimmed.")
+            return
+        removed = prune_wal_archive(archive_dir, start_wal)
+        logger.info(f"Removed {removed} archived WAL file(s) older than {start_wal} from '{archive_dir}'.")
+
+
+def select_retained(entries: list, keep_last: int = 0, keep_daily: int = 0, keep_weekly: int = 0, keep_monthly: int = 0):
+    """
+    Ids of the backups a GFS policy keeps: the newest `keep_last`, plus the newest backup of
+    each of the last `keep_daily` days, `keep_weekly` ISO weeks and `keep_monthly` months
+    that have backups. `entries` must be sorted newest first.
+    """
+    keep = {entry.id for entry in entries[:keep_last]}
+    periods = [
+        (keep_daily, lambda created: created.date()),
+        (keep_weekly, lambda created: created.isocalendar()[:2]),
+        (keep_monthly, lambda created: (created.year, created.month)),
+    ]
+    for count, period_of in periods:
+        seen = set()
+        for entry in entries:
+            if len(seen) >= count:
+                break
+            period = period_of(entry.created)
+            if period not in seen:
+                seen.add(period)
+                keep.add(entry.id)
+    return keep
+
+
+def delete_artifact(path):
+    if is_storage_url(path):
+        storage, key = split_location(path)
+        storage.delete(key)
+        return
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+    else:
+        logger.warning(f"Backup '{path}' is already gone; removing it from the catalog.")
+    sidecar_path(path).unlink(missing_ok=True)
+    toc_cache_path(path).unlink(missing_ok=True)
+    # Incremental snapshots of a SQLite backup cannot be restored without it
+    shutil.rmtree(deltas_path(path), ignore_errors=True)
+
+
+def format_entries(entries: list):
+    """
+    Render catalog entries as a table, newest first.
+    """
+    if not entries:
+        return "No backups in the catalog."
+    lines = [f"{'ID':>6}  {'CREATED':19}  {'TYPE':8}  {'DATABASE':24}  {'FORMAT':9}  {'SIZE (MB)':>10}  {'TIME (s)':>9}  PATH"]
+    for e in entries:
+        database = f"{e.db_name}.{e.collection_name}" if e.collection_name else e.db_name
+        lines.append(
+            f"{e.id:>6}  {e.created_at:19}  {e.db_type:8}  {database[:24]:24}  {(e.format or '-'):9}  "
+            f"{(e.size or 0) / (1024 * 1024):10.1f}  {(e.duration or 0):9.1f}  {e.path}"
+        )
+    return "\n".join(lines)
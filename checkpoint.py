@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from logger import setup_logger
+
+logger = setup_logger("checkpoint")
+
+# Backups are written under `<name>.partial` and renamed to `<name>` once complete, so an
+# artifact without the suffix is always a finished backup
+PARTIAL_SUFFIX = ".partial"
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def partial_path(path: Path):
+    path = Path(path)
+    return path.with_name(f"{path.name}{PARTIAL_SUFFIX}")
+
+
+def atomic_write_text(path: Path, text: str):
+    """
+    Replace a file's contents so a reader sees either the old or the new version, never half of one.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def durable_replace(tmp_path: Path, path: Path):
+    """
+    Rename a finished temporary file into place so that its contents and the rename both
+    survive a crash: the file is flushed before the rename and its directory after it.
+    """
+    fd = os.open(tmp_path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+    # Windows cannot open a directory to flush it, and commits renames with the file system journal
+    if os.name != "nt":
+        fd = os.open(Path(path).parent, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def finalize(path: Path):
+    """
+    Move a finished backup from its partial path to its final one. Returns the final path.
+    """
+    path = Path(path)
+    os.replace(partial_path(path), path)
+    return path
+
+
+def discard(path: Path):
+    """
+    Remove what a failed backup left at its partial path.
+    """
+    partial = partial_path(path)
+    if partial.is_dir():
+        shutil.rmtree(partial, ignore_errors=True)
+    else:
+        partial.unlink(missing_ok=True)
+
+
+def find_resumable(output_dir: Path, prefix: str, **expected):
+    """
+    Final path of the newest interrupted backup in `output_dir` whose name starts with `prefix`
+    and whose checkpoint matches `expected` (e.g. db_name=...), or None.
+    """
+    candidates = []
+    for partial in Path(output_dir).glob(f"{prefix}*{PARTIAL_SUFFIX}"):
+        checkpoint = Checkpoint(partial)
+        if checkpoint.exists and all(checkpoint.state.get(key) == value for key, value in expected.items()):
+            candidates.append(partial)
+    if not candidates:
+        return None
+    newest = max(candidates, key=lambda p: p.name)
+    return newest.with_name(newest.name[:-len(PARTIAL_SUFFIX)])
+
+
+class Checkpoint:
+    """
+    Progress of a resumable backup, kept in its partial directory: the plan (every unit of
+    work, fixed when the backup first started) and the units already finished. A unit is
+    marked finished only after its file has been renamed into place, so a resumed run redoes
+    exactly the units whose output may be incomplete.
+    """
+
+    def __init__(self, directory: Path):
+        self.path = Path(directory) / CHECKPOINT_FILE
+        self.state = json.loads(self.path.read_text()) if self.path.exists() else None
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self):
+        return self.state is not None
+
+    def start(self, state: dict):
+        self.state = {**state, "done": {}}
+        self._save()
+
+    def is_done(self, unit_id: str):
+        return unit_id in self.state["done"]
+
+    def mark_done(self, unit_id: str, result: dict):
+        # Called from worker threads as units finish
+        with self._lock:
+            self.state["done"][unit_id] = result
+            self._save()
+
+    def update(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+            self._save()
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+    def _save(self):
+        atomic_write_text(self.path, json.dumps(self.state, indent=2))
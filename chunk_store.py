@@ -0,0 +1,302 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+# Content-defined chunking over every byte of the stream, text or binary. Each byte is mapped
+# to a pseudo-random bit with bytes.translate, and a boundary is considered wherever the bits
+# of the last len(ANCHOR) bytes spell ANCHOR. Both steps run in C (translate and find), so the
+# scan keeps up with dump streams without a per-byte Python rolling hash. A candidate becomes a
+# boundary when the CRC of the WINDOW_SIZE bytes before it matches the mask, so a boundary
+# depends only on the content just before it and an insertion only shifts the chunks around it.
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+BOUNDARY_MASK = (1 << 8) - 1
+WINDOW_SIZE = 48
+# One candidate per 2**len(ANCHOR) bytes; with the mask, a boundary every ~64 KiB past the minimum
+ANCHOR = b"10110010"
+BIT_TABLE = bytes(b"01"[hashlib.blake2b(bytes([value]), digest_size=1).digest()[0] & 1] for value in range(256))
+# Chunks of a snapshot being written are not in any manifest until it commits, so garbage
+# collection must not run alongside a writer. Writers and collection hold lock files in locks/,
+# refreshed in the background while held; one older than STALE_LOCK_SECONDS was left behind by
+# a process that died and is ignored.
+LOCK_REFRESH_SECONDS = 30
+STALE_LOCK_SECONDS = 10 * 60
+GC_LOCK = "gc"
+
+
+class Chunker:
+    """
+    Split a byte stream into content-defined chunks.
+    """
+
+    def __init__(self, min_size: int = MIN_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE, mask: int = BOUNDARY_MASK):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self.buffer = bytearray()
+        # BIT_TABLE image of the buffer, searched for ANCHOR
+        self.bits = bytearray()
+        self.scan_pos = 0
+
+    def _find_cut(self):
+        # Hot loop: bind lookups locally. min_size > WINDOW_SIZE, so windows never underflow.
+        buffer, mask, crc32 = self.buffer, self.mask, zlib.crc32
+        find = self.bits.find
+        width = len(ANCHOR)
+        limit = min(len(buffer), self.max_size)
+        pos = find(ANCHOR, max(self.scan_pos, self.min_size - width), limit)
+        with memoryview(buffer) as view:
+            while pos != -1:
+                end = pos + width
+                if crc32(view[end - WINDOW_SIZE:end]) & mask == 0:
+                    return end
+                pos = find(ANCHOR, pos + 1, limit)
+
+        if len(self.buffer) >= self.max_size:
+            return self.max_size
+        # An anchor may straddle the data that arrives next
+        self.scan_pos = max(limit - width + 1, 0)
+        return None
+
+    def feed(self, data: bytes):
+        """
+        Add data and yield every chunk that is now complete.
+        """
+        self.buffer += data
+        self.bits += data.translate(BIT_TABLE)
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return
+            chunk = bytes(self.buffer[:cut])
+            del self.buffer[:cut]
+            del self.bits[:cut]
+            self.scan_pos = 0
+            yield chunk
+
+    def finish(self):
+        """
+        Yield whatever is left in the buffer as the final chunk.
+        """
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer = bytearray()
+            self.bits = bytearray()
+            yield chunk
+
+
+class ChunkStore:
+    """
+    Deduplicating backup repository.
+
+    Layout:
+        chunks/<2 hex>/<blake2b-256 hex>   unique chunk contents
+        snapshots/<name>.json              manifest: metadata plus the ordered list of chunk hashes
+        locks/                             snapshots being written and a running garbage collection
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.chunks_dir = self.path / "chunks"
+        self.snapshots_dir = self.path / "snapshots"
+        self.locks_dir = self.path / "locks"
+        self.chunks_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+        self.locks_dir.mkdir(exist_ok=True)
+
+    def _chunk_path(self, digest: str):
+        return self.chunks_dir / digest[:2] / digest
+
+    def put_chunk(self, data: bytes):
+        """
+        Store a chunk unless it already exists. Returns (digest, was_written).
+        """
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+        path = self._chunk_path(digest)
+        if path.exists():
+            return digest, False
+
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{digest}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return digest, True
+
+    def get_chunk(self, digest: str):
+        path = self._chunk_path(digest)
+        if not path.exists():
+            raise FileNotFoundError(f"Chunk {digest} is missing from repository '{self.path}'.")
+        data = path.read_bytes()
+        if hashlib.blake2b(data, digest_size=32).hexdigest() != digest:
+            raise ValueError(f"Chunk {digest} in repository '{self.path}' is corrupt.")
+        return data
+
+    def _held(self, path: Path):
+        try:
+            return time.time() - path.stat().st_mtime < STALE_LOCK_SECONDS
+        except FileNotFoundError:
+            return False
+
+    def lock_writer(self):
+        """
+        Mark a snapshot as being written, waiting for a running garbage collection to finish
+        first. Collection checks for writers after taking its own lock, so either it sees this
+        marker and skips, or this waits until it is done.
+        """
+        path = self.locks_dir / f"writer-{uuid.uuid4().hex}"
+        path.touch()
+        lock = RepositoryLock(path)
+        while self._held(self.locks_dir / GC_LOCK):
+            time.sleep(1)
+        return lock
+
+    def writer(self, name: str, metadata: dict = None):
+        return SnapshotWriter(self, name, metadata or {})
+
+    def load_manifest(self, name: str):
+        path = self.snapshots_dir / f"{name}.json"
+        if not path.exists():
+            raise FileNotFoundError(f"Snapshot '{name}' not found in repository '{self.path}'.")
+        return json.loads(path.read_text())
+
+    def snapshots(self, db_name: str = None):
+        """
+        Manifests of all snapshots, oldest first, optionally only for one database.
+        """
+        manifests = [json.loads(path.read_text()) for path in self.snapshots_dir.glob("*.json")]
+        if db_name:
+            manifests = [m for m in manifests if m.get("db_name") == db_name]
+        return sorted(manifests, key=lambda m: (m["created"], m["name"]))
+
+    def latest_snapshot(self, db_name: str):
+        manifests = self.snapshots(db_name)
+        if not manifests:
+            raise FileNotFoundError(f"No snapshots for database '{db_name}' in repository '{self.path}'.")
+        return manifests[-1]
+
+    def collect_garbage(self):
+        """
+        Delete chunks no snapshot refers to any more. Returns the number of chunks removed, or
+        None when snapshots are being written or another collection runs, and nothing was done.
+        """
+        gc_path = self.locks_dir / GC_LOCK
+        if self._held(gc_path):
+            return None
+        gc_path.unlink(missing_ok=True)
+        try:
+            os.close(os.open(gc_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        lock = RepositoryLock(gc_path)
+        try:
+            writers = list(self.locks_dir.glob("writer-*"))
+            if any(self._held(path) for path in writers):
+                return None
+            for path in writers:
+                path.unlink(missing_ok=True)
+
+            referenced = set()
+            for manifest in self.snapshots():
+                referenced.update(manifest["chunks"])
+            removed = 0
+            for path in self.chunks_dir.glob("*/*"):
+                if path.name not in referenced and not path.name.endswith(".tmp"):
+                    path.unlink(missing_ok=True)
+                    removed += 1
+            return removed
+        finally:
+            lock.release()
+
+    def read_snapshot(self, name: str):
+        """
+        Rebuild a snapshot's stream, chunk by chunk.
+        """
+        for digest in self.load_manifest(name)["chunks"]:
+            yield self.get_chunk(digest)
+
+
+class RepositoryLock:
+    """
+    Lock file in a repository's locks/ directory, touched by a background thread for as long
+    as it is held so that it never looks stale.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._released = threading.Event()
+        threading.Thread(target=self._refresh, name="repository-lock", daemon=True).start()
+
+    def _refresh(self):
+        while not self._released.wait(LOCK_REFRESH_SECONDS):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def release(self):
+        self._released.set()
+        self.path.unlink(missing_ok=True)
+
+
+class SnapshotWriter:
+    """
+    Sink for a dump stream: chunks it, stores new chunks and records the manifest on commit.
+    Garbage collection of the repository is held off until it commits or aborts.
+    """
+
+    def __init__(self, store: ChunkStore, name: str, metadata: dict):
+        self.lock = store.lock_writer()
+        self.store = store
+        self.name = name
+        self.metadata = metadata
+        self.chunker = Chunker()
+        self.chunks = []
+        self.size = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def _store(self, chunks):
+        for chunk in chunks:
+            digest, written = self.store.put_chunk(chunk)
+            self.chunks.append(digest)
+            if written:
+                self.new_chunks += 1
+                self.new_bytes += len(chunk)
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        self._store(self.chunker.feed(data))
+
+    def commit(self):
+        """
+        Flush the last chunk and atomically write the manifest. Returns the manifest path.
+        """
+        self._store(self.chunker.finish())
+        manifest = {
+            **self.metadata,
+            "name": self.name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "size": self.size,
+            "new_bytes": self.new_bytes,
+            "new_chunks": self.new_chunks,
+            "chunks": self.chunks,
+        }
+        path = self.store.snapshots_dir / f"{self.name}.json"
+        tmp_path = path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, path)
+        self.lock.release()
+        return path
+
+    def abort(self):
+        """
+        Give up on the snapshot. Chunks it stored are collected by the next garbage collection.
+        """
+        self.lock.release()
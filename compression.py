@@ -0,0 +1,84 @@
+import os
+import shutil
+from pathlib import Path
+
+# Supported stream compressors. Tools are tried in order, so the multi-threaded
+# implementation is preferred when it is installed.
+COMPRESSORS = {
+    "zstd": {"extension": ".zst", "tools": ["zstd"], "default_level": 3, "levels": (1, 19)},
+    "lz4": {"extension": ".lz4", "tools": ["lz4"], "default_level": 1, "levels": (1, 12)},
+    "gzip": {"extension": ".gz", "tools": ["pigz", "gzip"], "default_level": 6, "levels": (1, 9)},
+}
+
+
+class Compression:
+    def __init__(self, algorithm: str, level: int = None, threads: int = None):
+        if algorithm not in COMPRESSORS:
+            raise ValueError(f"Unsupported compression '{algorithm}'. Use one of {', '.join(COMPRESSORS)}.")
+
+        spec = COMPRESSORS[algorithm]
+        low, high = spec["levels"]
+        level = spec["default_level"] if level is None else level
+        if not isinstance(level, int) or not low <= level <= high:
+            raise ValueError(f"{algorithm} compression level must be between {low} and {high}.")
+
+        self.algorithm = algorithm
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.extension = spec["extension"]
+
+    def __str__(self):
+        return f"{self.algorithm}:{self.level}"
+
+    def _find_tool(self):
+        """
+        Locate the compressor binary, preferring the parallel implementation.
+        """
+        for tool in COMPRESSORS[self.algorithm]["tools"]:
+            tool_path = shutil.which(tool)
+            if tool_path:
+                return tool, tool_path
+        raise FileNotFoundError(f"{self.algorithm} not found. Make sure {' or '.join(COMPRESSORS[self.algorithm]['tools'])} is installed and in your PATH.")
+
+    def compress_command(self):
+        """
+        Command that compresses stdin to stdout.
+        """
+        tool, tool_path = self._find_tool()
+        if tool == "zstd":
+            return [tool_path, "-q", f"-{self.level}", f"-T{self.threads}", "-c"]
+        if tool == "pigz":
+            return [tool_path, f"-{self.level}", "-p", str(self.threads), "-c"]
+        return [tool_path, f"-{self.level}", "-c"]
+
+    def decompress_command(self):
+        """
+        Command that decompresses stdin to stdout.
+        """
+        tool, tool_path = self._find_tool()
+        if tool == "zstd":
+            return [tool_path, "-q", "-d", "-c"]
+        return [tool_path, "-d", "-c"]
+
+
+def parse_compression(spec: str):
+    """
+    Parse a `--compress` value such as `zstd`, `lz4` or `gzip:9`.
+    """
+    if not spec:
+        return None
+    algorithm, _, level = spec.strip().lower().partition(":")
+    if level and not level.isdigit():
+        raise ValueError(f"Compression level must be an integer, got '{level}'.")
+    return Compression(algorithm, int(level) if level else None)
+
+
+def detect_compression(path):
+    """
+    Return the Compression matching a backup file's extension, or None when it is not compressed.
+    """
+    suffix = Path(path).suffix.lower()
+    for algorithm, spec in COMPRESSORS.items():
+        if suffix == spec["extension"]:
+            return Compression(algorithm)
+    return None
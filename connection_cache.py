@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+
+# How long a successful connection check is trusted before the endpoint is checked again
+VERIFY_TTL_SECONDS = 60
+
+
+class TTLCache:
+    """
+    Thread-safe dict whose entries expire `ttl` seconds after they were set.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Endpoints, databases and collections that passed a connection check recently
+verified = TTLCache(VERIFY_TTL_SECONDS)
+
+
+def secret_fingerprint(secret: str):
+    """
+    Digest of a password for cache keys, so a check that passed with one password is not
+    trusted for another while the password itself stays out of the cache.
+    """
+    return hashlib.sha256((secret or "").encode()).hexdigest()
+
+
+class ResourceCache:
+    """
+    One long-lived shared resource (a connection pool or client) per key, created on first use.
+    """
+
+    def __init__(self, factory, closer):
+        self.factory = factory
+        self.closer = closer
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, *args, **kwargs):
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = self.factory(*args, **kwargs)
+            return self._resources[key]
+
+    def discard(self, key):
+        with self._lock:
+            resource = self._resources.pop(key, None)
+        if resource is not None:
+            self.closer(resource)
+
+    def close_all(self):
+        with self._lock:
+            resources = list(self._resources.values())
+            self._resources.clear()
+        for resource in resources:
+            self.closer(resource)
@@ -1,2 +1,28 @@
-from .postgres_handlers.init import *
-from .mongodb_handler.init import *
\ No newline at end of file
+import importlib
+
+# Handler package of each --db-type and the backup/restore functions it provides. A package,
+# and with it its database driver, is only imported the first time one of its functions is
+# used, so a run loads just the driver of the database it works on.
+HANDLERS = {
+    "postgres": ("db_handlers.postgres_handlers.init", ["backup_postgres_database", "restore_postgres_database", "archive_postgres_wal", "restore_postgres_physical"]),
+    "mongodb": ("db_handlers.mongodb_handler.init", ["backup_mongo_database", "restore_mongo_database"]),
+    "sqlite": ("db_handlers.sqlite_handler.init", ["backup_sqlite_database", "restore_sqlite_database", "sqlite_path"]),
+    "mysql": ("db_handlers.mysql_handler.init", ["backup_mysql_database", "restore_mysql_database"]),
+}
+FUNCTIONS = {name: db_type for db_type, (_, names) in HANDLERS.items() for name in names}
+
+
+def load_handler(db_type: str):
+    """
+    The handler package of a database type, imported on first use.
+    """
+    if db_type not in HANDLERS:
+        raise ValueError(f"Unsupported database type '{db_type}'. Use one of {', '.join(HANDLERS)}.")
+    return importlib.import_module(HANDLERS[db_type][0])
+
+
+def __getattr__(name):
+    # `handlers.backup_postgres_database` resolves here, importing only the Postgres handler
+    if name in FUNCTIONS:
+        return getattr(load_handler(FUNCTIONS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
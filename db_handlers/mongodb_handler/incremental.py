@@ -0,0 +1,228 @@
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from bson import decode, json_util
+from bson.timestamp import Timestamp
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import OperationFailure
+from logger import setup_logger
+from integrity import HashingWriter, add_to_sidecar
+from .native import RAW_CODEC_OPTIONS, WRITE_BUFFER_SIZE, iter_bson_file
+
+logger = setup_logger("logs")
+
+# Chain metadata kept at the root of a directory backup
+META_FILE = "backup_meta.json"
+DELTAS_DIR = "deltas"
+# Writes per bulk_write call when replaying deltas
+REPLAY_BATCH_SIZE = 1000
+
+
+def current_operation_time(client):
+    """
+    The cluster's latest operation time, or None when the server is not part of a
+    replica set or sharded cluster (change streams are not available there).
+    """
+    return client.admin.command("ping").get("operationTime")
+
+
+def load_meta(backup_dir: Path):
+    path = Path(backup_dir) / META_FILE
+    if not path.exists():
+        return None
+    return json_util.loads(path.read_text())
+
+
+def save_meta(backup_dir: Path, meta: dict):
+    path = Path(backup_dir) / META_FILE
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json_util.dumps(meta, indent=2, json_options=json_util.CANONICAL_JSON_OPTIONS))
+    tmp_path.replace(path)
+
+
+def write_base_meta(backup_dir: Path, db_name: str, collection_name: str, start_time: Timestamp):
+    """
+    Record where a full backup starts in the oplog, so later incremental runs can continue from there.
+    """
+    save_meta(backup_dir, {
+        "db_name": db_name,
+        "collection_name": collection_name,
+        "base_operation_time": start_time,
+        "deltas": [],
+    })
+
+
+class IncrementalCapture:
+    """
+    Capture every change since the end of a backup chain into a compact delta file.
+
+    A change stream is resumed from the last delta's resume token (or the base backup's start
+    operation time) and read up to the cluster time at which this run started. Events are
+    written as raw BSON to `<base>/deltas/<timestamp>.bson` and the chain is recorded in
+    backup_meta.json.
+    """
+
+    def __init__(self, client, db_name: str, base_dir: Path, batch_size: int = None):
+        self.client = client
+        self.db_name = db_name
+        self.base_dir = Path(base_dir)
+        self.batch_size = batch_size
+        self.meta = load_meta(self.base_dir)
+        if not self.meta:
+            raise FileNotFoundError(f"'{self.base_dir}' has no {META_FILE}. Incremental backups need a full directory backup taken from a replica set.")
+        if self.meta["db_name"] != db_name:
+            raise ValueError(f"Backup chain at '{self.base_dir}' belongs to database '{self.meta['db_name']}', not '{db_name}'.")
+
+    def _open_stream(self):
+        collection_name = self.meta.get("collection_name")
+        target = self.client.get_database(self.db_name, codec_options=RAW_CODEC_OPTIONS)
+        if collection_name:
+            target = target.get_collection(collection_name)
+
+        options = {"batch_size": self.batch_size, "max_await_time_ms": 1000}
+        deltas = self.meta["deltas"]
+        if deltas:
+            options["start_after"] = deltas[-1]["resume_token"]
+        else:
+            options["start_at_operation_time"] = self.meta["base_operation_time"]
+        return target.watch(**options)
+
+    def run(self):
+        end_time = current_operation_time(self.client)
+        if end_time is None:
+            raise Exception("Incremental backups need change streams, which require a replica set or sharded cluster.")
+
+        deltas_dir = self.base_dir / DELTAS_DIR
+        deltas_dir.mkdir(exist_ok=True)
+        # Microseconds keep two runs in the same second from sharing a delta file
+        delta_path = deltas_dir / f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.bson"
+        if delta_path.exists():
+            raise FileExistsError(f"Delta '{delta_path}' already exists.")
+        tmp_path = delta_path.with_suffix(".tmp")
+
+        events = 0
+        last_cluster_time = None
+        try:
+            with self._open_stream() as stream, open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                writer = HashingWriter(f)
+                while stream.alive:
+                    # An empty getMore means the stream has caught up; the resume token still
+                    # advances past it, so the next run starts where this one stopped
+                    change = stream.try_next()
+                    if change is None:
+                        break
+                    cluster_time = change["clusterTime"]
+                    writer.write(change.raw)
+                    events += 1
+                    last_cluster_time = cluster_time
+                    if cluster_time >= end_time:
+                        break
+                resume_token = stream.resume_token
+        except OperationFailure as e:
+            tmp_path.unlink(missing_ok=True)
+            raise Exception(f"Could not resume the change stream, the oplog may have rolled over since the last backup. Take a new full backup. ({e})")
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        tmp_path.replace(delta_path)
+        size = writer.size
+        add_to_sidecar(self.base_dir, f"{DELTAS_DIR}/{delta_path.name}", size, writer.checksum)
+        self.meta["deltas"].append({
+            "file": delta_path.name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "events": events,
+            "size": size,
+            "last_cluster_time": last_cluster_time,
+            "resume_token": resume_token,
+        })
+        save_meta(self.base_dir, self.meta)
+        logger.info(f"Captured {events} change(s) ({size} bytes) into {delta_path.name}.")
+        return delta_path
+
+
+class DeltaReplayer:
+    """
+    Replay a chain's delta files on top of a restored base backup, optionally stopping at a
+    point in time. Replay is idempotent: inserts and replaces are upserts, updates re-apply
+    their $set/$unset fields and deletes ignore missing documents.
+    """
+
+    def __init__(self, client, db_name: str, base_dir: Path, until: datetime = None):
+        self.db = client.get_database(db_name)
+        self.base_dir = Path(base_dir)
+        self.meta = load_meta(self.base_dir) or {"deltas": []}
+        # Naive datetimes are taken as local time
+        self.until = until.astimezone(timezone.utc) if until else None
+        self.pending = {}
+        self.applied = 0
+
+    def _past_target(self, cluster_time: Timestamp):
+        return self.until is not None and cluster_time.as_datetime() > self.until
+
+    def _flush(self, collection_name: str = None):
+        names = [collection_name] if collection_name else list(self.pending)
+        for name in names:
+            operations = self.pending.pop(name, [])
+            if operations:
+                self.db.get_collection(name).bulk_write(operations, ordered=True)
+                self.applied += len(operations)
+
+    def _queue(self, collection_name: str, operation):
+        operations = self.pending.setdefault(collection_name, [])
+        operations.append(operation)
+        if len(operations) >= REPLAY_BATCH_SIZE:
+            self._flush(collection_name)
+
+    def _apply(self, change: dict):
+        operation_type = change["operationType"]
+        collection_name = change.get("ns", {}).get("coll")
+
+        if operation_type in ("insert", "replace"):
+            self._queue(collection_name, ReplaceOne(change["documentKey"], change["fullDocument"], upsert=True))
+        elif operation_type == "update":
+            description = change["updateDescription"]
+            # Arrays shortened by $pop, $pull or a pipeline update. The server applies the
+            # truncation before the updated fields, and a $push on `field` would conflict with a
+            # $set of `field.N` in the same update, so it goes first as an update of its own.
+            truncated = description.get("truncatedArrays")
+            if truncated:
+                self._queue(collection_name, UpdateOne(change["documentKey"], {
+                    "$push": {entry["field"]: {"$each": [], "$slice": entry["newSize"]} for entry in truncated}
+                }))
+            update = {}
+            if description.get("updatedFields"):
+                update["$set"] = description["updatedFields"]
+            if description.get("removedFields"):
+                update["$unset"] = {field: "" for field in description["removedFields"]}
+            if update:
+                self._queue(collection_name, UpdateOne(change["documentKey"], update))
+        elif operation_type == "delete":
+            self._queue(collection_name, DeleteOne(change["documentKey"]))
+        elif operation_type == "drop":
+            self._flush()
+            self.db.drop_collection(collection_name)
+        elif operation_type == "rename":
+            self._flush()
+            self.db.get_collection(collection_name).rename(change["to"]["coll"], dropTarget=True)
+        elif operation_type == "dropDatabase":
+            self._flush()
+            for name in self.db.list_collection_names():
+                self.db.drop_collection(name)
+        else:
+            logger.info(f"Skipping '{operation_type}' change during replay.")
+
+    def run(self):
+        start_time = time.time()
+        for delta in self.meta["deltas"]:
+            path = self.base_dir / DELTAS_DIR / delta["file"]
+            for raw in iter_bson_file(path):
+                change = decode(raw)
+                if self._past_target(change["clusterTime"]):
+                    self._flush()
+                    logger.info(f"Reached target time {self.until.isoformat()}; replayed {self.applied} change(s).")
+                    return self.applied
+                self._apply(change)
+        self._flush()
+        logger.info(f"Replayed {self.applied} change(s) from {len(self.meta['deltas'])} delta file(s) in {time.time() - start_time:.1f}s.")
+        return self.applied
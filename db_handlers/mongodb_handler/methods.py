@@ -4,10 +4,12 @@ from urllib.parse import urlparse
 from pathlib import Path
 from .mongodb import MongoDBHandler
 from validation import Validation
+from catalog import Catalog, endpoint_of, artifact_size
+from metrics import track_run, phase
 
 logger = setup_logger("mongodb_tasks")
 
-def fetch_mongo_params_and_validate(database_url: str, collection_name: str, output: str = None, backup_file: str = None, backup_dir: str = None):
+def fetch_mongo_params_and_validate(database_url: str, collection_name: str, output: str = None, backup_file: str = None, backup_dir: str = None, compress: str = None, repo: str = None, engine: str = "tool", jobs: int = 1, batch_size: int = None, incremental_base: str = None, storage: str = None, resume: bool = False, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False):
     if database_url:
         parsed = urlparse(database_url)
         user = parsed.username
@@ -27,40 +29,83 @@ def fetch_mongo_params_and_validate(database_url: str, collection_name: str, out
             format="bson",
             backup_file=backup_file,
             backup_dir=backup_dir,
-            output_dir=output,
-            collection_name=collection_name
+            output_dir=None if storage else output,
+            collection_name=collection_name,
+            compress=compress,
+            repo=repo,
+            engine=engine,
+            jobs=jobs,
+            batch_size=batch_size,
+            incremental_base=incremental_base,
+            storage=storage,
+            resume=resume,
+            max_rate=max_rate,
+            io_priority=io_priority,
+            adaptive=adaptive,
+            encrypt=encrypt
         )
         validator.validate_user_params()
         return db_name
     return None
 
 
-def backup_mongo_database(database_url: str, collection_name: str = None, output: str = None):
-    db_name = fetch_mongo_params_and_validate(database_url=database_url, output=output, collection_name=collection_name)
-    mg = MongoDBHandler(db_name=db_name, output_dir=output, collection_name=collection_name, database_url=database_url)
+def backup_mongo_database(database_url: str, collection_name: str = None, output: str = None, compress: str = None, repo: str = None, engine: str = "tool", jobs: int = 1, batch_size: int = None, incremental_base: str = None, storage: str = None, metrics: str = None, resume: bool = False, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False, passphrase_file: str = None):
+    db_name = fetch_mongo_params_and_validate(database_url=database_url, output=output, collection_name=collection_name, compress=compress, repo=repo, engine=engine, jobs=jobs, batch_size=batch_size, incremental_base=incremental_base, storage=storage, resume=resume, max_rate=max_rate, io_priority=io_priority, adaptive=adaptive, encrypt=encrypt)
 
-    if mg.test_connection():
-        logger.info(f"Started taking backup......")
-        start_time = time.time()
-        backup_dir = mg.backup()
-        end_time = time.time()
-        output_dirname = Path(output).name
-        dirname = Path(backup_dir).name
-        relative_path_str = f"{output_dirname}\\{dirname}"
-        logger.info(f"Backup completed. Saved to {relative_path_str}. Time: {round((end_time-start_time)/60, 3)} minutes.")
-    else:
-        raise Exception(f"Failed to connect to {db_name}.")
+    with track_run("backup", "mongodb", db_name, sink=metrics) as run:
+        mg = MongoDBHandler(db_name=db_name, output_dir=output, collection_name=collection_name, database_url=database_url, compress=compress, repo=repo, engine=engine, jobs=jobs, batch_size=batch_size, storage=storage, resume=resume, max_rate=max_rate, io_priority=io_priority, adaptive=adaptive, encrypt=encrypt, passphrase_file=passphrase_file)
 
+        with phase("connect"):
+            connected = mg.test_connection()
+        if connected:
+            logger.info("Started taking backup......")
+            start_time = time.time()
+            if incremental_base:
+                output = incremental_base
+                backup_dir = mg.backup_incremental(incremental_base)
+            else:
+                backup_dir = mg.backup()
+            end_time = time.time()
+            size = mg.upload.size if mg.upload else artifact_size(backup_dir)
+            run.count("bytes", size)
+            if storage:
+                relative_path_str = str(backup_dir)
+            else:
+                output_dirname = Path(repo).name if repo else Path(output).name
+                dirname = Path(backup_dir).relative_to(repo) if repo else Path(backup_dir).name
+                relative_path_str = f"{output_dirname}\\{dirname}"
+            logger.info(f"Backup completed. Saved to {relative_path_str}. Time: {round((end_time-start_time)/60, 3)} minutes ({size / max(end_time - start_time, 1e-6) / (1024 * 1024):.2f} MB/s).")
+            # Deltas belong to their base backup's entry; only full backups are catalogued
+            if not incremental_base:
+                try:
+                    with phase("catalog"):
+                        Catalog().record(
+                            "mongodb", db_name, backup_dir, endpoint=endpoint_of(database_url), collection_name=collection_name,
+                            format="archive" if compress or repo or storage or encrypt else "bson", engine=engine, compression=compress, repo=repo,
+                            duration=end_time - start_time, size=size, checksum=mg.upload.checksum if mg.upload else None,
+                        )
+                except Exception as e:
+                    logger.warning(f"Could not record the backup in the catalog: {e}")
+            return backup_dir
+        else:
+            raise Exception(f"Failed to connect to {db_name}.")
 
-def restore_mongo_database(database_url: str, collection_name: str = None, backup_dir: str = None):
-    db_name = fetch_mongo_params_and_validate(database_url=database_url, backup_dir=backup_dir, collection_name=collection_name)
-    mg = MongoDBHandler(db_name=db_name, output_dir=None, database_url=database_url)
 
-    if mg.test_connection():
-        logger.info("Connected to MongoDB successfully. Starting restore...")
-        start_time = time.time()
-        mg.restore(backup_dir)
-        end_time = time.time()
-        logger.info(f"Restore completed successfully in {round((end_time-end_time)/60, 3)} minutes.")
-    else:
-        raise Exception(f"Failed to connect to MongoDB at {db_name}.")
+def restore_mongo_database(database_url: str, collection_name: str = None, backup_dir: str = None, repo: str = None, snapshot: str = None, engine: str = "tool", jobs: int = 1, batch_size: int = None, until=None, metrics: str = None, passphrase_file: str = None):
+    db_name = fetch_mongo_params_and_validate(database_url=database_url, backup_dir=backup_dir, collection_name=collection_name, repo=repo, engine=engine, jobs=jobs, batch_size=batch_size)
+
+    with track_run("restore", "mongodb", db_name, sink=metrics) as run:
+        mg = MongoDBHandler(db_name=db_name, output_dir=None, database_url=database_url, repo=repo, engine=engine, jobs=jobs, batch_size=batch_size, passphrase_file=passphrase_file)
+
+        with phase("connect"):
+            connected = mg.test_connection()
+        if connected:
+            logger.info("Connected to MongoDB successfully. Starting restore...")
+            start_time = time.time()
+            mg.restore(backup_dir, snapshot=snapshot, until=until)
+            end_time = time.time()
+            if backup_dir:
+                run.count("bytes", artifact_size(backup_dir))
+            logger.info(f"Restore completed successfully in {round((end_time-start_time)/60, 3)} minutes.")
+        else:
+            raise Exception(f"Failed to connect to MongoDB at {db_name}.")
@@ -1,23 +1,58 @@
 import os
-import subprocess
 import shutil
 import platform
 from datetime import datetime
 from pathlib import Path
-from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, OperationFailure
 from logger import setup_logger
+from compression import parse_compression, detect_compression
+from pipeline import run_pipeline, check_pipeline
+from process_runner import run_process
+from metrics import phase
+from checkpoint import partial_path, finalize, discard, find_resumable
+from chunk_store import ChunkStore
+from storage import open_storage, split_location, is_storage_url, FilesystemStorage
+from integrity import record_checksums
+from encryption import Encryption, load_passphrase, is_encrypted, plain_name, ENCRYPTED_EXTENSION
+from connection_cache import verified
+from throttle import rate_limit, priority_prefix, ThrottledWriter
+from .pool import get_client, discard_client
+from .native import NativeMongoBackup, NativeMongoRestore
+from .incremental import IncrementalCapture, DeltaReplayer, current_operation_time, load_meta, write_base_meta
 
 logger = setup_logger("logs")
 
+# Adaptive throttling backs off once this many operations are queued for the global lock
+BUSY_QUEUED_OPERATIONS = 8
+
 class MongoDBHandler:
-    def __init__(self, db_name: str, database_url: str, output_dir: str = None, collection_name: str = None):
+    def __init__(self, db_name: str, database_url: str, output_dir: str = None, collection_name: str = None, compress: str = None, repo: str = None, engine: str = "tool", jobs: int = 1, batch_size: int = None, storage: str = None, resume: bool = False, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False, passphrase_file: str = None):
         self.db_name = db_name
         self.database_url = database_url
         self.collection_name = collection_name if collection_name else None
+        self.compression = parse_compression(compress)
+        self.repo = ChunkStore(repo) if repo else None
+        self.engine = engine or "tool"
+        self.jobs = jobs or 1
+        self.batch_size = batch_size
+        self.storage = open_storage(storage) if storage else None
+        # Backups are sealed with a passphrase-derived key; restores read the passphrase only when the backup is encrypted
+        self.passphrase_file = passphrase_file
+        self.encryption = Encryption(load_passphrase(passphrase_file)) if encrypt else None
+        # Continue the newest interrupted native backup instead of starting over
+        self.resume = resume
+        # Throttling: MB/s ceiling, priority of the child tools and back-off on server load
+        self.max_rate = max_rate
+        self.io_priority = io_priority
+        self.adaptive = adaptive
+        self.throttle = None
+        # Writer of the last streamed backup, which knows its size and checksum
+        self.upload = None
         if output_dir:
             self.output_dir = Path(output_dir)
-            self.output_dir.mkdir(parents=True, exist_ok=True)
+            # Uploads stream straight to the storage backend; only their names come from here
+            if not self.storage:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
 
     def _find_tool(self, tool_name: str):
         """
@@ -59,40 +94,68 @@ class MongoDBHandler:
         """
         Test connection to MongoDB.
         """
+        # Batch and scheduled runs hit the same endpoints over and over; trust a recent check
+        cache_key = ("mongodb", self.database_url, self.db_name, self.collection_name)
+        if verified.get(cache_key):
+            logger.info(f"Connection to MongoDB database '{self.db_name}' was verified recently.")
+            return True
         try:
-            client = MongoClient(self.database_url, serverSelectionTimeoutMS=5000)
+            client = get_client(self.database_url)
 
             # Ping server
             client.admin.command("ping")
             logger.info(f"Successfully connected to MongoDB server.")
 
-            # List databases
-            db_list = client.list_database_names()
-            if self.db_name not in db_list:
+            # Look up only this database instead of listing every database on the cluster
+            if not list(client.list_databases(filter={"name": self.db_name}, nameOnly=True)):
                 raise Exception(f"Database '{self.db_name}' does not exist on the server.")
 
             logger.info(f"Database '{self.db_name}' exists.")
 
             if self.collection_name:
-                collection_list = client[self.db_name].list_collection_names()
-                if self.collection_name not in collection_list:
+                if not client[self.db_name].list_collection_names(filter={"name": self.collection_name}):
                     raise Exception(f"Collection '{self.collection_name}' does not exist in database '{self.db_name}'.")
                 logger.info(f"Collection '{self.collection_name}' exists in database '{self.db_name}'.")
 
-            client.close()
+            verified.set(cache_key, True)
             return True
         except ConnectionFailure as e:
-            raise Exception(f"Could not connect to MongoDB server at {self.host}:{self.port}: {e}")
+            discard_client(self.database_url)
+            raise Exception(f"Could not connect to MongoDB server for database '{self.db_name}': {e}")
         except OperationFailure as e:
+            discard_client(self.database_url)
             raise Exception(f"Authentication failed: {e}")
         except Exception as e:
             raise Exception(f"Unexpected connection error: {e}")
 
+    def server_busy(self):
+        """
+        Load signal for adaptive throttling from serverStatus: a description when operations
+        queue up or the storage engine has run out of read or write tickets, otherwise None.
+        """
+        status = get_client(self.database_url).admin.command("serverStatus", repl=0, metrics=0, locks=0)
+        queued = status.get("globalLock", {}).get("currentQueue", {}).get("total", 0)
+        if queued >= BUSY_QUEUED_OPERATIONS:
+            return f"{queued} operations queued"
+        # MongoDB 7.0 moved the ticket counters from wiredTiger.concurrentTransactions to queues.execution
+        tickets = status.get("queues", {}).get("execution") or status.get("wiredTiger", {}).get("concurrentTransactions", {})
+        for kind in ("read", "write"):
+            if tickets.get(kind, {}).get("available", 1) == 0:
+                return f"no {kind} tickets available"
+        return None
+
     def backup(self):
         """
-        Backup the MongoDB database using mongodump.
+        Backup the MongoDB database using mongodump, or the in-process native engine.
         """
-        mongodump_path = self._find_tool("mongodump")
+        with rate_limit(self.max_rate, adaptive=self.adaptive, probe=self.server_busy) as bucket:
+            self.throttle = bucket
+            return self._backup()
+
+    def _sink(self, writer):
+        return ThrottledWriter(writer, self.throttle) if self.throttle else writer
+
+    def _backup(self):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_db_name = self.db_name.replace(" ", "_")
 
@@ -101,10 +164,37 @@ class MongoDBHandler:
         else:
             backup_dir = self.output_dir / f"{safe_db_name}_backup_{timestamp}"
 
+        # Directory backups remember the cluster time they started at, so they can be the
+        # base of an incremental chain. Taken before the dump so no change is missed.
+        writes_directory = self.engine == "native" or not (self.repo or self.compression or self.storage or self.encryption)
+        start_time = current_operation_time(get_client(self.database_url)) if writes_directory else None
+
+        if self.engine == "native":
+            if self.resume:
+                interrupted = find_resumable(self.output_dir, backup_dir.name.removesuffix(timestamp), db_name=self.db_name, collection_name=self.collection_name)
+                if interrupted:
+                    backup_dir = interrupted
+                else:
+                    logger.info(f"No interrupted backup of '{self.db_name}' in '{self.output_dir}'. Starting a new one.")
+            # A resumed dump keeps the chain start of its first attempt, the earliest point it read from
+            work_dir = partial_path(backup_dir)
+            if not load_meta(work_dir):
+                work_dir.mkdir(parents=True, exist_ok=True)
+                self._record_chain_start(work_dir, start_time)
+            engine = NativeMongoBackup(
+                get_client(self.database_url), self.db_name, backup_dir,
+                collection_name=self.collection_name, jobs=self.jobs, batch_size=self.batch_size, throttle=self.throttle,
+            )
+            with phase("dump"):
+                return engine.run()
+
+        with phase("tool_lookup"):
+            mongodump_path = self._find_tool("mongodump")
+
         command = [
+            *priority_prefix(self.io_priority),
             mongodump_path,
             "--uri", self.database_url,
-            "--out", str(backup_dir),
             "--authenticationDatabase", "admin",
         ]
 
@@ -112,17 +202,113 @@ class MongoDBHandler:
         if self.collection_name:
             command.extend(["--collection", self.collection_name])
 
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Backup failed:\nSTDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}")
+        if self.jobs > 1:
+            command.extend(["--numParallelCollections", str(self.jobs)])
+
+        if self.repo:
+            # Stream a single archive into the chunk store, writing only chunks it has not seen before
+            command.append("--archive")
+            writer = self.repo.writer(backup_dir.name, {"db_type": "mongodb", "db_name": self.db_name, "collection_name": self.collection_name, "format": "archive"})
+            try:
+                with phase("dump"):
+                    results = run_pipeline([command], sink=self._sink(writer), logger=logger)
+                check_pipeline(results, "Backup")
+                with phase("store"):
+                    manifest_path = writer.commit()
+            except Exception:
+                writer.abort()
+                raise
+            logger.info(f"Snapshot '{backup_dir.name}' stored: {writer.size} bytes in {len(writer.chunks)} chunks, {writer.new_bytes} bytes in {writer.new_chunks} new chunks.")
+            return manifest_path
+
+        if self.storage or self.compression or self.encryption:
+            # Stream a single archive, compressed on all cores and encrypted when asked, instead of
+            # writing raw .bson files. It goes to the storage backend, or to the output directory,
+            # through a writer that checksums it as it is written.
+            key = f"{backup_dir.name}.archive{self.compression.extension if self.compression else ''}{ENCRYPTED_EXTENSION if self.encryption else ''}"
+            command.append("--archive")
+            if self.compression:
+                logger.info(f"Compressing backup stream with {self.compression}.")
+            if self.encryption:
+                logger.info("Encrypting backup stream with AES-256-GCM.")
+            commands = [command, priority_prefix(self.io_priority) + self.compression.compress_command()] if self.compression else [command]
+            writer = (self.storage or FilesystemStorage(self.output_dir)).writer(key)
+            sink = writer
+            try:
+                if self.encryption:
+                    sink = self.encryption.writer(writer)
+                with phase("dump"):
+                    results = run_pipeline(commands, sink=self._sink(sink), logger=logger)
+                check_pipeline(results, "Backup")
+                with phase("upload"):
+                    location = sink.commit()
+            except Exception:
+                sink.abort()
+                raise
+            self.upload = writer
+            return location if self.storage else Path(location)
+
+        command.extend(["--out", str(partial_path(backup_dir))])
+        if self.throttle:
+            logger.warning("mongodump writes directory backups itself, so --max-rate cannot pace them. Use --io-priority, --compress or the native engine.")
+        try:
+            with phase("dump"):
+                run_process(command, "Backup", logger=logger)
+        except Exception:
+            discard(backup_dir)
+            raise
+        finalize(backup_dir)
+        # mongodump wrote these files itself, so they are read back once to checksum them
+        with phase("checksum"):
+            record_checksums(backup_dir, jobs=self.jobs)
+        self._record_chain_start(backup_dir, start_time)
 
         return backup_dir
 
-    def restore(self, backup_dir):
+    def _record_chain_start(self, backup_dir: Path, start_time):
+        if start_time is None:
+            logger.info("Server is not a replica set; this backup cannot be the base of incremental backups.")
+            return
+        write_base_meta(backup_dir, self.db_name, self.collection_name, start_time)
+
+    def backup_incremental(self, base_dir):
         """
-        Restore the MongoDB database using mongorestore.
+        Capture only the changes made since the last backup of a chain into a delta file.
         """
-        mongorestore_path = self._find_tool("mongorestore")
+        capture = IncrementalCapture(get_client(self.database_url), self.db_name, base_dir, batch_size=self.batch_size)
+        with phase("capture"):
+            return capture.run()
+
+    def _replay_deltas(self, backup_dir, until=None):
+        meta = load_meta(backup_dir)
+        if not meta or not meta["deltas"]:
+            if until:
+                raise ValueError(f"'{backup_dir}' has no incremental deltas to replay up to {until}.")
+            return
+        logger.info(f"Replaying {len(meta['deltas'])} incremental delta(s){f' up to {until}' if until else ''}.")
+        with phase("replay"):
+            DeltaReplayer(get_client(self.database_url), self.db_name, backup_dir, until=until).run()
+
+    def restore(self, backup_dir=None, snapshot: str = None, until=None):
+        """
+        Restore the MongoDB database using mongorestore, or the in-process native engine.
+        Directory backups with incremental deltas are rolled forward, optionally only up to `until`.
+        """
+        remote = is_storage_url(backup_dir)
+        if until and (self.repo or remote or Path(backup_dir).is_file()):
+            raise ValueError("Point-in-time restore needs a directory backup with incremental deltas.")
+
+        if self.engine == "native":
+            engine = NativeMongoRestore(
+                get_client(self.database_url), self.db_name, backup_dir,
+                collection_name=self.collection_name, jobs=self.jobs, batch_size=self.batch_size,
+            )
+            with phase("restore"):
+                engine.run()
+            return self._replay_deltas(backup_dir, until)
+
+        with phase("tool_lookup"):
+            mongorestore_path = self._find_tool("mongorestore")
 
         # Base command with URI
         command = [
@@ -131,6 +317,54 @@ class MongoDBHandler:
             "--authenticationDatabase", "admin",
             "--drop"
         ]
+        if self.jobs > 1:
+            command.extend(["--numParallelCollections", str(self.jobs)])
+
+        namespace = f"{self.db_name}.{self.collection_name}" if self.collection_name else f"{self.db_name}.*"
+
+        if self.repo:
+            # Rebuild the archive stream from the manifest straight into mongorestore's stdin
+            manifest = self.repo.load_manifest(snapshot) if snapshot else self.repo.latest_snapshot(self.db_name)
+            logger.info(f"Restoring snapshot '{manifest['name']}' from repository.")
+            command.extend(["--archive", "--nsInclude", namespace])
+            with phase("restore"):
+                results = run_pipeline([command], source=self.repo.read_snapshot(manifest["name"]), logger=logger)
+            check_pipeline(results, "Restore")
+            return
+
+        compression = detect_compression(plain_name(backup_dir)) if backup_dir else None
+        encrypted = bool(backup_dir) and is_encrypted(backup_dir)
+        if remote or encrypted:
+            # Archive in object storage: download ranges ahead and stream them into mongorestore.
+            # Encrypted archives are decrypted on a thread pool on the way.
+            if remote:
+                storage, key = split_location(backup_dir)
+                logger.info(f"Streaming backup from {backup_dir}.")
+            else:
+                storage, key = FilesystemStorage(Path(backup_dir).parent), Path(backup_dir).name
+            command.extend(["--archive", "--nsInclude", namespace])
+            source = storage.reader(key)
+            if encrypted:
+                logger.info("Decrypting backup stream.")
+                source = Encryption(load_passphrase(self.passphrase_file)).decrypt(source, name=key)
+            commands = [compression.decompress_command(), command] if compression else [command]
+            with phase("restore"):
+                results = run_pipeline(commands, source=source, logger=logger)
+            check_pipeline(results, "Restore")
+            return
+
+        if backup_dir and Path(backup_dir).is_file():
+            # A single archive file, e.g. written through --storage file://; compressed ones are
+            # decompressed on the fly into mongorestore's stdin
+            command.extend(["--archive", "--nsInclude", namespace])
+            commands = [command]
+            if compression:
+                logger.info(f"Decompressing {compression.algorithm} backup stream.")
+                commands.insert(0, compression.decompress_command())
+            with phase("restore"):
+                results = run_pipeline(commands, input_path=backup_dir, logger=logger)
+            check_pipeline(results, "Restore")
+            return
 
         # If restoring a specific collection
         if self.collection_name:
@@ -159,9 +393,6 @@ class MongoDBHandler:
                 "--dir", str(db_dir)
             ])
 
-        try:
-            result = subprocess.run(command, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"Restore failed:\nSTDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}")
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"Restore process error: {e}")
+        with phase("restore"):
+            run_process(command, "Restore", logger=logger)
+        self._replay_deltas(backup_dir, until)
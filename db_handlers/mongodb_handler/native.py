@@ -0,0 +1,418 @@
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from bson import json_util, ObjectId, Int64, Decimal128
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from logger import setup_logger
+from metrics import phase, count
+from checkpoint import Checkpoint, partial_path, finalize
+from integrity import HashingWriter, record_checksums
+from throttle import ThrottledWriter
+
+logger = setup_logger("logs")
+
+# Documents come back as undecoded BSON bytes and are written out as-is
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+DEFAULT_BATCH_SIZE = 5000
+# Restore batches are also capped by size, well below the 48 MB wire message limit
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Collections are split into _id ranges once they hold this many documents per range
+MIN_DOCS_PER_RANGE = 500_000
+# Sampled _ids per range when picking range boundaries
+SAMPLES_PER_RANGE = 100
+
+# $type aliases for the _id types that can be split into ranges. Range filters only match
+# _ids of the same type, so other types are picked up by a separate remainder unit.
+SPLITTABLE_ID_TYPES = {
+    ObjectId: "objectId",
+    int: "number",
+    float: "number",
+    Int64: "number",
+    Decimal128: "number",
+    str: "string",
+    datetime: "date",
+}
+
+
+class DumpUnit:
+    """
+    One cursor's worth of work: a whole collection or one _id range of it.
+    """
+
+    def __init__(self, collection_name: str, part: int, filter: dict, estimated_docs: int):
+        self.collection_name = collection_name
+        self.part = part
+        self.filter = filter
+        self.estimated_docs = estimated_docs
+        self.documents = 0
+        self.bytes = 0
+
+
+class NativeMongoBackup:
+    """
+    In-process replacement for mongodump.
+
+    Collections (and _id ranges of large collections) are read in parallel on a thread pool
+    with large-batch cursors. Documents are never decoded: the raw BSON bytes are written to
+    `<backup_dir>/<db>/<collection>.bson` next to a `<collection>.metadata.json`, the same
+    layout mongodump produces, so mongorestore can read the result.
+
+    The dump is built in `<backup_dir>.partial` with a checkpoint of finished units. When it
+    is interrupted the directory is kept, and running again over it dumps only the units that
+    did not finish. A token bucket, when given, paces all units together.
+    """
+
+    def __init__(self, client, db_name: str, backup_dir: Path, collection_name: str = None, jobs: int = 4, batch_size: int = None, throttle=None):
+        self.client = client
+        self.db_name = db_name
+        self.db = client.get_database(db_name)
+        self.backup_dir = Path(backup_dir)
+        self.work_dir = partial_path(self.backup_dir)
+        self.db_dir = self.work_dir / db_name
+        self.checkpoint = Checkpoint(self.work_dir)
+        self.collection_name = collection_name
+        self.jobs = max(jobs or 1, 1)
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.throttle = throttle
+
+    def _collections(self):
+        filter = {"name": self.collection_name} if self.collection_name else {}
+        for info in self.db.list_collections(filter=filter):
+            if info.get("type", "collection") != "collection" or info["name"].startswith("system."):
+                logger.info(f"Skipping {info.get('type', 'collection')} '{info['name']}'.")
+                continue
+            yield info
+
+    def _write_metadata(self, info: dict):
+        collection = self.db.get_collection(info["name"])
+        uuid = info.get("info", {}).get("uuid")
+        metadata = {
+            "indexes": list(collection.list_indexes()),
+            "uuid": (uuid.hex() if isinstance(uuid, bytes) else uuid.hex) if uuid is not None else "",
+            "collectionName": info["name"],
+            "type": "collection",
+            "options": info.get("options", {}),
+        }
+        path = self.db_dir / f"{info['name']}.metadata.json"
+        path.write_text(json_util.dumps(metadata, json_options=json_util.CANONICAL_JSON_OPTIONS))
+
+    def _range_boundaries(self, collection, parts: int):
+        """
+        Approximate quantiles of _id from a random sample, or None when _id cannot be split.
+        """
+        sample = list(collection.aggregate([
+            {"$sample": {"size": parts * SAMPLES_PER_RANGE}},
+            {"$project": {"_id": 1}},
+            {"$sort": {"_id": 1}},
+        ], allowDiskUse=True))
+        if not sample:
+            return None, None
+        id_types = {SPLITTABLE_ID_TYPES.get(type(doc["_id"])) for doc in sample}
+        if len(id_types) != 1 or None in id_types:
+            return None, None
+        step = len(sample) / parts
+        boundaries = []
+        for i in range(1, parts):
+            value = sample[int(i * step)]["_id"]
+            if not boundaries or value != boundaries[-1]:
+                boundaries.append(value)
+        return boundaries, id_types.pop()
+
+    def _plan(self, name: str):
+        collection = self.db.get_collection(name)
+        estimated = collection.estimated_document_count()
+        parts = min(self.jobs * 2, estimated // MIN_DOCS_PER_RANGE)
+        if self.jobs == 1 or parts < 2:
+            return [DumpUnit(name, 0, {}, estimated)]
+
+        boundaries, id_type = self._range_boundaries(collection, parts)
+        if not boundaries:
+            return [DumpUnit(name, 0, {}, estimated)]
+
+        filters = [{"_id": {"$lt": boundaries[0]}}]
+        filters += [{"_id": {"$gte": low, "$lt": high}} for low, high in zip(boundaries, boundaries[1:])]
+        filters.append({"_id": {"$gte": boundaries[-1]}})
+        # Documents whose _id is of another type never match the range filters above
+        filters.append({"_id": {"$not": {"$type": id_type}}})
+        per_range = estimated // (len(filters) - 1)
+        logger.info(f"Splitting '{name}' (~{estimated} documents) into {len(filters) - 1} _id ranges.")
+        return [DumpUnit(name, part, filter, per_range if part < len(filters) - 1 else 0) for part, filter in enumerate(filters)]
+
+    def _part_path(self, unit: DumpUnit):
+        return self.db_dir / f"{unit.collection_name}.bson.part{unit.part}"
+
+    @staticmethod
+    def _unit_id(unit: DumpUnit):
+        return f"{unit.collection_name}.part{unit.part}"
+
+    def _dump_unit(self, unit: DumpUnit):
+        collection = self.db.get_collection(unit.collection_name, codec_options=RAW_CODEC_OPTIONS)
+        cursor = collection.find(unit.filter, batch_size=self.batch_size)
+        if unit.filter:
+            cursor = cursor.hint([("_id", 1)])
+        path = self._part_path(unit)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            writer = HashingWriter(f)
+            sink = ThrottledWriter(writer, self.throttle) if self.throttle else writer
+            for document in cursor:
+                raw = document.raw
+                sink.write(raw)
+                unit.documents += 1
+        tmp_path.replace(path)
+        unit.bytes = writer.size
+        self.checkpoint.mark_done(self._unit_id(unit), {"documents": unit.documents, "bytes": unit.bytes, "checksum": writer.checksum})
+        return unit
+
+    def _assemble(self, name: str, units: list):
+        """
+        Join a collection's part files, in order, into <collection>.bson. Parts are removed
+        only once the joined file is in place, so an interrupted join can simply be redone.
+        Returns the joined file's size and checksum (the join hashes what it copies), or None
+        when they are not known and the file has to be read back.
+        """
+        target = self.db_dir / f"{name}.bson"
+        parts = [self._part_path(unit) for unit in units]
+        done = self.checkpoint.state["done"]
+        if len(parts) == 1:
+            if not target.exists():
+                parts[0].replace(target)
+            unit = done[self._unit_id(units[0])]
+            # None for parts finished before checksums were recorded; record_checksums hashes those
+            return {"size": unit["bytes"], "checksum": unit["checksum"]} if "checksum" in unit else None
+
+        checksums = self.checkpoint.state.get("assembled", {})
+        if target.exists():
+            for part in parts:
+                part.unlink(missing_ok=True)
+            return checksums.get(name)
+        tmp_path = target.with_name(f"{target.name}.tmp")
+        with open(tmp_path, "wb") as out:
+            writer = HashingWriter(out)
+            for part in parts:
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, writer, WRITE_BUFFER_SIZE)
+        tmp_path.replace(target)
+        self.checkpoint.update(assembled={**checksums, name: {"size": writer.size, "checksum": writer.checksum}})
+        for part in parts:
+            part.unlink()
+        return {"size": writer.size, "checksum": writer.checksum}
+
+    def _start(self):
+        """
+        Write collection metadata, plan the units and record the plan in a new checkpoint.
+        """
+        plan = {}
+        for info in self._collections():
+            self._write_metadata(info)
+            plan[info["name"]] = self._plan(info["name"])
+        if self.collection_name and self.collection_name not in plan:
+            raise Exception(f"Collection '{self.collection_name}' does not exist in database '{self.db_name}'.")
+
+        self.checkpoint.start({
+            "engine": "native",
+            "db_name": self.db_name,
+            "collection_name": self.collection_name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            # Range filters hold ObjectIds, dates and other BSON values
+            "plan": json_util.dumps({
+                name: [{"part": u.part, "filter": u.filter, "estimated_docs": u.estimated_docs} for u in units]
+                for name, units in plan.items()
+            }, json_options=json_util.CANONICAL_JSON_OPTIONS),
+        })
+        return plan
+
+    def _resume(self):
+        """
+        Rebuild the plan of an interrupted dump from its checkpoint.
+        """
+        saved = json_util.loads(self.checkpoint.state["plan"])
+        plan = {
+            name: [DumpUnit(name, u["part"], u["filter"], u["estimated_docs"]) for u in units]
+            for name, units in saved.items()
+        }
+        total = sum(len(units) for units in plan.values())
+        logger.warning(
+            f"Resuming dump in '{self.work_dir}': {len(self.checkpoint.state['done'])} of {total} unit(s) already dumped. "
+            "Units dumped now reflect the database as it is at this point."
+        )
+        return plan
+
+    def run(self):
+        start_time = time.time()
+        resuming = self.checkpoint.exists
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            plan = self._resume() if resuming else self._start()
+            # Biggest units first so the pool does not end on one long straggler
+            units = [unit for units in plan.values() for unit in units]
+            pending = sorted((u for u in units if not self.checkpoint.is_done(self._unit_id(u))), key=lambda u: u.estimated_docs, reverse=True)
+            logger.info(f"Dumping {len(plan)} collection(s) as {len(pending)} unit(s) with {self.jobs} worker(s).")
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="mongodump") as executor:
+                for unit in executor.map(self._dump_unit, pending):
+                    logger.info(f"Dumped {unit.documents} documents ({unit.bytes} bytes) from '{unit.collection_name}' part {unit.part}.")
+
+            checksums = {}
+            for name, collection_units in plan.items():
+                assembled = self._assemble(name, collection_units)
+                if assembled:
+                    checksums[f"{self.db_name}/{name}.bson"] = assembled
+        except Exception:
+            if not self.checkpoint.exists:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+            else:
+                logger.error(
+                    f"Dump interrupted with {len(self.checkpoint.state['done'])} unit(s) finished. "
+                    f"Run it again with --resume to dump only the rest into '{self.backup_dir.name}'."
+                )
+            raise
+
+        done = self.checkpoint.state["done"].values()
+        total_docs = sum(unit["documents"] for unit in done)
+        total_bytes = sum(unit["bytes"] for unit in done)
+        self.checkpoint.remove()
+        finalize(self.backup_dir)
+        # .bson files were checksummed while they were written; only metadata is read here
+        record_checksums(self.backup_dir, known=checksums)
+
+        count("documents", total_docs)
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Native dump wrote {total_docs} documents, {total_bytes} bytes in {elapsed:.1f}s ({total_bytes / elapsed / (1024 * 1024):.1f} MB/s).")
+        return self.backup_dir
+
+
+def iter_bson_file(path: Path):
+    """
+    Yield the raw bytes of every document in a .bson file.
+
+    The file is memory-mapped and split on the 4-byte little-endian length prefix that starts
+    each document, so nothing is parsed and the only copy is the document's own bytes.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset < size:
+                if offset + 4 > size:
+                    raise ValueError(f"Truncated document at offset {offset} in {path}.")
+                (length,) = struct.unpack_from("<i", mm, offset)
+                if length < 5 or offset + length > size:
+                    raise ValueError(f"Corrupt document length {length} at offset {offset} in {path}.")
+                yield mm[offset:offset + length]
+                offset += length
+
+
+class NativeMongoRestore:
+    """
+    In-process replacement for mongorestore --drop.
+
+    Every collection is dropped and recreated with its saved options, then its .bson file is
+    streamed into unordered insert_many batches that run in parallel on a thread pool.
+    Secondary indexes from metadata.json are built only after all data is loaded, one
+    createIndexes command per collection so the server builds them in a single pass.
+    """
+
+    def __init__(self, client, db_name: str, backup_dir: Path, collection_name: str = None, jobs: int = 4, batch_size: int = None):
+        self.db = client.get_database(db_name)
+        self.db_name = db_name
+        self.db_dir = Path(backup_dir) / db_name
+        self.collection_name = collection_name
+        self.jobs = max(jobs or 1, 1)
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.documents = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def _bson_files(self):
+        if not self.db_dir.exists():
+            raise FileNotFoundError(f"Backup directory for the database not found: {self.db_dir}")
+        if self.collection_name:
+            path = self.db_dir / f"{self.collection_name}.bson"
+            if not path.exists():
+                raise FileNotFoundError(f"Collection BSON file not found: {path}")
+            return [path]
+        return sorted(self.db_dir.glob("*.bson"))
+
+    def _metadata(self, name: str):
+        path = self.db_dir / f"{name}.metadata.json"
+        return json_util.loads(path.read_text()) if path.exists() else {}
+
+    def _batches(self, path: Path):
+        batch, batch_bytes = [], 0
+        for raw in iter_bson_file(path):
+            batch.append(RawBSONDocument(raw))
+            batch_bytes += len(raw)
+            if len(batch) >= self.batch_size or batch_bytes >= MAX_BATCH_BYTES:
+                yield batch, batch_bytes
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch, batch_bytes
+
+    def _insert(self, collection, batch: list, batch_bytes: int, slots: threading.Semaphore):
+        try:
+            collection.insert_many(batch, ordered=False, bypass_document_validation=True)
+            with self._lock:
+                self.documents += len(batch)
+                self.bytes += batch_bytes
+        finally:
+            slots.release()
+
+    def _load(self, executor: ThreadPoolExecutor, name: str, path: Path, metadata: dict):
+        self.db.drop_collection(name)
+        options = metadata.get("options") or {}
+        self.db.create_collection(name, **options)
+        collection = self.db.get_collection(name, codec_options=RAW_CODEC_OPTIONS)
+
+        # At most two batches per worker are queued, so memory stays bounded on huge files
+        slots = threading.Semaphore(self.jobs * 2)
+        futures = []
+        for batch, batch_bytes in self._batches(path):
+            slots.acquire()
+            futures.append(executor.submit(self._insert, collection, batch, batch_bytes, slots))
+        return futures
+
+    def _build_indexes(self, name: str, metadata: dict):
+        indexes = []
+        for index in metadata.get("indexes", []):
+            if index.get("name") == "_id_":
+                continue
+            index = {key: value for key, value in index.items() if key not in ("v", "ns")}
+            indexes.append(index)
+        if indexes:
+            self.db.command("createIndexes", name, indexes=indexes)
+            logger.info(f"Built {len(indexes)} index(es) on '{name}'.")
+
+    def run(self):
+        start_time = time.time()
+        files = self._bson_files()
+        metadata = {path.stem: self._metadata(path.stem) for path in files}
+
+        logger.info(f"Restoring {len(files)} collection(s) with {self.jobs} insert worker(s), batches of {self.batch_size}.")
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="mongorestore") as executor:
+            futures = []
+            for path in files:
+                futures.extend(self._load(executor, path.stem, path, metadata[path.stem]))
+            for future in futures:
+                future.result()
+        load_time = time.time() - start_time
+        logger.info(f"Loaded {self.documents} documents ({self.bytes} bytes) in {load_time:.1f}s.")
+        count("documents", self.documents)
+
+        # Index builds are independent per collection, so they run in parallel too
+        with phase("indexes"), ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="createIndexes") as executor:
+            for future in [executor.submit(self._build_indexes, name, meta) for name, meta in metadata.items()]:
+                future.result()
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Native restore finished in {elapsed:.1f}s ({self.bytes / elapsed / (1024 * 1024):.1f} MB/s).")
@@ -0,0 +1,24 @@
+import atexit
+from pymongo import MongoClient
+from connection_cache import ResourceCache
+
+# MongoClient is itself a thread-safe connection pool, so one client per URL is shared
+_clients = ResourceCache(
+    factory=lambda database_url: MongoClient(database_url, serverSelectionTimeoutMS=5000),
+    closer=lambda client: client.close(),
+)
+atexit.register(_clients.close_all)
+
+
+def get_client(database_url: str):
+    """
+    Shared MongoClient for a connection URL.
+    """
+    return _clients.get(database_url, database_url)
+
+
+def discard_client(database_url: str):
+    """
+    Close and forget a client, e.g. after its server became unreachable.
+    """
+    _clients.discard(database_url)
@@ -0,0 +1,2 @@
+from .methods import *
+from .mysql import *
\ No newline at end of file
@@ -0,0 +1,85 @@
+import pymysql
+from datetime import datetime
+from pathlib import Path
+from logger import setup_logger
+from compression import parse_compression
+from connection_cache import verified, secret_fingerprint
+from .native import NativeMySQLBackup, NativeMySQLRestore, RAW_CONVERSIONS
+
+logger = setup_logger("logs")
+
+DEFAULT_PORT = 3306
+DEFAULT_USER = "root"
+CONNECT_TIMEOUT = 10
+# Server errors test_connection turns into readable messages
+UNKNOWN_DATABASE = 1049
+ACCESS_DENIED = 1045
+CANNOT_CONNECT = 2003
+
+
+class MySQLHandler:
+    def __init__(self, host: str, port: int, user: str, password: str, db_name: str, output_dir: str = None, format: str = "directory", jobs: int = 4, compress: str = None):
+        self.host = host.strip()
+        self.port = port or DEFAULT_PORT
+        self.user = user
+        self.password = password
+        self.db_name = db_name
+        # The native engine always writes a directory of range files
+        self.format = format
+        self.jobs = jobs or 1
+        # Each range file is compressed on its own by a single-threaded compressor
+        self.compression = parse_compression(compress)
+        # Directory backups have no single stream; their files are checksummed as they are written
+        self.upload = None
+        if output_dir:
+            self.output_dir = Path(output_dir)
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def connect(self, raw: bool = False, local_infile: bool = False):
+        """
+        A new autocommit connection. Raw connections return column values as the server's
+        undecoded text, for the range exports. LOAD DATA LOCAL lets the server ask the client
+        for any file it can read, so only the restore's load connections enable it.
+        """
+        options = {"conv": RAW_CONVERSIONS, "use_unicode": False} if raw else {}
+        return pymysql.connect(
+            host=self.host, port=self.port, user=self.user, password=self.password, database=self.db_name,
+            charset="utf8mb4", autocommit=True, local_infile=local_infile, connect_timeout=CONNECT_TIMEOUT, **options,
+        )
+
+    def test_connection(self):
+        # Batch and scheduled runs hit the same endpoints over and over; trust a recent check
+        cache_key = ("mysql", self.host, self.port, self.user, secret_fingerprint(self.password), self.db_name)
+        if verified.get(cache_key):
+            logger.info(f"Connection to '{self.db_name}' at {self.host}:{self.port} was verified recently.")
+            return True
+        try:
+            conn = self.connect()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT VERSION()")
+                    logger.info(f"Server version: {cursor.fetchone()[0]}")
+            finally:
+                conn.close()
+            verified.set(cache_key, True)
+            return True
+        except pymysql.err.OperationalError as e:
+            code = e.args[0] if e.args else None
+            if code == UNKNOWN_DATABASE:
+                raise Exception(f"Database '{self.db_name}' does not exist.")
+            elif code == ACCESS_DENIED:
+                raise Exception("Authentication failed. Please check your username or password.")
+            elif code == CANNOT_CONNECT:
+                raise Exception(f"Could not connect to the server at {self.host}:{self.port}. Is MySQL running?")
+            else:
+                raise Exception(f"OperationalError: {e}")
+        except Exception as e:
+            raise Exception(f"Unexpected connection error: {e}")
+
+    def backup(self):
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        backup_dir = self.output_dir / f"{self.db_name}_backup_{timestamp}"
+        return NativeMySQLBackup(self.connect, self.db_name, backup_dir, jobs=self.jobs, compression=self.compression).run()
+
+    def restore(self, backup_dir: str):
+        NativeMySQLRestore(self.connect, self.db_name, backup_dir, jobs=self.jobs).run()
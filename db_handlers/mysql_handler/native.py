@@ -0,0 +1,583 @@
+import json
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import pymysql
+from pymysql.converters import conversions
+from logger import setup_logger
+from metrics import phase, count
+from checkpoint import partial_path, finalize, atomic_write_text
+from compression import Compression, detect_compression
+from integrity import HashingWriter, record_checksums
+from pipeline import run_pipeline, check_pipeline
+
+logger = setup_logger("logs")
+
+MANIFEST_FILE = "manifest.json"
+DATA_DIR = "data"
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Rows fetched from the unbuffered cursor and encoded per block
+FETCH_ROWS = 10000
+# Tables are split into ranges once they hold this many bytes per range
+MIN_RANGE_BYTES = 256 * 1024 * 1024
+# Primary keys of these types are split into value ranges; other tables are exported whole
+SPLITTABLE_PK_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+# Columns written as hex and loaded through UNHEX(), so arbitrary bytes never meet the
+# multi-byte parser of LOAD DATA
+BINARY_TYPES = (
+    "binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob", "bit", "geometry", "point", "linestring",
+    "polygon", "multipoint", "multilinestring", "multipolygon", "geometrycollection", "geomcollection",
+)
+# Privilege errors of FLUSH TABLES WITH READ LOCK (no RELOAD privilege, managed servers)
+ACCESS_DENIED_ERRORS = (1044, 1045, 1227)
+
+# Encoders only: rows come back as the server's text representation, undecoded, which is
+# exactly what LOAD DATA reads back
+RAW_CONVERSIONS = {key: value for key, value in conversions.items() if not isinstance(key, int)}
+NULL = b"\\N"
+
+# TIMESTAMP values are read and written in UTC; zero auto-increment keys are kept, like mysqldump
+DUMP_SESSION = "SET SESSION time_zone = '+00:00'"
+LOAD_SESSION = "SET SESSION time_zone = '+00:00', sql_mode = 'NO_AUTO_VALUE_ON_ZERO', foreign_key_checks = 0, unique_checks = 0"
+
+TABLES_QUERY = """
+    SELECT TABLE_NAME, TABLE_TYPE, ENGINE, COALESCE(DATA_LENGTH, 0)
+    FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE()
+    ORDER BY TABLE_NAME
+"""
+
+COLUMNS_QUERY = """
+    SELECT COLUMN_NAME, DATA_TYPE, EXTRA
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    ORDER BY ORDINAL_POSITION
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT COLUMN_NAME
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY'
+    ORDER BY SEQ_IN_INDEX
+"""
+
+TRIGGERS_QUERY = """
+    SELECT TRIGGER_NAME
+    FROM information_schema.TRIGGERS
+    WHERE TRIGGER_SCHEMA = DATABASE()
+    ORDER BY EVENT_OBJECT_TABLE, ACTION_ORDER
+"""
+
+ROUTINES_QUERY = "SELECT COUNT(*) FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = DATABASE()"
+
+KEY_CLAUSE = re.compile(r"^(UNIQUE |FULLTEXT |SPATIAL )?(KEY|INDEX) ")
+FOREIGN_KEY_CLAUSE = re.compile(r"^CONSTRAINT .+ FOREIGN KEY ")
+FIRST_KEY_COLUMN = re.compile(r"\(`((?:[^`]|``)+)`")
+DEFINER_CLAUSE = re.compile(r" DEFINER=`(?:[^`]|``)*`@`(?:[^`]|``)*`")
+
+
+def quote(name: str):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def split_create_table(statement: str, auto_increment: str = None):
+    """
+    Split SHOW CREATE TABLE output into the statement without secondary indexes and foreign
+    keys, the index clauses and the foreign key clauses. A key on the auto-increment column
+    stays in the statement, since MySQL does not allow that column without one.
+    """
+    lines = statement.split("\n")
+    end = next(i for i in range(1, len(lines)) if lines[i].startswith(")"))
+    keep, indexes, foreign_keys = [], [], []
+    for line in lines[1:end]:
+        clause = line.strip().rstrip(",")
+        if FOREIGN_KEY_CLAUSE.match(clause):
+            foreign_keys.append(clause)
+            continue
+        first_column = FIRST_KEY_COLUMN.search(clause)
+        if KEY_CLAUSE.match(clause) and not (first_column and first_column.group(1).replace("``", "`") == auto_increment):
+            indexes.append(clause)
+        else:
+            keep.append(clause)
+    create = "\n".join([lines[0], ",\n".join(f"  {clause}" for clause in keep), *lines[end:]])
+    return create, indexes, foreign_keys
+
+
+def without_definer(statement: str):
+    """
+    Drop the DEFINER of a view or trigger, so it is owned by the restoring user, who may be
+    the only account that exists on the target server.
+    """
+    return DEFINER_CLAUSE.sub("", statement, count=1)
+
+
+def in_completion_order(executor: ThreadPoolExecutor, function, items):
+    """
+    Run `function` over `items` on `executor` and yield the results as they finish. On the
+    first failure the items that have not started yet are cancelled instead of run for nothing.
+    """
+    futures = [executor.submit(function, item) for item in items]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def encode_rows(rows, binary: list):
+    """
+    Rows as LOAD DATA text: tab-separated, backslash-escaped, \\N for NULL, binary columns in hex.
+    """
+    lines = []
+    for row in rows:
+        lines.append(b"\t".join(
+            NULL if value is None
+            else value.hex().encode() if hexed
+            else value.replace(b"\\", b"\\\\").replace(b"\t", b"\\t").replace(b"\n", b"\\n")
+            for value, hexed in zip(row, binary)
+        ))
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+class ChunkUnit:
+    """
+    One SELECT stream's worth of work: a whole table or one primary-key range of it.
+    """
+
+    def __init__(self, table: dict, part: int, condition: str = None, estimated_bytes: int = 0, extension: str = ""):
+        self.table = table
+        self.part = part
+        self.condition = condition
+        self.estimated_bytes = estimated_bytes
+        self.file = f"{table['index']}.{part}.tsv{extension}"
+        self.rows = 0
+        self.bytes = 0
+        self.checksum = None
+
+
+class NativeMySQLBackup:
+    """
+    Parallel table export over connections that share one consistent snapshot.
+
+    The coordinating connection takes FLUSH TABLES WITH READ LOCK, every worker connection
+    opens START TRANSACTION WITH CONSISTENT SNAPSHOT while no write can commit, the schema
+    and binary log position are read, and the lock is released; it is held for well under a
+    second on an idle lock queue. Each worker then reads InnoDB tables as of that instant.
+    Large tables with an integer primary key are split into key ranges, so several workers
+    export one table at once. Each range is written as LOAD DATA text to its own file under
+    `data/`, compressed per file, and `manifest.json` records the schema with secondary
+    indexes and foreign keys split off for the restore to build after the data is loaded.
+
+    Without the RELOAD privilege the lock cannot be taken; the export then runs on a single
+    snapshot connection, which is consistent on its own.
+    """
+
+    def __init__(self, connect, db_name: str, backup_dir: Path, jobs: int = 4, compression: Compression = None):
+        self.connect = connect
+        self.db_name = db_name
+        self.backup_dir = Path(backup_dir)
+        self.work_dir = partial_path(self.backup_dir)
+        self.data_dir = self.work_dir / DATA_DIR
+        self.jobs = max(jobs or 1, 1)
+        # Workers already run in parallel, so each file gets a single-threaded compressor
+        self.compression = Compression(compression.algorithm, compression.level, threads=1) if compression else None
+        self.workers = queue.Queue()
+
+    def _open_snapshots(self, cursor):
+        """
+        Open the worker snapshots under a global read lock. Returns (connections, consistent).
+        """
+        try:
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            locked = True
+        except pymysql.err.OperationalError as e:
+            if e.args[0] not in ACCESS_DENIED_ERRORS:
+                raise
+            locked = False
+            if self.jobs > 1:
+                logger.warning(f"FLUSH TABLES WITH READ LOCK was denied ({e.args[1]}). Snapshots of parallel workers could not be aligned, so the export runs on one connection.")
+        connections = []
+        for _ in range(self.jobs if locked else 1):
+            conn = self.connect(raw=True)
+            connections.append(conn)
+            with conn.cursor() as worker:
+                worker.execute(DUMP_SESSION)
+                worker.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                worker.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+        return connections, locked
+
+    @staticmethod
+    def _binlog_position(cursor):
+        # SHOW MASTER STATUS was renamed in MySQL 8.2; without binary logging both return no row
+        for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+            try:
+                cursor.execute(statement)
+            except pymysql.err.MySQLError:
+                continue
+            row = cursor.fetchone()
+            return {"file": row[0], "position": row[1]} if row else None
+        return None
+
+    def _schema(self, cursor):
+        cursor.execute(TABLES_QUERY)
+        tables, views = [], []
+        for name, table_type, engine, size in cursor.fetchall():
+            if table_type == "VIEW":
+                cursor.execute(f"SHOW CREATE VIEW {quote(name)}")
+                views.append({"name": name, "create": without_definer(cursor.fetchone()[1])})
+                continue
+            if table_type != "BASE TABLE":
+                logger.warning(f"Skipping {name}: {table_type.lower()} objects are not exported.")
+                continue
+            if engine != "InnoDB":
+                logger.warning(f"Table {name} uses {engine}, which has no snapshots; its rows are read after the lock is released and may not match the other tables.")
+
+            cursor.execute(COLUMNS_QUERY, (name,))
+            columns, auto_increment = [], None
+            for column, data_type, extra in cursor.fetchall():
+                extra = (extra or "").upper()
+                if "AUTO_INCREMENT" in extra:
+                    auto_increment = column
+                if "VIRTUAL GENERATED" in extra or "STORED GENERATED" in extra:
+                    continue
+                columns.append({"name": column, "type": data_type, "binary": data_type.lower() in BINARY_TYPES})
+            cursor.execute(f"SHOW CREATE TABLE {quote(name)}")
+            create, indexes, foreign_keys = split_create_table(cursor.fetchone()[1], auto_increment)
+            tables.append({
+                "index": len(tables), "name": name, "engine": engine, "size": size, "columns": columns,
+                "create": create, "indexes": indexes, "foreign_keys": foreign_keys,
+            })
+
+        cursor.execute(TRIGGERS_QUERY)
+        triggers = []
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"SHOW CREATE TRIGGER {quote(name)}")
+            triggers.append({"name": name, "create": without_definer(cursor.fetchone()[2])})
+        cursor.execute(ROUTINES_QUERY)
+        if cursor.fetchone()[0]:
+            logger.warning("Stored procedures and functions are not exported by the native engine.")
+        return tables, views, triggers
+
+    def _plan(self, cursor, table: dict):
+        extension = self.compression.extension if self.compression else ""
+        parts = min(self.jobs * 2, table["size"] // MIN_RANGE_BYTES)
+        if self.workers.qsize() == 1 or parts < 2:
+            return [ChunkUnit(table, 0, estimated_bytes=table["size"], extension=extension)]
+
+        cursor.execute(PRIMARY_KEY_QUERY, (table["name"],))
+        primary_key = [row[0] for row in cursor.fetchall()]
+        types = {column["name"]: column["type"].lower() for column in table["columns"]}
+        if len(primary_key) != 1 or types.get(primary_key[0]) not in SPLITTABLE_PK_TYPES:
+            return [ChunkUnit(table, 0, estimated_bytes=table["size"], extension=extension)]
+
+        key = quote(primary_key[0])
+        # The bounds only place the boundaries; the first and last ranges are open, so rows
+        # outside them still land in a range
+        cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM {quote(table['name'])}")
+        low, high = cursor.fetchone()
+        if low is None or high - low < parts:
+            return [ChunkUnit(table, 0, estimated_bytes=table["size"], extension=extension)]
+        step = (high - low + 1) // parts
+        boundaries = [low + i * step for i in range(1, parts)]
+        conditions = [f"{key} < {boundaries[0]}"]
+        conditions += [f"{key} >= {a} AND {key} < {b}" for a, b in zip(boundaries, boundaries[1:])]
+        conditions.append(f"{key} >= {boundaries[-1]}")
+        logger.info(f"Splitting {table['name']} ({table['size']} bytes) into {parts} ranges of '{primary_key[0]}'.")
+        per_range = table["size"] // parts
+        return [ChunkUnit(table, part, condition, per_range, extension) for part, condition in enumerate(conditions)]
+
+    def _blocks(self, cursor, unit: ChunkUnit):
+        binary = [column["binary"] for column in unit.table["columns"]]
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            unit.rows += len(rows)
+            yield encode_rows(rows, binary)
+
+    def _export_unit(self, unit: ChunkUnit):
+        conn = self.workers.get()
+        try:
+            columns = ", ".join(quote(column["name"]) for column in unit.table["columns"])
+            statement = f"SELECT {columns} FROM {quote(unit.table['name'])}"
+            if unit.condition:
+                statement += f" WHERE {unit.condition}"
+            path = self.data_dir / unit.file
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            with conn.cursor(pymysql.cursors.SSCursor) as cursor, open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                cursor.execute(statement)
+                writer = HashingWriter(f)
+                if self.compression:
+                    processes = run_pipeline([self.compression.compress_command()], source=self._blocks(cursor, unit), sink=writer, logger=logger)
+                    check_pipeline(processes, "Table export")
+                else:
+                    for block in self._blocks(cursor, unit):
+                        writer.write(block)
+            tmp_path.replace(path)
+        finally:
+            self.workers.put(conn)
+        unit.bytes, unit.checksum = writer.size, writer.checksum
+        return unit
+
+    def run(self):
+        start_time = time.time()
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        coordinator = self.connect()
+        connections = []
+        try:
+            with coordinator.cursor() as cursor:
+                with phase("snapshot"):
+                    try:
+                        connections, consistent = self._open_snapshots(cursor)
+                        binlog = self._binlog_position(cursor)
+                        tables, views, triggers = self._schema(cursor)
+                    finally:
+                        cursor.execute("UNLOCK TABLES")
+                logger.info(f"Opened {len(connections)} snapshot connection(s){' under a global read lock' if consistent else ''}.")
+                for conn in connections:
+                    self.workers.put(conn)
+                units = [unit for table in tables for unit in self._plan(cursor, table)]
+
+            # Biggest units first so the pool does not end on one long straggler
+            units.sort(key=lambda u: u.estimated_bytes, reverse=True)
+            logger.info(f"Exporting {len(tables)} table(s) as {len(units)} stream(s) with {len(connections)} worker(s).")
+            with phase("copy"), ThreadPoolExecutor(max_workers=len(connections), thread_name_prefix="mysqldump") as executor:
+                for unit in in_completion_order(executor, self._export_unit, units):
+                    logger.info(f"Exported {unit.rows} rows ({unit.bytes} bytes) from {unit.table['name']} part {unit.part}.")
+        except BaseException:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            raise
+        finally:
+            for conn in connections:
+                conn.close()
+            coordinator.close()
+
+        for table in tables:
+            table_units = sorted((u for u in units if u.table is table), key=lambda u: u.part)
+            table["files"] = [u.file for u in table_units]
+            table["rows"] = sum(u.rows for u in table_units)
+            table["bytes"] = sum(u.bytes for u in table_units)
+        manifest = {
+            "engine": "native",
+            "db_type": "mysql",
+            "db_name": self.db_name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "consistent": consistent,
+            "binlog": binlog,
+            "compression": str(self.compression) if self.compression else None,
+            "tables": tables,
+            "views": views,
+            "triggers": triggers,
+        }
+        atomic_write_text(self.work_dir / MANIFEST_FILE, json.dumps(manifest, indent=2))
+        finalize(self.backup_dir)
+        # Data files were checksummed while they were written; only the manifest is read here
+        record_checksums(self.backup_dir, known={
+            f"{DATA_DIR}/{unit.file}": {"size": unit.bytes, "checksum": unit.checksum} for unit in units
+        })
+
+        total_rows = sum(table["rows"] for table in tables)
+        total_bytes = sum(table["bytes"] for table in tables)
+        count("rows", total_rows)
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Native export wrote {total_rows} rows, {total_bytes} bytes in {elapsed:.1f}s ({total_bytes / elapsed / (1024 * 1024):.1f} MB/s).")
+        return self.backup_dir
+
+
+class NativeMySQLRestore:
+    """
+    Restore a native MySQL export with parallel LOAD DATA LOCAL INFILE.
+
+    The restore runs in three phases:
+      1. pre-data: the backed-up tables and views are dropped and the tables created with
+         their primary keys only.
+      2. data: every range file is loaded on its own connection, with foreign key and unique
+         checks off. Compressed files are decompressed into a named pipe that LOAD DATA
+         reads from, so nothing is unpacked to disk.
+      3. post-data: secondary indexes are added with one ALTER TABLE per table, in parallel,
+         so each index is built by one sort instead of row by row; then foreign keys, views
+         and triggers are created. Triggers come last so they do not fire on loaded rows.
+    """
+
+    def __init__(self, connect, db_name: str, backup_dir: Path, jobs: int = 4):
+        self.connect = connect
+        self.db_name = db_name
+        self.backup_dir = Path(backup_dir)
+        self.jobs = max(jobs or 1, 1)
+        manifest_path = self.backup_dir / MANIFEST_FILE
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"'{self.backup_dir}' is not a native MySQL backup: {MANIFEST_FILE} not found.")
+        self.manifest = json.loads(manifest_path.read_text())
+        if self.manifest.get("db_type") != "mysql":
+            raise ValueError(f"'{self.backup_dir}' is not a MySQL backup.")
+        self.tables = self.manifest["tables"]
+
+    @contextmanager
+    def _session(self, local_infile: bool = False):
+        conn = self.connect(local_infile=local_infile)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(LOAD_SESSION)
+                yield cursor
+        finally:
+            conn.close()
+
+    def _check_local_infile(self, cursor):
+        cursor.execute("SELECT @@GLOBAL.local_infile")
+        if not int(cursor.fetchone()[0]):
+            raise Exception("The server does not accept LOAD DATA LOCAL INFILE. Enable it with SET GLOBAL local_infile = 1 (or local_infile=1 in my.cnf) and run the restore again.")
+
+    def _create_tables(self):
+        with self._session() as cursor:
+            self._check_local_infile(cursor)
+            for view in self.manifest["views"]:
+                cursor.execute(f"DROP VIEW IF EXISTS {quote(view['name'])}")
+            for table in self.tables:
+                cursor.execute(f"DROP TABLE IF EXISTS {quote(table['name'])}")
+            for table in self.tables:
+                cursor.execute(table["create"])
+
+    @contextmanager
+    def _local_file(self, path: Path, tmp: str):
+        """
+        A path LOAD DATA LOCAL can read `path` from: the file itself, or for compressed files
+        a named pipe fed by the decompressor (a decompressed scratch file without named pipes).
+        """
+        compression = detect_compression(path)
+        if not compression:
+            yield path
+            return
+        local = Path(tmp) / f"{path.name}.pipe"
+        if not hasattr(os, "mkfifo"):
+            check_pipeline(run_pipeline([compression.decompress_command()], input_path=str(path), output_path=str(local), logger=logger), "Decompression")
+            try:
+                yield local
+            finally:
+                local.unlink(missing_ok=True)
+            return
+
+        os.mkfifo(local)
+        result = {}
+
+        def feed():
+            try:
+                result["processes"] = run_pipeline([compression.decompress_command()], input_path=str(path), output_path=str(local), logger=logger)
+            except Exception as e:
+                result["error"] = e
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            yield local
+        finally:
+            if feeder.is_alive():
+                # LOAD DATA may have failed before opening the pipe. Hold the read end open until
+                # the decompressor has opened its end, then close it so it exits on a broken pipe.
+                fd = os.open(local, os.O_RDONLY | os.O_NONBLOCK)
+                try:
+                    while feeder.is_alive():
+                        try:
+                            if os.read(fd, 1):
+                                break
+                        except BlockingIOError:
+                            break
+                        feeder.join(0.05)
+                finally:
+                    os.close(fd)
+            feeder.join()
+            local.unlink(missing_ok=True)
+        if "error" in result:
+            raise result["error"]
+        check_pipeline(result["processes"], "Decompression")
+
+    def _load_file(self, table: dict, file: str, tmp: str):
+        targets, assignments = [], []
+        for index, column in enumerate(table["columns"]):
+            if column["binary"]:
+                targets.append(f"@v{index}")
+                assignments.append(f"{quote(column['name'])} = UNHEX(@v{index})")
+            else:
+                targets.append(quote(column["name"]))
+        with self._local_file(self.backup_dir / DATA_DIR / file, tmp) as local, self._session(local_infile=True) as cursor:
+            statement = (
+                f"LOAD DATA LOCAL INFILE {cursor.connection.escape(str(local))} INTO TABLE {quote(table['name'])} CHARACTER SET utf8mb4"
+                f" FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({', '.join(targets)})"
+            )
+            if assignments:
+                statement += f" SET {', '.join(assignments)}"
+            cursor.execute(statement)
+            return table, cursor.rowcount
+
+    def _add_indexes(self, table: dict):
+        # InnoDB builds one FULLTEXT index per statement; the rest are built together
+        fulltext = [clause for clause in table["indexes"] if clause.startswith("FULLTEXT ")]
+        others = [clause for clause in table["indexes"] if not clause.startswith("FULLTEXT ")]
+        statements = [[clause] for clause in fulltext]
+        if others:
+            statements.insert(0, others)
+        with self._session() as cursor:
+            for clauses in statements:
+                cursor.execute(f"ALTER TABLE {quote(table['name'])} {', '.join(f'ADD {clause}' for clause in clauses)}")
+        return table
+
+    def _create_dependents(self):
+        with self._session() as cursor:
+            for table in self.tables:
+                if table["foreign_keys"]:
+                    cursor.execute(f"ALTER TABLE {quote(table['name'])} {', '.join(f'ADD {clause}' for clause in table['foreign_keys'])}")
+            # Views can select from other views; retry the failures until nothing more can be created
+            pending = list(self.manifest["views"])
+            while pending:
+                failed = []
+                for view in pending:
+                    try:
+                        cursor.execute(view["create"])
+                    except pymysql.err.MySQLError as e:
+                        failed.append((view, e))
+                if len(failed) == len(pending):
+                    view, error = failed[0]
+                    raise Exception(f"Could not create view {view['name']}: {error}")
+                pending = [view for view, _ in failed]
+            for trigger in self.manifest["triggers"]:
+                cursor.execute(trigger["create"])
+
+    def run(self):
+        start_time = time.time()
+        logger.info(f"Restoring native MySQL backup of '{self.manifest['db_name']}' taken {self.manifest['created']}.")
+        with phase("pre_data"):
+            self._create_tables()
+
+        files = [(table, file) for table in self.tables for file in table["files"]]
+        phase_time = time.time()
+        logger.info(f"Loading {len(self.tables)} table(s) from {len(files)} file(s) with {self.jobs} worker(s).")
+        total_rows = 0
+        with tempfile.TemporaryDirectory(prefix="mysqlrestore-") as tmp:
+            with phase("data"), ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="mysqlload") as executor:
+                for table, rows in in_completion_order(executor, lambda f: self._load_file(f[0], f[1], tmp), files):
+                    total_rows += rows
+                    logger.info(f"Loaded {rows} rows into {table['name']}.")
+        count("rows", total_rows)
+        total_bytes = sum(table["bytes"] for table in self.tables)
+        elapsed = max(time.time() - phase_time, 1e-6)
+        logger.info(f"Loaded {total_rows} rows, {total_bytes} bytes in {elapsed:.1f}s ({total_bytes / elapsed / (1024 * 1024):.1f} MB/s).")
+
+        phase_time = time.time()
+        logger.info(f"Building secondary indexes with {self.jobs} worker(s).")
+        with phase("post_data"):
+            # Biggest tables first so the pool does not end on one long index build
+            tables = sorted((t for t in self.tables if t["indexes"]), key=lambda t: t["bytes"], reverse=True)
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="mysqlindex") as executor:
+                for table in in_completion_order(executor, self._add_indexes, tables):
+                    logger.info(f"Built {len(table['indexes'])} index(es) on {table['name']}.")
+            self._create_dependents()
+        logger.info(f"Post-data phase finished in {time.time() - phase_time:.1f}s; native restore took {time.time() - start_time:.1f}s.")
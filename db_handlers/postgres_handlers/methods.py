@@ -4,11 +4,15 @@ from urllib.parse import urlparse
 from .postgres import *
 from validation import Validation
 from pathlib import Path
+from catalog import Catalog, endpoint_of, artifact_size
+from metrics import track_run, phase
+from .selection import TableSelection
+from .physical import PhysicalRestore, WAL_ARCHIVE_DIR
 
 logger = setup_logger("logs")
 
 
-def fetch_database_params_and_validate(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, output: str = None, backup_file: str = None):
+def fetch_database_params_and_validate(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, output: str = None, backup_file: str = None, jobs: int = 1, compress: str = None, repo: str = None, engine: str = "tool", storage: str = None, resume: bool = False, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False):
     if database_url:
         parsed = urlparse(database_url)
         db_type = parsed.scheme.split('+')[0]
@@ -17,6 +21,9 @@ def fetch_database_params_and_validate(db_type: str, database_url: str, host: st
         host = parsed.hostname
         port = parsed.port or 5432
         db_name = parsed.path.lstrip('/')
+    else:
+        port = port or 5432
+        user = user or "postgres"
 
     logger.info(f"Testing connection on {db_type} database named '{db_name}' at {host}:{port}.")
     if database_url:
@@ -24,36 +31,72 @@ def fetch_database_params_and_validate(db_type: str, database_url: str, host: st
     else:
         logger.info(f"Database information: db_type={db_type}, host={host}, db={db_name}, port={port}, user={user}")
     logger.info(f"Selected format: .{format}")
+    if jobs > 1:
+        logger.info(f"Parallel jobs: {jobs}")
+    if compress:
+        logger.info(f"Compression: {compress}")
+    if repo:
+        logger.info(f"Repository: {repo}")
+    if engine != "tool":
+        logger.info(f"Engine: {engine}")
+    if storage:
+        logger.info(f"Storage: {storage}")
+    if encrypt:
+        logger.info("Encryption: AES-256-GCM")
+    if max_rate or (io_priority and io_priority != "normal"):
+        logger.info(f"Throttling: {f'{max_rate} MB/s' if max_rate else 'no rate limit'}{', adaptive' if adaptive else ''}, I/O priority {io_priority or 'normal'}")
 
     if not all([db_type, host, port, user, password, db_name]):
         raise ValueError("Missing required database parameters. Use either --database-url or provide individual options.")
 
     # validate user params
-    validator = Validation(host=host, port=port, user=user, password=password, db_name=db_name, format=format, backup_file=backup_file, output_dir=output)
+    validator = Validation(host=host, port=port, user=user, password=password, db_name=db_name, format=format, backup_file=backup_file, output_dir=None if storage else output, jobs=jobs, compress=compress, repo=repo, engine=engine, storage=storage, resume=resume, max_rate=max_rate, io_priority=io_priority, adaptive=adaptive, encrypt=encrypt)
     validator.validate_user_params()
 
     return host, port, user, password, db_name, format, output, backup_file
 
 
-def backup_postgres_database(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, output: str = None):
+def backup_postgres_database(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, output: str = None, jobs: int = 1, compress: str = None, repo: str = None, engine: str = "tool", storage: str = None, metrics: str = None, resume: bool = False, include_tables: list = None, exclude_tables: list = None, schemas: list = None, exclude_table_data: list = None, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False, passphrase_file: str = None):
     try:
         host, port, user, password, db_name, format, output, _ = fetch_database_params_and_validate(
-            db_name=db_name, db_type=db_type, database_url=database_url, host=host, port=port, password=password, format=format, user=user, output=output
+            db_name=db_name, db_type=db_type, database_url=database_url, host=host, port=port, password=password, format=format, user=user, output=output, jobs=jobs, compress=compress, repo=repo, engine=engine, storage=storage, resume=resume,
+            max_rate=max_rate, io_priority=io_priority, adaptive=adaptive, encrypt=encrypt
         )
-        pg =  PostgresHandler(host=host, port=port, user=user, password=password, db_name=db_name, output_dir=output, format=format)
-        if pg.test_connection():
-            logger.info(f"Connected to {db_type} database successfully.")
-            logger.info(f"Started taking backup......")
-            start_time = time.time()
-            backup_file_path = pg.backup()
-            end_time = time.time()
-            output_dirname = Path(output).name
-            filename = Path(backup_file_path).name
-            relative_path_str = f"{output_dirname}\\{filename}"
-            logger.info(f"Backup file saved at: {relative_path_str}. Total time taken: {round((end_time-start_time)/60, 6)} minutes.")
-        else:
-            logger.error(f"Failed to connect to the database {db_name}.")
-            raise Exception(f"Failed to connect to the database {db_name}.")
+        selection = TableSelection(include_tables, exclude_tables, schemas, exclude_table_data)
+        with track_run("backup", "postgres", db_name, sink=metrics) as run:
+            pg =  PostgresHandler(host=host, port=port, user=user, password=password, db_name=db_name, output_dir=output, format=format, jobs=jobs, compress=compress, repo=repo, engine=engine, storage=storage, resume=resume, selection=selection, max_rate=max_rate, io_priority=io_priority, adaptive=adaptive, encrypt=encrypt, passphrase_file=passphrase_file)
+            with phase("connect"):
+                connected = pg.test_connection()
+            if connected:
+                logger.info(f"Connected to {db_type} database successfully.")
+                logger.info("Started taking backup......")
+                start_time = time.time()
+                backup_file_path = pg.backup()
+                end_time = time.time()
+                size = pg.upload.size if pg.upload else artifact_size(backup_file_path)
+                run.count("bytes", size)
+                if storage:
+                    relative_path_str = str(backup_file_path)
+                else:
+                    output_dirname = Path(repo).name if repo else Path(output).name
+                    filename = Path(backup_file_path).relative_to(repo) if repo else Path(backup_file_path).name
+                    relative_path_str = f"{output_dirname}\\{filename}"
+                logger.info(f"Backup file saved at: {relative_path_str}. Total time taken: {round((end_time-start_time)/60, 6)} minutes ({size / max(end_time - start_time, 1e-6) / (1024 * 1024):.2f} MB/s).")
+                try:
+                    with phase("catalog"):
+                        # Partial backups are listed and retained apart from full ones, like single-collection MongoDB backups
+                        Catalog().record(
+                            "postgres", db_name, backup_file_path, endpoint=endpoint_of(host=host, port=port), collection_name=selection.describe() or None,
+                            format="directory" if engine == "physical" else format,
+                            engine=engine, compression=compress, repo=repo, duration=end_time - start_time,
+                            size=size, checksum=pg.upload.checksum if pg.upload else None,
+                        )
+                except Exception as e:
+                    logger.warning(f"Could not record the backup in the catalog: {e}")
+                return backup_file_path
+            else:
+                logger.error(f"Failed to connect to the database {db_name}.")
+                raise Exception(f"Failed to connect to the database {db_name}.")
 
     except Exception as e:
         raise e
@@ -65,25 +108,31 @@ def backup_postgres_database(db_type: str, database_url: str, host: str, port: i
         raise fe
 
 
-def restore_postgres_database(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, backup_file: str):
+def restore_postgres_database(db_type: str, database_url: str, host: str, port: int, password: str, db_name: str, format: str, user: str, backup_file: str, jobs: int = 1, repo: str = None, snapshot: str = None, engine: str = "tool", session_settings: list = None, metrics: str = None, include_tables: list = None, exclude_tables: list = None, schemas: list = None, exclude_table_data: list = None, passphrase_file: str = None):
     try:
         host, port, user, password, db_name, format, _, backup_file = fetch_database_params_and_validate(
-            db_name=db_name, db_type=db_type, database_url=database_url, host=host, port=port, password=password, format=format, user=user, backup_file=backup_file
+            db_name=db_name, db_type=db_type, database_url=database_url, host=host, port=port, password=password, format=format, user=user, backup_file=backup_file, jobs=jobs, repo=repo, engine=engine
         )
+        selection = TableSelection(include_tables, exclude_tables, schemas, exclude_table_data)
 
-        # Instantiate handler
-        pg = PostgresHandler(host=host, port=port, user=user, password=password, db_name=db_name, output_dir=None, format=format)
+        with track_run("restore", "postgres", db_name, sink=metrics) as run:
+            # Instantiate handler
+            pg = PostgresHandler(host=host, port=port, user=user, password=password, db_name=db_name, output_dir=None, format=format, jobs=jobs, repo=repo, engine=engine, session_settings=session_settings, selection=selection, passphrase_file=passphrase_file)
 
-        # Check connection and restore
-        if pg.test_connection():
-            logger.info("Connected to the database. Starting restore...")
-            start_time = time.time()
-            pg.restore(backup_file)
-            end_time = time.time()
-            logger.info(f"Restore completed successfully in {round((end_time - start_time)/60, 6)} minutes.")
-        else:
-            logger.error("Failed to connect to the database.")
-            raise Exception(f"Failed to connect to the database {db_name}.")
+            # Check connection and restore
+            with phase("connect"):
+                connected = pg.test_connection()
+            if connected:
+                logger.info("Connected to the database. Starting restore...")
+                start_time = time.time()
+                pg.restore(backup_file, snapshot=snapshot)
+                end_time = time.time()
+                if backup_file:
+                    run.count("bytes", artifact_size(backup_file))
+                logger.info(f"Restore completed successfully in {round((end_time - start_time)/60, 6)} minutes.")
+            else:
+                logger.error("Failed to connect to the database.")
+                raise Exception(f"Failed to connect to the database {db_name}.")
 
     except Exception as e:
         raise e
@@ -92,4 +141,45 @@ def restore_postgres_database(db_type: str, database_url: str, host: str, port:
     except (ValueError, KeyError) as kv:
         raise kv
     except (FileExistsError, FileNotFoundError) as fe:
-        raise fe
\ No newline at end of file
+        raise fe
+
+
+def archive_postgres_wal(database_url: str, host: str, port: int, password: str, db_name: str, user: str, output: str = None, archive_dir: str = None, compress: str = None, slot: str = None, io_priority: str = None):
+    """
+    Stream the server's WAL into `archive_dir` (default: <output>/wal_archive) until interrupted.
+    """
+    host, port, user, password, db_name, _, output, _ = fetch_database_params_and_validate(
+        db_name=db_name, db_type="postgres", database_url=database_url, host=host, port=port, password=password, format="dump", user=user, output=output, compress=compress, io_priority=io_priority
+    )
+    archive_dir = Path(archive_dir) if archive_dir else Path(output) / WAL_ARCHIVE_DIR
+    pg = PostgresHandler(host=host, port=port, user=user, password=password, db_name=db_name, output_dir=None, format="dump", compress=compress, io_priority=io_priority)
+    pg.test_connection()
+    archiver = pg.wal_archiver(archive_dir, slot=slot)
+    try:
+        archiver.run()
+    except KeyboardInterrupt:
+        logger.info("Stopping the WAL archiver...")
+        archiver.stop()
+        if archiver.process:
+            archiver.process.wait()
+        archiver.archive_finished()
+
+
+def restore_postgres_physical(db_name: str, backup_dir: str, target_dir: str, wal_archive: str = None, target_time=None, metrics: str = None):
+    """
+    Prepare a new data directory from a base backup that recovers to `target_time`.
+    """
+    if not backup_dir:
+        raise ValueError("Give the base backup to restore with --dir-path, --latest or --at.")
+    if not target_dir:
+        raise ValueError("A physical restore builds a new data directory. Give its location with --target-dir.")
+    if not Path(backup_dir).is_dir():
+        raise FileNotFoundError(f"Base backup '{backup_dir}' does not exist.")
+    # archive-wal keeps the archive next to the base backups by default
+    archive_dir = Path(wal_archive) if wal_archive else Path(backup_dir).resolve().parent / WAL_ARCHIVE_DIR
+
+    with track_run("restore", "postgres", db_name, sink=metrics):
+        logger.info(f"Preparing '{target_dir}' from base backup '{Path(backup_dir).name}' with WAL from '{archive_dir}'.")
+        start_time = time.time()
+        PhysicalRestore(backup_dir, target_dir, archive_dir, target_time=target_time).run()
+        logger.info(f"Data directory prepared in {round((time.time() - start_time)/60, 6)} minutes.")
@@ -0,0 +1,506 @@
+import json
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from psycopg2 import sql
+from logger import setup_logger
+from process_runner import run_process
+from metrics import phase, count
+from checkpoint import Checkpoint, partial_path, finalize, atomic_write_text
+from integrity import HashingWriter, record_checksums
+from throttle import ThrottledWriter
+from .selection import TableSelection, read_toc, select_entries, write_list_file, toc_cache_path
+
+logger = setup_logger("logs")
+
+MANIFEST_FILE = "manifest.json"
+# Custom-format pg_dump archive holding the schema only (pre-data and post-data sections)
+SCHEMA_FILE = "schema.dump"
+DATA_DIR = "data"
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Tables are split into ranges once they hold this many bytes per range
+MIN_RANGE_BYTES = 256 * 1024 * 1024
+# Primary keys of these types are split into value ranges; other tables are split by ctid
+SPLITTABLE_PK_TYPES = ("smallint", "integer", "bigint")
+# ctid ranges are read with a TID Range Scan from PostgreSQL 14 on. Older servers scan the whole
+# table for every range, so tables without an integer key are exported in one stream there.
+TID_RANGE_SCAN_VERSION = 140000
+
+TABLES_QUERY = """
+    SELECT c.oid, n.nspname, c.relname, pg_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%'
+      AND n.nspname NOT LIKE 'pg_temp%'
+      AND NOT EXISTS (SELECT 1 FROM pg_depend d WHERE d.objid = c.oid AND d.deptype = 'e')
+    ORDER BY n.nspname, c.relname
+"""
+
+COLUMNS_QUERY = """
+    SELECT attname
+    FROM pg_attribute
+    WHERE attrelid = %s AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+    ORDER BY attnum
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT a.attname, format_type(a.atttypid, NULL)
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = %s AND i.indisprimary AND i.indnatts = 1
+"""
+
+SEQUENCES_QUERY = """
+    SELECT s.schemaname, s.sequencename, s.last_value, tn.nspname, tc.relname
+    FROM pg_sequences s
+    LEFT JOIN pg_depend d
+      ON d.classid = 'pg_class'::regclass
+     AND d.objid = format('%I.%I', s.schemaname, s.sequencename)::regclass
+     AND d.refclassid = 'pg_class'::regclass
+     AND d.deptype IN ('a', 'i')
+    LEFT JOIN pg_class tc ON tc.oid = d.refobjid
+    LEFT JOIN pg_namespace tn ON tn.oid = tc.relnamespace
+    WHERE s.last_value IS NOT NULL
+"""
+
+
+class CopyUnit:
+    """
+    One COPY stream's worth of work: a whole table or one key/ctid range of it.
+    """
+
+    def __init__(self, table: dict, part: int, condition=None, estimated_bytes: int = 0):
+        self.table = table
+        self.part = part
+        self.condition = condition
+        self.estimated_bytes = estimated_bytes
+        self.file = f"{table['oid']}.{part}.bin"
+        self.rows = 0
+        self.bytes = 0
+
+
+class NativePostgresBackup:
+    """
+    Parallel table export with COPY ... TO STDOUT (FORMAT binary).
+
+    A coordinating transaction exports its snapshot with pg_export_snapshot(), and every
+    worker connection adopts it with SET TRANSACTION SNAPSHOT, so all tables (and the schema,
+    dumped by pg_dump --snapshot) are read as of the same instant. Large tables are split into
+    primary-key ranges, or ctid ranges when there is no integer key, so a single huge table
+    is exported by several workers at once. Each range is written to its own file under
+    `data/`, and `manifest.json` records tables, columns, files and sequence values.
+
+    The backup is built in `<backup_dir>.partial` with a checkpoint of finished ranges. When it
+    is interrupted the directory is kept, and running again over it exports only the ranges
+    that did not finish, under a new snapshot.
+
+    A table selection limits the tables (and the schema dump) to the selected ones; tables
+    whose data is excluded are kept with no range files. A token bucket, when given, paces
+    all COPY streams together.
+    """
+
+    def __init__(self, connection, pg_dump_command: list, env: dict, db_name: str, backup_dir: Path, jobs: int = 4, selection: TableSelection = None, throttle=None):
+        self.connection = connection
+        self.pg_dump_command = pg_dump_command
+        self.env = env
+        self.db_name = db_name
+        self.backup_dir = Path(backup_dir)
+        self.work_dir = partial_path(self.backup_dir)
+        self.data_dir = self.work_dir / DATA_DIR
+        self.jobs = max(jobs or 1, 1)
+        self.checkpoint = Checkpoint(self.work_dir)
+        self.selection = selection or TableSelection()
+        self.throttle = throttle
+        # server_version_num, read by the coordinating transaction
+        self.server_version = None
+
+    def _tables(self, cursor):
+        cursor.execute(TABLES_QUERY)
+        tables = []
+        for oid, schema, name, size in cursor.fetchall():
+            if not self.selection.includes(schema, name):
+                continue
+            cursor.execute(COLUMNS_QUERY, (oid,))
+            columns = [row[0] for row in cursor.fetchall()]
+            tables.append({"oid": oid, "schema": schema, "name": name, "columns": columns, "size": size})
+        return tables
+
+    def _plan(self, cursor, table: dict, block_size: int):
+        parts = min(self.jobs * 2, table["size"] // MIN_RANGE_BYTES)
+        if self.jobs == 1 or parts < 2:
+            return [CopyUnit(table, 0, estimated_bytes=table["size"])]
+
+        per_range = table["size"] // parts
+        cursor.execute(PRIMARY_KEY_QUERY, (table["oid"],))
+        primary_key = cursor.fetchone()
+        if primary_key and primary_key[1] in SPLITTABLE_PK_TYPES:
+            key = sql.Identifier(primary_key[0])
+            cursor.execute(sql.SQL("SELECT min({key}), max({key}) FROM {table}").format(key=key, table=self._identifier(table)))
+            low, high = cursor.fetchone()
+            if low is None or high - low < parts:
+                return [CopyUnit(table, 0, estimated_bytes=table["size"])]
+            step = (high - low + 1) // parts
+            boundaries = [low + i * step for i in range(1, parts)]
+            conditions = [sql.SQL("{key} < {high}").format(key=key, high=sql.Literal(boundaries[0]))]
+            conditions += [
+                sql.SQL("{key} >= {low} AND {key} < {high}").format(key=key, low=sql.Literal(a), high=sql.Literal(b))
+                for a, b in zip(boundaries, boundaries[1:])
+            ]
+            conditions.append(sql.SQL("{key} >= {low}").format(key=key, low=sql.Literal(boundaries[-1])))
+            logger.info(f"Splitting {table['schema']}.{table['name']} ({table['size']} bytes) into {parts} ranges of '{primary_key[0]}'.")
+        elif self.server_version and self.server_version < TID_RANGE_SCAN_VERSION:
+            logger.info(f"Exporting {table['schema']}.{table['name']} ({table['size']} bytes) in one stream: it has no integer primary key, and ctid ranges need PostgreSQL 14 to avoid a full scan per range.")
+            return [CopyUnit(table, 0, estimated_bytes=table["size"])]
+        else:
+            # Pages added after the snapshot hold no visible rows, so the last range is left open
+            pages = max(table["size"] // block_size, 1)
+            step = -(-pages // parts)
+            boundaries = [i * step for i in range(1, parts)]
+            conditions = [sql.SQL("ctid < {high}::tid").format(high=sql.Literal(f"({boundaries[0]},0)"))]
+            conditions += [
+                sql.SQL("ctid >= {low}::tid AND ctid < {high}::tid").format(low=sql.Literal(f"({a},0)"), high=sql.Literal(f"({b},0)"))
+                for a, b in zip(boundaries, boundaries[1:])
+            ]
+            conditions.append(sql.SQL("ctid >= {low}::tid").format(low=sql.Literal(f"({boundaries[-1]},0)")))
+            logger.info(f"Splitting {table['schema']}.{table['name']} ({table['size']} bytes) into {parts} ctid ranges.")
+        return [CopyUnit(table, part, condition, per_range) for part, condition in enumerate(conditions)]
+
+    @staticmethod
+    def _identifier(table: dict):
+        return sql.Identifier(table["schema"], table["name"])
+
+    def _copy_statement(self, unit: CopyUnit):
+        table = self._identifier(unit.table)
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in unit.table["columns"])
+        if unit.condition is None:
+            return sql.SQL("COPY {table} ({columns}) TO STDOUT (FORMAT binary)").format(table=table, columns=columns)
+        return sql.SQL("COPY (SELECT {columns} FROM {table} WHERE {condition}) TO STDOUT (FORMAT binary)").format(
+            table=table, columns=columns, condition=unit.condition,
+        )
+
+    def _export_unit(self, snapshot_id: str, unit: CopyUnit):
+        path = self.data_dir / unit.file
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                    writer = HashingWriter(f)
+                    sink = ThrottledWriter(writer, self.throttle) if self.throttle else writer
+                    cursor.copy_expert(self._copy_statement(unit).as_string(conn), sink)
+                unit.rows = max(cursor.rowcount, 0)
+        tmp_path.replace(path)
+        unit.bytes = writer.size
+        self.checkpoint.mark_done(unit.file, {"rows": unit.rows, "bytes": unit.bytes, "checksum": writer.checksum})
+        return unit
+
+    def _dump_schema(self, snapshot_id: str):
+        command = self.pg_dump_command + [
+            "-F", "c",
+            "--schema-only",
+            f"--snapshot={snapshot_id}",
+            "-f", str(self.work_dir / SCHEMA_FILE),
+            *self.selection.pg_dump_args(),
+            self.db_name,
+        ]
+        run_process(command, "Schema dump", env=self.env, logger=logger)
+
+    def _start(self, conn, cursor, snapshot_id: str, block_size: int):
+        """
+        Dump the schema, plan the ranges and record the plan in a new checkpoint.
+        """
+        with phase("schema"):
+            self._dump_schema(snapshot_id)
+        tables = self._tables(cursor)
+        units = [
+            unit for table in tables if self.selection.includes_data(table["schema"], table["name"])
+            for unit in self._plan(cursor, table, block_size)
+        ]
+        cursor.execute(SEQUENCES_QUERY)
+        # Owned and identity sequences go with their table, like pg_dump -t does
+        sequences = [
+            {"schema": schema, "name": name, "last_value": value}
+            for schema, name, value, owner_schema, owner in cursor.fetchall()
+            if (self.selection.includes(owner_schema, owner) if owner else self.selection.includes(schema, name))
+        ]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_largeobject_metadata)")
+        if cursor.fetchone()[0]:
+            logger.warning("Large objects are not exported by the native engine. Use the tool engine to keep them.")
+
+        self.checkpoint.start({
+            "engine": "native",
+            "db_name": self.db_name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "snapshots": [snapshot_id],
+            "tables": tables,
+            "sequences": sequences,
+            "units": [
+                {"table": tables.index(unit.table), "part": unit.part, "estimated_bytes": unit.estimated_bytes,
+                 "condition": unit.condition.as_string(conn) if unit.condition is not None else None}
+                for unit in units
+            ],
+        })
+        return tables, units
+
+    def _resume(self, snapshot_id: str):
+        """
+        Rebuild the plan of an interrupted backup from its checkpoint.
+        """
+        state = self.checkpoint.state
+        tables = state["tables"]
+        units = [
+            CopyUnit(tables[u["table"]], u["part"], sql.SQL(u["condition"]) if u["condition"] else None, u["estimated_bytes"])
+            for u in state["units"]
+        ]
+        self.checkpoint.update(snapshots=state["snapshots"] + [snapshot_id])
+        logger.warning(
+            f"Resuming backup in '{self.work_dir}': {len(state['done'])} of {len(units)} COPY stream(s) already exported. "
+            "Ranges exported now are read from a new snapshot, so the backup is consistent per range but not across the interruption."
+        )
+        return tables, units
+
+    def run(self):
+        start_time = time.time()
+        resuming = self.checkpoint.exists
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    # This transaction stays open until every worker has adopted its snapshot
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    cursor.execute("SELECT pg_export_snapshot(), current_setting('block_size')::int, current_setting('server_version_num')::int")
+                    snapshot_id, block_size, self.server_version = cursor.fetchone()
+                    logger.info(f"Exported snapshot {snapshot_id}.")
+
+                    tables, units = self._resume(snapshot_id) if resuming else self._start(conn, cursor, snapshot_id, block_size)
+                    pending = [unit for unit in units if not self.checkpoint.is_done(unit.file)]
+
+                    # Biggest units first so the pool does not end on one long straggler
+                    pending.sort(key=lambda u: u.estimated_bytes, reverse=True)
+                    logger.info(f"Exporting {len(tables)} table(s) as {len(pending)} COPY stream(s) with {self.jobs} worker(s).")
+                    with phase("copy"), ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="pgcopy") as executor:
+                        for unit in executor.map(lambda u: self._export_unit(snapshot_id, u), pending):
+                            logger.info(f"Exported {unit.rows} rows ({unit.bytes} bytes) from {unit.table['schema']}.{unit.table['name']} part {unit.part}.")
+        except Exception:
+            if not self.checkpoint.exists:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+            else:
+                logger.error(
+                    f"Backup interrupted with {len(self.checkpoint.state['done'])} COPY stream(s) finished. "
+                    f"Run it again with --resume to export only the rest into '{self.backup_dir.name}'."
+                )
+            raise
+
+        done = self.checkpoint.state["done"]
+        for table in tables:
+            table_units = sorted((u for u in units if u.table is table), key=lambda u: u.part)
+            table["files"] = [u.file for u in table_units]
+            table["rows"] = sum(done[u.file]["rows"] for u in table_units)
+            table["bytes"] = sum(done[u.file]["bytes"] for u in table_units)
+
+        snapshots = self.checkpoint.state["snapshots"]
+        manifest = {
+            "engine": "native",
+            "db_name": self.db_name,
+            "created": self.checkpoint.state["created"],
+            "snapshot": snapshots[0],
+            "schema": SCHEMA_FILE,
+            "tables": tables,
+            "sequences": self.checkpoint.state["sequences"],
+        }
+        if self.selection:
+            manifest["selection"] = self.selection.describe()
+        if len(snapshots) > 1:
+            manifest["resumed_snapshots"] = snapshots[1:]
+        atomic_write_text(self.work_dir / MANIFEST_FILE, json.dumps(manifest, indent=2))
+        self.checkpoint.remove()
+        finalize(self.backup_dir)
+        # Data files were checksummed while they were written; only the schema and manifest are read here
+        record_checksums(self.backup_dir, known={
+            f"{DATA_DIR}/{name}": {"size": unit["bytes"], "checksum": unit["checksum"]}
+            for name, unit in done.items() if "checksum" in unit
+        })
+
+        total_rows = sum(table["rows"] for table in tables)
+        total_bytes = sum(table["bytes"] for table in tables)
+        count("rows", total_rows)
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Native export wrote {total_rows} rows, {total_bytes} bytes in {elapsed:.1f}s ({total_bytes / elapsed / (1024 * 1024):.1f} MB/s).")
+        return self.backup_dir
+
+
+def parse_session_settings(settings):
+    """
+    Turn ["synchronous_commit=off", ...] into a dict of server settings.
+    """
+    parsed = {}
+    for setting in settings or []:
+        name, separator, value = setting.partition("=")
+        if not separator or not name.strip() or not value.strip():
+            raise ValueError(f"Invalid session setting '{setting}'. Use name=value, e.g. synchronous_commit=off.")
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def warn_ignored_restore_errors(result):
+    """
+    pg_restore exits non-zero when it ignored errors; surface that as a warning.
+    """
+    for line in result.tail:
+        if "pg_restore: warning: errors ignored on restore:" in line:
+            logger.warning(line.strip())
+            break
+
+
+class NativePostgresRestore:
+    """
+    Restore a native export with parallel COPY ... FROM STDIN (FORMAT binary).
+
+    The restore runs in three phases:
+      1. pre-data: tables, types and functions from schema.dump, created without indexes
+         or constraints.
+      2. data: tables are loaded in parallel over pooled connections, each table in one
+         transaction that truncates it and COPYs its range files with FREEZE, so the rows
+         need no hint-bit or vacuum pass later.
+      3. post-data: indexes, constraints and triggers are built by pg_restore -j once all
+         data is in, so every index is built in one sort instead of row by row.
+    Optional session settings (e.g. synchronous_commit=off, maintenance_work_mem=2GB) are
+    applied to the data transactions and to pg_restore. A table selection restores only the
+    selected tables: their schema entries are picked from the cached table of contents of
+    schema.dump and only their range files are loaded.
+    """
+
+    def __init__(self, connection, pg_restore_command: list, env: dict, db_name: str, backup_dir: Path, jobs: int = 4, session_settings: dict = None, selection: TableSelection = None):
+        self.connection = connection
+        self.pg_restore_command = pg_restore_command
+        self.env = dict(env)
+        self.db_name = db_name
+        self.backup_dir = Path(backup_dir)
+        self.jobs = max(jobs or 1, 1)
+        self.session_settings = session_settings or {}
+        if self.session_settings:
+            # PGOPTIONS is split on spaces, which have to be escaped inside values
+            options = " ".join(f"-c {name}=" + value.replace(" ", "\\ ") for name, value in self.session_settings.items())
+            self.env["PGOPTIONS"] = f"{self.env.get('PGOPTIONS', '')} {options}".strip()
+
+        manifest_path = self.backup_dir / MANIFEST_FILE
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"'{self.backup_dir}' is not a native backup: {MANIFEST_FILE} not found.")
+        self.manifest = json.loads(manifest_path.read_text())
+        self.selection = selection or TableSelection()
+        self.tables = self.manifest["tables"]
+        self.sequences = self.manifest["sequences"]
+        # pg_restore -L file of the selected schema entries
+        self.list_file = None
+
+    def _select(self, tmp: str):
+        """
+        Narrow the restore to the selected tables, their schema entries and their sequences.
+        """
+        schema = self.backup_dir / self.manifest["schema"]
+        entries = read_toc(schema, self.pg_restore_command, self.env, cache=toc_cache_path(self.backup_dir))
+        selected = select_entries(entries, self.selection)
+        sequences = {(e.schema, e.tag.split(" ")[0]) for e in selected if e.desc == "SEQUENCE"}
+        self.tables = [
+            table if self.selection.includes_data(table["schema"], table["name"]) else {**table, "files": [], "bytes": 0}
+            for table in self.tables if self.selection.includes(table["schema"], table["name"])
+        ]
+        if not self.tables:
+            raise ValueError(f"No table in '{self.backup_dir}' matches the selection {self.selection.describe()}.")
+        self.sequences = [s for s in self.sequences if (s["schema"], s["name"]) in sequences]
+        self.list_file = write_list_file(selected, tmp)
+        logger.info(f"Restoring {len(self.tables)} of {len(self.manifest['tables'])} table(s) for {self.selection.describe()}.")
+
+    def _restore_section(self, section: str, jobs: int = 1):
+        command = self.pg_restore_command + ["-d", self.db_name, f"--section={section}"]
+        if section == "pre-data":
+            command.extend(["--clean", "--if-exists"])
+        if jobs > 1:
+            command.extend(["-j", str(jobs)])
+        if self.list_file:
+            command.extend(["-L", self.list_file])
+        command.append(str(self.backup_dir / self.manifest["schema"]))
+        result = run_process(command, f"Restore of {section}", env=self.env, logger=logger, check=False)
+        warn_ignored_restore_errors(result)
+
+    def _drop_tables(self):
+        """
+        Drop the backed-up tables with CASCADE first, so foreign keys and views of an
+        existing copy of the database cannot block the pre-data phase.
+        """
+        tables = [sql.Identifier(table["schema"], table["name"]) for table in self.tables]
+        if not tables:
+            return
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("DROP TABLE IF EXISTS {tables} CASCADE").format(tables=sql.SQL(", ").join(tables)))
+            conn.commit()
+
+    def _load_table(self, table: dict):
+        identifier = sql.Identifier(table["schema"], table["name"])
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in table["columns"])
+        statement = sql.SQL("COPY {table} ({columns}) FROM STDIN (FORMAT binary, FREEZE)").format(table=identifier, columns=columns)
+        rows = 0
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                for name, value in self.session_settings.items():
+                    cursor.execute("SELECT set_config(%s, %s, true)", (name, value))
+                # FREEZE needs the table to be emptied in the same transaction
+                cursor.execute(sql.SQL("TRUNCATE {table}").format(table=identifier))
+                for file in table["files"]:
+                    with open(self.backup_dir / DATA_DIR / file, "rb", buffering=WRITE_BUFFER_SIZE) as f:
+                        cursor.copy_expert(statement.as_string(conn), f, size=WRITE_BUFFER_SIZE)
+                    rows += max(cursor.rowcount, 0)
+            conn.commit()
+        return table, rows
+
+    def _set_sequences(self):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                for sequence in self.sequences:
+                    name = sql.Identifier(sequence["schema"], sequence["name"]).as_string(conn)
+                    cursor.execute("SELECT setval(%s::regclass, %s, true)", (name, sequence["last_value"]))
+            conn.commit()
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix="pgrestore-") as tmp:
+            if self.selection:
+                with phase("toc"):
+                    self._select(tmp)
+            self._run()
+
+    def _run(self):
+        start_time = time.time()
+        tables = self.tables
+        logger.info(f"Restoring native backup of '{self.manifest['db_name']}' taken {self.manifest['created']}.")
+
+        with phase("pre_data"):
+            self._drop_tables()
+            self._restore_section("pre-data")
+        phase_time = time.time()
+
+        # Biggest tables first so the pool does not end on one long straggler
+        tables = sorted(tables, key=lambda t: t["bytes"], reverse=True)
+        logger.info(f"Loading {len(tables)} table(s) with {self.jobs} worker(s).")
+        total_rows = 0
+        with phase("data"), ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="pgcopy") as executor:
+            for table, rows in executor.map(self._load_table, tables):
+                total_rows += rows
+                logger.info(f"Loaded {rows} rows into {table['schema']}.{table['name']}.")
+        self._set_sequences()
+        count("rows", total_rows)
+        total_bytes = sum(table["bytes"] for table in tables)
+        elapsed = max(time.time() - phase_time, 1e-6)
+        logger.info(f"Loaded {total_rows} rows, {total_bytes} bytes in {elapsed:.1f}s ({total_bytes / elapsed / (1024 * 1024):.1f} MB/s).")
+
+        phase_time = time.time()
+        logger.info(f"Building indexes and constraints with {self.jobs} job(s).")
+        with phase("post_data"):
+            self._restore_section("post-data", jobs=self.jobs)
+        logger.info(f"Post-data phase finished in {time.time() - phase_time:.1f}s; native restore took {time.time() - start_time:.1f}s.")
@@ -0,0 +1,412 @@
+import io
+import json
+import os
+import re
+import shlex
+import shutil
+import platform
+import subprocess
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+from logger import setup_logger
+from checkpoint import partial_path, finalize, discard, atomic_write_text, durable_replace
+from compression import COMPRESSORS, Compression, detect_compression
+from integrity import HashingWriter, record_checksums
+from metrics import phase, count
+from pipeline import run_pipeline, check_pipeline
+from process_runner import StreamingProcess, run_process
+
+logger = setup_logger("logs")
+
+BACKUP_INFO = "backup.json"
+# Archived WAL lives next to the base backups: <output>/wal_archive/<segment>[.zst]
+WAL_ARCHIVE_DIR = "wal_archive"
+# pg_receivewal's own directory inside the archive. Finished segments are compressed out of
+# it; the newest one stays so a restarted receiver continues after it.
+INCOMING_DIR = ".incoming"
+DEFAULT_SLOT = "backup_utility"
+# Seconds between scans for finished segments, and before a failed receiver is restarted
+POLL_SECONDS = 2
+RESTART_SECONDS = 10
+WAL_SEGMENT = re.compile(r"^[0-9A-F]{24}$")
+TIMELINE_HISTORY = re.compile(r"^[0-9A-F]{8}\.history$")
+RECOVERY_MARKER = "# Point-in-time recovery, written by the backup utility"
+
+
+def find_pg_tool(tool: str):
+    """
+    Locate a PostgreSQL client program such as pg_dump or pg_basebackup.
+    """
+    tool_path = shutil.which(tool)
+    if tool_path:
+        return tool_path
+
+    system = platform.system()
+
+    if system == "Windows":
+        possible_paths = [
+            Path("C:/Program Files/PostgreSQL"),
+            Path("C:/Program Files (x86)/PostgreSQL"),
+        ]
+        for base in possible_paths:
+            if base.exists():
+                for version_dir in base.iterdir():
+                    bin_path = version_dir / "bin" / f"{tool}.exe"
+                    if bin_path.exists():
+                        return str(bin_path)
+
+    elif system in ("Linux", "Darwin"):
+        possible_paths = [
+            f"/usr/bin/{tool}",
+            f"/usr/local/bin/{tool}",
+            f"/opt/homebrew/bin/{tool}",
+        ]
+        for path in possible_paths:
+            if Path(path).exists():
+                return path
+
+    raise FileNotFoundError(f"{tool} not found. Make sure PostgreSQL is installed and {tool} is in your PATH.")
+
+
+def pg_tool_version(tool_path: str):
+    """
+    Major version of a PostgreSQL client program, e.g. 16 for "pg_basebackup (PostgreSQL) 16.2".
+    """
+    output = subprocess.run([tool_path, "--version"], capture_output=True, text=True).stdout
+    match = re.search(r"\) (\d+)", output)
+    if not match:
+        raise Exception(f"Could not read the version of {tool_path} from '{output.strip()}'.")
+    return int(match.group(1))
+
+
+def find_tar():
+    tar_path = shutil.which("tar")
+    if not tar_path:
+        raise FileNotFoundError("tar not found. Make sure tar is installed and in your PATH.")
+    return tar_path
+
+
+def _compress_file(source: Path, compression: Compression):
+    """
+    Compress `source` next to itself and remove it. Returns the compressed file's writer.
+    """
+    target = source.with_name(f"{source.name}{compression.extension}")
+    tmp_path = target.with_name(f"{target.name}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            writer = HashingWriter(f)
+            processes = run_pipeline([compression.compress_command()], input_path=str(source), sink=writer, logger=logger)
+        check_pipeline(processes, "Compression")
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    source.unlink()
+    return target, writer
+
+
+def _wal_ranges(manifest_path: Path):
+    # backup_manifest exists from PostgreSQL 13 on
+    if not manifest_path.exists():
+        return None
+    return json.loads(manifest_path.read_text()).get("WAL-Ranges")
+
+
+def _first_wal_segment(tar: Path):
+    """
+    Oldest WAL segment in a base backup's pg_wal tar: the one the backup started in, and so
+    the oldest archived segment a recovery from it reads.
+    """
+    compression = detect_compression(tar)
+    listing = [find_tar(), "-t", "-f", "-"]
+    commands = [compression.decompress_command(), listing] if compression else [listing]
+    names = io.BytesIO()
+    check_pipeline(run_pipeline(commands, input_path=str(tar), sink=names, logger=logger), "WAL listing")
+    segments = sorted(Path(line).name for line in names.getvalue().decode().splitlines() if WAL_SEGMENT.match(Path(line).name))
+    return segments[0] if segments else None
+
+
+def base_backup_start_wal(backup_dir: Path):
+    """
+    First WAL segment of a base backup, from its backup.json, or None for backups taken
+    before it was recorded.
+    """
+    info_path = Path(backup_dir) / BACKUP_INFO
+    if not info_path.exists():
+        return None
+    return json.loads(info_path.read_text()).get("start_wal")
+
+
+def prune_wal_archive(archive_dir: Path, keep_from: str):
+    """
+    Delete archived WAL segments older than `keep_from`, the first segment of the oldest base
+    backup still kept. Timeline history files are small and always kept. Returns the number
+    of files removed.
+    """
+    removed = 0
+    for path in Path(archive_dir).iterdir():
+        name = path.name.split(".")[0]
+        if path.is_file() and WAL_SEGMENT.match(name) and name < keep_from:
+            path.unlink()
+            removed += 1
+    return removed
+
+
+class BaseBackup:
+    """
+    Physical copy of the whole cluster over the replication protocol with pg_basebackup.
+
+    The backup is a directory of tar files: base.tar with the data directory, pg_wal.tar with
+    the WAL streamed while the copy ran (enough to make it consistent on its own) and one
+    <oid>.tar per extra tablespace. pg_basebackup compresses them as it writes them where it
+    can (gzip on every version, lz4 and zstd from 15 on); otherwise, and for a pg_wal.tar it
+    left uncompressed, they are compressed after it finishes. backup.json records when the
+    backup started and finished; recovery can target any later time that the WAL archive
+    covers.
+    """
+
+    def __init__(self, connection_args: list, env: dict, backup_dir: Path, compression: Compression = None, max_rate: float = None, priority: list = None):
+        self.connection_args = connection_args
+        self.env = env
+        self.backup_dir = Path(backup_dir)
+        self.compression = compression
+        self.max_rate = max_rate
+        self.priority = priority or []
+
+    def _compress_args(self, tool: str):
+        """
+        pg_basebackup options that compress the tar files on the client, or None when this
+        pg_basebackup cannot use the algorithm.
+        """
+        if pg_tool_version(tool) >= 15:
+            return [f"--compress=client-{self.compression.algorithm}:{self.compression.level}"]
+        if self.compression.algorithm == "gzip":
+            return ["-Z", str(self.compression.level)]
+        return None
+
+    def run(self):
+        work_dir = partial_path(self.backup_dir)
+        tool = find_pg_tool("pg_basebackup")
+        command = [
+            *self.priority, tool, *self.connection_args,
+            "-D", str(work_dir), "-F", "t", "-X", "stream", "-c", "fast", "-l", self.backup_dir.name, "-v",
+        ]
+        compress_args = self._compress_args(tool) if self.compression else None
+        if compress_args:
+            command.extend(compress_args)
+        if self.max_rate:
+            # pg_basebackup paces itself, in kB/s
+            command.append(f"--max-rate={max(int(self.max_rate * 1024), 32)}k")
+
+        started = datetime.now().astimezone()
+        known = {}
+        try:
+            with phase("basebackup"):
+                run_process(command, "Base backup", env=self.env, logger=logger)
+            finished = datetime.now().astimezone()
+            if self.compression:
+                # Only what pg_basebackup left uncompressed is still a plain .tar here
+                with phase("compress"):
+                    for tar in sorted(work_dir.glob("*.tar")):
+                        target, writer = _compress_file(tar, self.compression)
+                        known[target.name] = {"size": writer.size, "checksum": writer.checksum}
+            info = {
+                "engine": "physical",
+                "db_type": "postgres",
+                "started": started.isoformat(timespec="seconds"),
+                "finished": finished.isoformat(timespec="seconds"),
+                "compression": str(self.compression) if self.compression else None,
+                "wal_ranges": _wal_ranges(work_dir / "backup_manifest"),
+                "start_wal": next((_first_wal_segment(tar) for tar in work_dir.glob("pg_wal.tar*")), None),
+                "tablespaces": sorted(tar.name.split(".")[0] for tar in work_dir.glob("*.tar*") if tar.name.split(".")[0] not in ("base", "pg_wal")),
+            }
+            atomic_write_text(work_dir / BACKUP_INFO, json.dumps(info, indent=2))
+        except BaseException:
+            discard(self.backup_dir)
+            raise
+        finalize(self.backup_dir)
+        with phase("checksum"):
+            record_checksums(self.backup_dir, known=known)
+        return self.backup_dir
+
+
+class WalArchiver:
+    """
+    Continuous WAL archiving with pg_receivewal over a replication slot.
+
+    pg_receivewal streams into `<archive>/.incoming/`; every few seconds the finished
+    segments are compressed into the archive. The slot makes the server keep WAL the
+    archiver has not received yet, so a stopped archiver leaves no gap, at the price of WAL
+    piling up on the server until it is back. The segment being written is only in
+    `.incoming/` as a .partial file, which point-in-time recovery also reads.
+    """
+
+    def __init__(self, connection_args: list, env: dict, archive_dir: Path, compression: Compression = None, slot: str = DEFAULT_SLOT, priority: list = None):
+        self.connection_args = connection_args
+        self.env = env
+        self.archive_dir = Path(archive_dir)
+        self.incoming_dir = self.archive_dir / INCOMING_DIR
+        self.compression = compression
+        self.slot = slot
+        self.priority = priority or []
+        self.stopped = threading.Event()
+        self.process = None
+
+    def _create_slot(self, tool: str):
+        command = [tool, *self.connection_args, "--slot", self.slot, "--create-slot", "--if-not-exists"]
+        run_process(command, "Replication slot creation", env=self.env, logger=logger)
+
+    def archive_finished(self):
+        """
+        Move finished segments and timeline history files into the archive. Returns the
+        number of files archived.
+        """
+        names = sorted(p.name for p in self.incoming_dir.iterdir() if WAL_SEGMENT.match(p.name) or TIMELINE_HISTORY.match(p.name))
+        segments = [name for name in names if WAL_SEGMENT.match(name)]
+        newest = segments[-1] if segments else None
+        archived = 0
+        for name in names:
+            source = self.incoming_dir / name
+            extension = self.compression.extension if self.compression else ""
+            target = self.archive_dir / f"{name}{extension}"
+            if not target.exists():
+                tmp_path = target.with_name(f"{target.name}.tmp")
+                if self.compression:
+                    check_pipeline(run_pipeline([self.compression.compress_command()], input_path=str(source), output_path=str(tmp_path), logger=logger), "WAL compression")
+                else:
+                    shutil.copyfile(source, tmp_path)
+                # The segment is deleted from .incoming below, and the server may have dropped it
+                # once pg_receivewal confirmed it, so the archived copy must be on disk first
+                durable_replace(tmp_path, target)
+                archived += 1
+            if name != newest:
+                source.unlink()
+        if archived:
+            count("wal_files", archived)
+            logger.info(f"Archived {archived} WAL file(s) into '{self.archive_dir}'.")
+        return archived
+
+    def stop(self):
+        self.stopped.set()
+        if self.process and self.process.poll() is None:
+            self.process.process.terminate()
+
+    def run(self):
+        self.incoming_dir.mkdir(parents=True, exist_ok=True)
+        tool = find_pg_tool("pg_receivewal")
+        self._create_slot(tool)
+        command = [*self.priority, tool, *self.connection_args, "-D", str(self.incoming_dir), "--slot", self.slot, "--no-loop", "-v"]
+        logger.info(f"Archiving WAL through slot '{self.slot}' into '{self.archive_dir}'.")
+        while not self.stopped.is_set():
+            self.process = StreamingProcess(command, env=self.env, logger=logger)
+            while self.process.poll() is None and not self.stopped.wait(POLL_SECONDS):
+                self.archive_finished()
+            self.process.wait()
+            self.archive_finished()
+            if not self.stopped.is_set():
+                logger.warning(f"pg_receivewal exited with code {self.process.returncode}. Restarting it in {RESTART_SECONDS}s; the slot keeps the WAL it missed.")
+                self.stopped.wait(RESTART_SECONDS)
+        logger.info("WAL archiver stopped.")
+
+
+def fetch_wal(archive_dir: Path, name: str, destination: str):
+    """
+    restore_command of a recovering server: copy WAL file `name` from the archive to
+    `destination`. Returns False when the archive does not have it, which tells the server
+    it reached the end of the archived WAL.
+    """
+    archive_dir = Path(archive_dir)
+    incoming_dir = archive_dir / INCOMING_DIR
+    candidates = [archive_dir / f"{name}{spec['extension']}" for spec in COMPRESSORS.values()]
+    # The segment the archiver was still receiving holds the newest changes
+    candidates += [archive_dir / name, incoming_dir / name, incoming_dir / f"{name}.partial"]
+    source = next((path for path in candidates if path.is_file()), None)
+    if source is None:
+        return False
+
+    destination = Path(destination)
+    tmp_path = destination.with_name(f"{destination.name}.tmp")
+    compression = detect_compression(source)
+    if compression:
+        check_pipeline(run_pipeline([compression.decompress_command()], input_path=str(source), output_path=str(tmp_path)), "WAL fetch")
+    else:
+        shutil.copyfile(source, tmp_path)
+    # After a crash the recovering server must not find a segment that was only partly written
+    durable_replace(tmp_path, destination)
+    return True
+
+
+def _conf_string(value: str):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def restore_command(archive_dir: Path):
+    """
+    Shell command the recovering server runs for every WAL file it needs.
+    """
+    cli_path = Path(__file__).resolve().parents[2] / "cli.py"
+    args = [sys.executable, str(cli_path), "wal-fetch", str(Path(archive_dir).resolve())]
+    quoted = subprocess.list2cmdline(args) if os.name == "nt" else " ".join(shlex.quote(arg) for arg in args)
+    return f"{quoted} %f %p"
+
+
+class PhysicalRestore:
+    """
+    Turn a base backup into a data directory that recovers to a point in time.
+
+    The tar files are unpacked into `target_dir`, and recovery.signal plus restore_command,
+    recovery_target_time and recovery_target_action = 'promote' are written to its
+    postgresql.auto.conf. Starting PostgreSQL on the directory replays the archived WAL up
+    to the target time (or to the end of the archive) and opens the database for writes.
+    """
+
+    def __init__(self, backup_dir: Path, target_dir: Path, archive_dir: Path, target_time: datetime = None):
+        self.backup_dir = Path(backup_dir)
+        self.target_dir = Path(target_dir)
+        self.archive_dir = Path(archive_dir)
+        self.target_time = target_time.astimezone() if target_time else None
+        info_path = self.backup_dir / BACKUP_INFO
+        if not info_path.exists():
+            raise FileNotFoundError(f"'{self.backup_dir}' is not a physical Postgres backup: {BACKUP_INFO} not found.")
+        self.info = json.loads(info_path.read_text())
+
+    def _extract(self, tar: Path, destination: Path):
+        compression = detect_compression(tar)
+        extract = [find_tar(), "-x", "-f", "-", "-C", str(destination)]
+        commands = [compression.decompress_command(), extract] if compression else [extract]
+        check_pipeline(run_pipeline(commands, input_path=str(tar), logger=logger), "Extraction")
+
+    def run(self):
+        finished = datetime.fromisoformat(self.info["finished"])
+        if self.target_time and self.target_time < finished:
+            raise ValueError(f"The base backup finished at {finished}. Pick a target time after that, or an older base backup.")
+        if self.info.get("tablespaces"):
+            raise Exception(f"The base backup has tablespaces ({', '.join(self.info['tablespaces'])}) that would have to be restored to their original locations. Restore it with pg_basebackup's tar files by hand.")
+        if self.target_dir.exists() and any(self.target_dir.iterdir()):
+            raise FileExistsError(f"Target data directory '{self.target_dir}' is not empty.")
+        if not self.archive_dir.is_dir():
+            logger.warning(f"WAL archive '{self.archive_dir}' does not exist. Recovery can only reach the end of the base backup.")
+
+        # PostgreSQL refuses to start on a data directory others can read
+        self.target_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tars = {tar.name.split(".")[0]: tar for tar in self.backup_dir.glob("*.tar*") if not tar.name.endswith(".tmp")}
+        with phase("extract"):
+            self._extract(tars["base"], self.target_dir)
+            if "pg_wal" in tars:
+                (self.target_dir / "pg_wal").mkdir(exist_ok=True)
+                self._extract(tars["pg_wal"], self.target_dir / "pg_wal")
+
+        settings = [RECOVERY_MARKER, f"restore_command = {_conf_string(restore_command(self.archive_dir))}"]
+        if self.target_time:
+            settings.append(f"recovery_target_time = {_conf_string(self.target_time.isoformat(sep=' ', timespec='seconds'))}")
+        settings.append("recovery_target_action = 'promote'")
+        with open(self.target_dir / "postgresql.auto.conf", "a") as conf:
+            conf.write("\n" + "\n".join(settings) + "\n")
+        (self.target_dir / "recovery.signal").touch()
+
+        target = f"up to {self.target_time.isoformat(sep=' ', timespec='seconds')}" if self.target_time else "to the end of the archive"
+        logger.info(f"Data directory ready at '{self.target_dir}'. Start PostgreSQL on it (pg_ctl -D \"{self.target_dir}\" start) to replay the archived WAL {target}; it promotes itself when done.")
+        return self.target_dir
+
@@ -0,0 +1,76 @@
+import atexit
+import threading
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from connection_cache import ResourceCache
+
+# Upper bound of open connections per endpoint; parallel engines check out several at once
+MAX_CONNECTIONS = 32
+# Shown in pg_stat_activity, so load checks can tell the utility's own sessions apart
+APPLICATION_NAME = "db-backup-utility"
+
+
+
+class BlockingPool:
+    """
+    ThreadedConnectionPool whose callers wait for a free connection once MAX_CONNECTIONS are
+    checked out, instead of getting a PoolError. Native runs with many --jobs and concurrent
+    backup-many targets on one endpoint then queue for connections rather than crash.
+    """
+
+    def __init__(self, maxconn: int, **params):
+        self.pool = ThreadedConnectionPool(0, maxconn, **params)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.slots.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close: bool = False):
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+_pools = ResourceCache(
+    factory=lambda **params: BlockingPool(MAX_CONNECTIONS, **params),
+    closer=lambda pool: pool.closeall(),
+)
+atexit.register(_pools.close_all)
+
+
+def get_pool(host: str, port: int, user: str, password: str, db_name: str):
+    """
+    Shared connection pool for one Postgres endpoint and database.
+    """
+    key = (host, port, user, password, db_name)
+    return _pools.get(key, host=host, port=port, user=user, password=password, dbname=db_name, application_name=APPLICATION_NAME)
+
+
+@contextmanager
+def pooled_connection(host: str, port: int, user: str, password: str, db_name: str):
+    """
+    Borrow a connection from the endpoint's pool. Broken connections are thrown away
+    instead of being returned to the pool, and a connection is always handed back
+    without an open transaction.
+    """
+    pool = get_pool(host, port, user, password, db_name)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        pool.putconn(conn, close=broken)
@@ -1,100 +1,98 @@
-import os, subprocess, shutil, platform
+import os, tempfile
 import psycopg2
 from datetime import datetime
 from pathlib import Path
 from logger import setup_logger
+from compression import parse_compression, detect_compression
+from pipeline import run_pipeline, check_pipeline
+from process_runner import run_process
+from metrics import phase
+from checkpoint import partial_path, finalize, discard, find_resumable
+from chunk_store import ChunkStore
+from storage import open_storage, split_location, is_storage_url, FilesystemStorage
+from integrity import record_checksums
+from encryption import Encryption, load_passphrase, is_encrypted, plain_name, ENCRYPTED_EXTENSION
+from connection_cache import verified, secret_fingerprint
+from throttle import rate_limit, priority_prefix, ThrottledWriter
+from .pool import pooled_connection, APPLICATION_NAME
+from .physical import BaseBackup, WalArchiver, find_pg_tool
+from .native import NativePostgresBackup, NativePostgresRestore, parse_session_settings, warn_ignored_restore_errors
+from .selection import TableSelection, read_toc, select_entries, write_list_file
 
 logger = setup_logger("logs")
 
+# Client sessions of other applications that are waiting on locks or I/O; the utility's own
+# sessions and its pg_dump are left out
+LOAD_QUERY = """
+    SELECT count(*)
+    FROM pg_stat_activity
+    WHERE state = 'active'
+      AND backend_type = 'client backend'
+      AND wait_event_type IN ('Lock', 'LWLock', 'IO', 'BufferPin')
+      AND pid <> pg_backend_pid()
+      AND application_name NOT IN ('pg_dump', %s)
+"""
+# Adaptive throttling backs off once this many sessions are waiting
+BUSY_WAITING_SESSIONS = 4
+
 class PostgresHandler:
-    def __init__(self, host: str, port: int, user: str, password: str, db_name: str, output_dir: str, format: str):
+    def __init__(self, host: str, port: int, user: str, password: str, db_name: str, output_dir: str, format: str, jobs: int = 1, compress: str = None, repo: str = None, engine: str = "tool", session_settings: list = None, storage: str = None, resume: bool = False, selection: TableSelection = None, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False, passphrase_file: str = None):
         self.host = host.strip()
         self.port = port or 5432
         self.user = user
         self.password = password
         self.db_name = db_name
         self.format = format
+        self.jobs = jobs or 1
+        self.compression = parse_compression(compress)
+        self.repo = ChunkStore(repo) if repo else None
+        self.engine = engine
+        self.session_settings = parse_session_settings(session_settings)
+        self.storage = open_storage(storage) if storage else None
+        # Backups are sealed with a passphrase-derived key; restores read the passphrase only when the backup is encrypted
+        self.passphrase_file = passphrase_file
+        self.encryption = Encryption(load_passphrase(passphrase_file)) if encrypt else None
+        # Continue the newest interrupted native backup instead of starting over
+        self.resume = resume
+        # Tables and schemas to back up or restore; empty means the whole database
+        self.selection = selection or TableSelection()
+        # Throttling: MB/s ceiling, priority of the child tools and back-off on server load
+        self.max_rate = max_rate
+        self.io_priority = io_priority
+        self.adaptive = adaptive
+        self.throttle = None
+        # Writer of the last streamed backup, which knows its size and checksum
+        self.upload = None
         if output_dir:
             self.output_dir = Path(output_dir)
-            self.output_dir.mkdir(parents=True, exist_ok=True)
+            # Uploads stream straight to the storage backend; only their names come from here
+            if not self.storage:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
 
     def _find_pg_dump(self):
-        pg_dump_path = shutil.which("pg_dump")
-        if pg_dump_path:
-            return pg_dump_path
-
-        system = platform.system()
-
-        if system == "Windows":
-            possible_paths = [
-                Path("C:/Program Files/PostgreSQL"),
-                Path("C:/Program Files (x86)/PostgreSQL"),
-            ]
-            for base in possible_paths:
-                if base.exists():
-                    for version_dir in base.iterdir():
-                        bin_path = version_dir / "bin" / "pg_dump.exe"
-                        if bin_path.exists():
-                            return str(bin_path)
-
-        elif system == "Linux" or system == "Darwin":
-            possible_paths = [
-                "/usr/bin/pg_dump",
-                "/usr/local/bin/pg_dump",
-                "/opt/homebrew/bin/pg_dump",
-            ]
-            for path in possible_paths:
-                if Path(path).exists():
-                    return path
-
-        raise FileNotFoundError("pg_dump not found. Make sure PostgreSQL is installed and pg_dump is in your PATH.")
+        return find_pg_tool("pg_dump")
 
     def _find_pg_restore_tool(self, format: str):
-        tool = "psql" if format == "sql" else "pg_restore"
-
-        tool_path = shutil.which(tool)
-        if tool_path:
-            return tool_path
-
-        system = platform.system()
-
-        if system == "Windows":
-            possible_paths = [
-                Path("C:/Program Files/PostgreSQL"),
-                Path("C:/Program Files (x86)/PostgreSQL"),
-            ]
-            for base in possible_paths:
-                if base.exists():
-                    for version_dir in base.iterdir():
-                        bin_path = version_dir / "bin" / f"{tool}.exe"
-                        if bin_path.exists():
-                            return str(bin_path)
-
-        elif system in ("Linux", "Darwin"):
-            possible_paths = [
-                f"/usr/bin/{tool}",
-                f"/usr/local/bin/{tool}",
-                f"/opt/homebrew/bin/{tool}",
-            ]
-            for path in possible_paths:
-                if Path(path).exists():
-                    return path
-
-        raise FileNotFoundError(f"{tool} not found. Make sure PostgreSQL is installed and {tool} is in your PATH.")
+        return find_pg_tool("psql" if format == "sql" else "pg_restore")
+
+    def connection(self):
+        """
+        Borrow a pooled connection to this handler's database.
+        """
+        return pooled_connection(self.host, self.port, self.user, self.password, self.db_name)
 
     def test_connection(self):
+        # Batch and scheduled runs hit the same endpoints over and over; trust a recent check
+        cache_key = ("postgres", self.host, self.port, self.user, secret_fingerprint(self.password), self.db_name)
+        if verified.get(cache_key):
+            logger.info(f"Connection to '{self.db_name}' at {self.host}:{self.port} was verified recently.")
+            return True
         try:
-            conn = psycopg2.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.password,
-                dbname=self.db_name
-            )
-            if conn:
-                conn.close()
-                return True
-            return False
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            verified.set(cache_key, True)
+            return True
         except psycopg2.OperationalError as e:
             error_msg = str(e).lower()
             if "does not exist" in error_msg:
@@ -108,12 +106,66 @@ class PostgresHandler:
         except Exception as e:
             raise Exception(f"Unexpected connection error: {e}")
 
+    def server_busy(self):
+        """
+        Load signal for adaptive throttling: a description when other sessions are piling up
+        on lock or I/O waits, otherwise None.
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(LOAD_QUERY, (APPLICATION_NAME,))
+                waiting = cursor.fetchone()[0]
+        return f"{waiting} sessions waiting on locks or I/O" if waiting >= BUSY_WAITING_SESSIONS else None
+
+    def _connection_args(self):
+        # Sanitize host
+        host = "127.0.0.1" if self.host.lower() == "localhost" else self.host
+        return ["-h", host, "-p", str(self.port), "-U", self.user]
+
+    def _env(self):
+        env = os.environ.copy()
+        env["PGPASSWORD"] = self.password
+        return env
+
     def backup(self):
-        pg_dump_path = self._find_pg_dump()
+        if self.engine == "physical":
+            return self._base_backup()
+        with rate_limit(self.max_rate, adaptive=self.adaptive, probe=self.server_busy) as bucket:
+            self.throttle = bucket
+            return self._backup()
+
+    def _base_backup(self):
+        """
+        Physical base backup of the whole cluster; see physical.py.
+        """
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        backup_dir = self.output_dir / f"{self.db_name.replace(' ', '_')}_basebackup_{timestamp}"
+        if self.adaptive:
+            logger.warning("pg_basebackup paces itself at --max-rate and cannot back off adaptively. Ignoring --adaptive.")
+        engine = BaseBackup(self._connection_args(), self._env(), backup_dir, compression=self.compression, max_rate=self.max_rate, priority=priority_prefix(self.io_priority))
+        return engine.run()
+
+    def wal_archiver(self, archive_dir: Path, slot: str = None):
+        """
+        Continuous WAL archiver for this server; see physical.py.
+        """
+        options = {"slot": slot} if slot else {}
+        return WalArchiver(self._connection_args(), self._env(), archive_dir, compression=self.compression, priority=priority_prefix(self.io_priority), **options)
+
+    def _sink(self, writer):
+        return ThrottledWriter(writer, self.throttle) if self.throttle else writer
+
+    def _backup(self):
+        with phase("tool_lookup"):
+            pg_dump_path = self._find_pg_dump()
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         safe_db_name = self.db_name.replace(" ", "_")
-        extension = ".sql" if self.format == "sql" else ".dump"
-        pg_format = "p" if self.format == "sql" else "c"
+        extension = {"sql": ".sql", "directory": ""}.get(self.format, ".dump")
+        pg_format = {"sql": "p", "directory": "d"}.get(self.format, "c")
+        if self.compression:
+            extension += self.compression.extension
+        if self.encryption:
+            extension += ENCRYPTED_EXTENSION
         backup_file = self.output_dir / f"{safe_db_name}_backup_{timestamp}{extension}"
 
         env = os.environ.copy()
@@ -124,54 +176,207 @@ class PostgresHandler:
             self.host = "127.0.0.1"
 
         command = [
+            *priority_prefix(self.io_priority),
             pg_dump_path,
             "-h", self.host,
             "-p", str(self.port),
             "-U", self.user,
-            "-F", pg_format,
-            "-f", str(backup_file),
-            "--enable-row-security",
-            self.db_name,
         ]
-        result = subprocess.run(command, env=env, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Backup failed:\nSTDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}")
+
+        if self.engine == "native":
+            backup_dir = self.output_dir / f"{safe_db_name}_backup_{timestamp}"
+            if self.resume:
+                interrupted = find_resumable(self.output_dir, f"{safe_db_name}_backup_", db_name=self.db_name)
+                if interrupted:
+                    backup_dir = interrupted
+                else:
+                    logger.info(f"No interrupted backup of '{self.db_name}' in '{self.output_dir}'. Starting a new one.")
+            engine = NativePostgresBackup(self.connection, command, env, self.db_name, backup_dir, jobs=self.jobs, selection=self.selection, throttle=self.throttle)
+            return engine.run()
+
+        command.extend(["-F", pg_format, "--enable-row-security"])
+
+        # pg_dump writes directory archives, and custom archives that need no compressor,
+        # encryption, upload or pacing, to the output itself. A custom archive written to a
+        # file gets the data offsets in its TOC, which parallel and selective pg_restore use;
+        # one written to a pipe has none.
+        direct = self.format == "directory" or (
+            self.format == "dump" and not (self.compression or self.encryption or self.storage or self.repo or self.throttle)
+        )
+
+        if self.compression or self.repo:
+            # pg_dump writes to stdout. The custom format's own zlib compression is switched off:
+            # the external compressor does that work on all cores, and compressed output would
+            # defeat chunk deduplication in a repository.
+            if self.format == "dump":
+                command.extend(["-Z", "0"])
+        elif direct:
+            command.extend(["-f", str(partial_path(backup_file))])
+
+        # Directory archives are the only pg_dump format that can be written in parallel
+        if self.format == "directory" and self.jobs > 1:
+            command.extend(["-j", str(self.jobs)])
+
+        if self.selection:
+            logger.info(f"Backing up only the selected tables: {self.selection.describe()}.")
+            command.extend(self.selection.pg_dump_args())
+
+        command.append(self.db_name)
+
+        if self.repo:
+            return self._backup_to_repo(command, env, f"{safe_db_name}_backup_{timestamp}")
+
+        if not direct:
+            # Other single-file backups stream through the writer, which checksums them as they are written
+            if self.compression:
+                logger.info(f"Compressing backup stream with {self.compression}.")
+            if self.encryption:
+                logger.info("Encrypting backup stream with AES-256-GCM.")
+            commands = [command, priority_prefix(self.io_priority) + self.compression.compress_command()] if self.compression else [command]
+            location = self._backup_to_storage(commands, env, backup_file.name)
+            return location if self.storage else Path(location)
+
+        if self.throttle and self.format == "directory":
+            logger.warning("pg_dump writes directory archives itself, so --max-rate cannot pace them. Use --io-priority, or the native engine.")
+        try:
+            with phase("dump"):
+                run_process(command, "Backup", env=env, logger=logger)
+        except Exception:
+            discard(backup_file)
+            raise
+        finalize(backup_file)
+        # pg_dump wrote the archive itself, so it is read back once to checksum it
+        with phase("checksum"):
+            record_checksums(backup_file, jobs=self.jobs)
         return backup_file
 
+    def _backup_to_repo(self, command: list, env: dict, snapshot_name: str):
+        """
+        Stream pg_dump output into the chunk store, writing only chunks it has not seen before.
+        """
+        writer = self.repo.writer(snapshot_name, {"db_type": "postgres", "db_name": self.db_name, "format": self.format})
+        try:
+            with phase("dump"):
+                results = run_pipeline([command], env=env, sink=self._sink(writer), logger=logger)
+            check_pipeline(results, "Backup")
+            with phase("store"):
+                manifest_path = writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+        logger.info(f"Snapshot '{snapshot_name}' stored: {writer.size} bytes in {len(writer.chunks)} chunks, {writer.new_bytes} bytes in {writer.new_chunks} new chunks.")
+        return manifest_path
+
+    def _backup_to_storage(self, commands: list, env: dict, key: str):
+        """
+        Stream the dump into a storage backend while pg_dump is still running; nothing is
+        staged on the local disk. Without --storage the backend is the output directory.
+        With --encrypt the stream is sealed chunk by chunk on its way into the writer.
+        """
+        storage = self.storage or FilesystemStorage(self.output_dir)
+        writer = storage.writer(key)
+        sink = writer
+        try:
+            if self.encryption:
+                sink = self.encryption.writer(writer)
+            with phase("dump"):
+                results = run_pipeline(commands, env=env, sink=self._sink(sink), logger=logger)
+            check_pipeline(results, "Backup")
+            with phase("upload"):
+                location = sink.commit()
+        except Exception:
+            sink.abort()
+            raise
+        self.upload = writer
+        return location
 
-    def restore(self, backup_file):
+    def restore(self, backup_file=None, snapshot: str = None):
         env = os.environ.copy()
         env["PGPASSWORD"] = self.password
-        restore_tool = self._find_pg_restore_tool(self.format)
-
-        if str(backup_file).endswith(".sql") or self.format == "sql":
-            command = [
-                restore_tool,
-                "-h", self.host,
-                "-p", str(self.port),
-                "-U", self.user,
-                "-f", str(backup_file),
-                "-d", self.db_name
-            ]
+
+        if self.engine == "native":
+            command = [self._find_pg_restore_tool("dump"), "-h", self.host, "-p", str(self.port), "-U", self.user]
+            engine = NativePostgresRestore(self.connection, command, env, self.db_name, backup_file, jobs=self.jobs, session_settings=self.session_settings, selection=self.selection)
+            return engine.run()
+
+        if self.repo:
+            manifest = self.repo.load_manifest(snapshot) if snapshot else self.repo.latest_snapshot(self.db_name)
+            logger.info(f"Restoring snapshot '{manifest['name']}' from repository.")
+            compression = None
+            remote = False
+            encrypted = False
+            is_sql = manifest["format"] == "sql"
+        else:
+            # Compressed backups are named like name.sql.zst, so look at the inner extension
+            remote = is_storage_url(backup_file)
+            encrypted = is_encrypted(backup_file)
+            compression = detect_compression(plain_name(backup_file))
+            inner_name = Path(plain_name(backup_file)).stem if compression else plain_name(backup_file)
+            is_sql = inner_name.endswith(".sql") or self.format == "sql"
+        if self.selection and (is_sql or compression or self.repo or remote or encrypted):
+            raise ValueError(
+                "Selective restore reads the archive's table of contents, which needs a local custom (dump) or "
+                "directory archive. Plain SQL dumps, compressed or encrypted streams, repository snapshots and uploads cannot be filtered."
+            )
+        with phase("tool_lookup"):
+            restore_tool = self._find_pg_restore_tool("sql" if is_sql else "dump")
+
+        command = [
+            restore_tool,
+            "-h", self.host,
+            "-p", str(self.port),
+            "-U", self.user,
+            "-d", self.db_name,
+        ]
+        if not is_sql:
+            command.append("-c")
+            if self.jobs > 1 and (compression or self.repo or remote or encrypted):
+                logger.warning("Parallel restore needs a seekable archive. Restoring the stream with a single job.")
+            elif self.jobs > 1:
+                command.extend(["-j", str(self.jobs)])
+
+        if self.repo:
+            # psql and pg_restore read the stream rebuilt from the manifest on stdin
+            with phase("restore"):
+                result = run_pipeline([command], env=env, source=self.repo.read_snapshot(manifest["name"]), logger=logger)[0]
+        elif remote or encrypted:
+            # Download ranges ahead in parallel, or read the local file, decrypt the chunks on a
+            # thread pool when encrypted and stream them straight into the restore tool
+            if remote:
+                storage, key = split_location(backup_file)
+                logger.info(f"Streaming backup from {backup_file}.")
+            else:
+                storage, key = FilesystemStorage(Path(backup_file).parent), Path(backup_file).name
+            source = storage.reader(key)
+            if encrypted:
+                logger.info("Decrypting backup stream.")
+                source = Encryption(load_passphrase(self.passphrase_file)).decrypt(source, name=key)
+            commands = [compression.decompress_command(), command] if compression else [command]
+            with phase("restore"):
+                results = run_pipeline(commands, env=env, source=source, logger=logger)
+            check_pipeline(results[:-1], "Restore")
+            result = results[-1]
+        elif compression:
+            # psql and pg_restore read the decompressed stream from stdin
+            logger.info(f"Decompressing {compression.algorithm} backup stream.")
+            with phase("restore"):
+                results = run_pipeline([compression.decompress_command(), command], env=env, input_path=backup_file, logger=logger)
+            check_pipeline(results[:-1], "Restore")
+            result = results[-1]
+        elif self.selection:
+            with phase("toc"):
+                entries = read_toc(backup_file, [restore_tool], env)
+            selected = select_entries(entries, self.selection)
+            if not any(entry.relation for entry in selected):
+                raise ValueError(f"No table in '{backup_file}' matches the selection {self.selection.describe()}.")
+            logger.info(f"Restoring {len(selected)} of {len(entries)} archive entries for {self.selection.describe()}.")
+            with tempfile.TemporaryDirectory(prefix="pgrestore-") as tmp:
+                command.extend(["-L", write_list_file(selected, tmp), str(backup_file)])
+                with phase("restore"):
+                    result = run_process(command, "Restore", env=env, logger=logger, check=False)
         else:
-            command = [
-                restore_tool,
-                "-h", self.host,
-                "-p", str(self.port),
-                "-U", self.user,
-                "-d", self.db_name,
-                "-c",
-                str(backup_file)
-            ]
+            command.extend(["-f", str(backup_file)] if is_sql else [str(backup_file)])
+            with phase("restore"):
+                result = run_process(command, "Restore", env=env, logger=logger, check=False)
 
-        try:
-            result = subprocess.run(command, env=env, capture_output=True, text=True)
-            warning_line = None
-            for line in result.stderr.splitlines():
-                if "pg_restore: warning: errors ignored on restore:" in line:
-                    warning_line = line.strip()
-                    break
-            if warning_line:
-                logger.warning(warning_line)
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"Restore process error: {e}")
\ No newline at end of file
+        warn_ignored_restore_errors(result)
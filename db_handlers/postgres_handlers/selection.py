@@ -0,0 +1,319 @@
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from logger import setup_logger
+from process_runner import run_process
+from checkpoint import atomic_write_text
+
+logger = setup_logger("logs")
+
+# pg_restore --list output is cached next to the backup: <backup>.toc.json
+TOC_CACHE_SUFFIX = ".toc.json"
+TOC_LINE = re.compile(r"^(\d+); (\d+) (\d+) (.*)$")
+# Longest first, so "TABLE DATA" is not read as "TABLE" with a tag starting with "DATA"
+TOC_DESCRIPTIONS = sorted([
+    "TABLE", "TABLE DATA", "TABLE ATTACH", "VIEW", "MATERIALIZED VIEW", "MATERIALIZED VIEW DATA", "FOREIGN TABLE",
+    "SEQUENCE", "SEQUENCE SET", "SEQUENCE OWNED BY", "DEFAULT", "CONSTRAINT", "CHECK CONSTRAINT", "FK CONSTRAINT",
+    "INDEX", "INDEX ATTACH", "TRIGGER", "RULE", "POLICY", "ROW SECURITY", "STATISTICS", "STATISTICS DATA",
+    "COMMENT", "ACL", "SECURITY LABEL", "SCHEMA", "EXTENSION", "TYPE", "DOMAIN", "FUNCTION", "PROCEDURE",
+    "AGGREGATE", "OPERATOR", "COLLATION", "CONVERSION", "CAST", "PUBLICATION", "PUBLICATION TABLE",
+    "SUBSCRIPTION", "EVENT TRIGGER", "ENCODING", "STDSTRINGS", "SEARCHPATH", "DATABASE", "DATABASE PROPERTIES",
+    "BLOB", "BLOBS", "LARGE OBJECT", "BLOB METADATA",
+], key=len, reverse=True)
+# Entries whose tag is the relation itself
+RELATION_ENTRIES = ("TABLE", "VIEW", "MATERIALIZED VIEW", "FOREIGN TABLE", "SEQUENCE")
+# Entries whose tag starts with the name of the relation (or index) they belong to
+RELATION_MEMBER_ENTRIES = (
+    "TABLE DATA", "TABLE ATTACH", "MATERIALIZED VIEW DATA", "SEQUENCE SET", "DEFAULT", "CONSTRAINT",
+    "CHECK CONSTRAINT", "FK CONSTRAINT", "TRIGGER", "RULE", "POLICY", "ROW SECURITY", "PUBLICATION TABLE",
+    "INDEX ATTACH", "STATISTICS DATA",
+)
+# Entries whose tag names an object, e.g. "TABLE orders" or "COLUMN orders.id"
+OBJECT_LABEL_ENTRIES = ("COMMENT", "ACL", "SECURITY LABEL")
+DATA_ENTRIES = ("TABLE DATA", "MATERIALIZED VIEW DATA")
+
+_RELATION = r"((?:\"[^\"]+\"|[\w$]+)\.(?:\"[^\"]+\"|[\w$]+))"
+# Entries whose table only shows up in their SQL, which is read once with pg_restore. Sequences
+# are looked up because identity sequences are created by an ALTER TABLE of their table.
+DEFINITION_PATTERNS = {
+    "INDEX": re.compile(rf"\bON (?:ONLY )?{_RELATION}"),
+    "STATISTICS": re.compile(rf"\bFROM {_RELATION}"),
+    "SEQUENCE OWNED BY": re.compile(rf"\bOWNED BY {_RELATION}\."),
+    "SEQUENCE": re.compile(rf"^ALTER TABLE (?:ONLY )?{_RELATION} ALTER COLUMN .* ADD GENERATED", re.MULTILINE),
+}
+ENTRY_HEADER = re.compile(r"^-- (?:Data for )?Name: (.*?); Type: (.*?); Schema: (.*?);", re.MULTILINE)
+
+
+def _pattern_regex(part: str):
+    """
+    Translate one part of a psql-style name pattern: `*` and `?` are wildcards, unquoted
+    letters are folded to lower case and double quotes keep case and wildcard characters.
+    """
+    regex, quoted = "", False
+    for char in part:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == "*":
+            regex += ".*"
+        elif not quoted and char == "?":
+            regex += "."
+        else:
+            regex += re.escape(char if quoted else char.lower())
+    return re.compile(f"{regex}$")
+
+
+def _split_pattern(pattern: str):
+    """
+    Split "schema.table" on its first unquoted dot. (None, table) without a schema.
+    """
+    quoted = False
+    for index, char in enumerate(pattern):
+        if char == '"':
+            quoted = not quoted
+        elif char == "." and not quoted:
+            return pattern[:index], pattern[index + 1:]
+    return None, pattern
+
+
+def _unquote(identifier: str):
+    return identifier[1:-1].replace('""', '"') if identifier.startswith('"') and identifier.endswith('"') else identifier
+
+
+class NamePattern:
+    """
+    A pg_dump -t / -n style pattern. A table pattern without a schema matches the table in any schema.
+    """
+
+    def __init__(self, pattern: str, schema_only: bool = False):
+        if not isinstance(pattern, str) or not pattern.strip():
+            raise ValueError("Table and schema patterns must be non-empty strings.")
+        self.pattern = pattern.strip()
+        if schema_only:
+            self.schema, self.name = _pattern_regex(self.pattern), None
+        else:
+            schema, name = _split_pattern(self.pattern)
+            self.schema = _pattern_regex(schema) if schema else None
+            self.name = _pattern_regex(name)
+
+    def matches(self, schema: str, name: str = None):
+        if self.schema and not self.schema.match(schema):
+            return False
+        return self.name is None or (name is not None and bool(self.name.match(name)))
+
+
+class TableSelection:
+    """
+    Which tables a backup or restore covers, with pg_dump's semantics: --include-table and
+    --schema narrow the set, --exclude-table removes tables from it and --exclude-table-data
+    keeps a table's definition but not its rows.
+    """
+
+    def __init__(self, include_tables: list = None, exclude_tables: list = None, schemas: list = None, exclude_table_data: list = None):
+        self.include_tables = list(include_tables or [])
+        self.exclude_tables = list(exclude_tables or [])
+        self.schemas = list(schemas or [])
+        self.exclude_table_data = list(exclude_table_data or [])
+        self._include = [NamePattern(p) for p in self.include_tables]
+        self._exclude = [NamePattern(p) for p in self.exclude_tables]
+        self._schemas = [NamePattern(p, schema_only=True) for p in self.schemas]
+        self._exclude_data = [NamePattern(p) for p in self.exclude_table_data]
+
+    def __bool__(self):
+        return bool(self.include_tables or self.exclude_tables or self.schemas or self.exclude_table_data)
+
+    @property
+    def narrowed(self):
+        """
+        True when only the included tables and schemas are kept, not everything but the excluded ones.
+        """
+        return bool(self.include_tables or self.schemas)
+
+    def includes_schema(self, schema: str):
+        return not self._schemas or any(p.matches(schema) for p in self._schemas)
+
+    def includes(self, schema: str, name: str):
+        if self._include:
+            selected = any(p.matches(schema, name) for p in self._include)
+        else:
+            selected = self.includes_schema(schema)
+        return selected and not any(p.matches(schema, name) for p in self._exclude)
+
+    def includes_data(self, schema: str, name: str):
+        return self.includes(schema, name) and not any(p.matches(schema, name) for p in self._exclude_data)
+
+    def pg_dump_args(self):
+        args = []
+        for option, patterns in (("-t", self.include_tables), ("-T", self.exclude_tables), ("-n", self.schemas)):
+            for pattern in patterns:
+                args.extend([option, pattern])
+        for pattern in self.exclude_table_data:
+            args.append(f"--exclude-table-data={pattern}")
+        return args
+
+    def describe(self):
+        """
+        Short label for logs and the catalog, e.g. "public.orders,-audit_*".
+        """
+        parts = self.include_tables + [f"schema:{s}" for s in self.schemas]
+        parts += [f"-{p}" for p in self.exclude_tables] + [f"-data:{p}" for p in self.exclude_table_data]
+        return ",".join(parts)
+
+
+class TocEntry:
+    """
+    One line of an archive's table of contents, with the relation it belongs to when it has one.
+    """
+
+    def __init__(self, line: str, dump_id: int, desc: str, schema: str, tag: str, relation: list = None):
+        self.line = line
+        self.dump_id = dump_id
+        self.desc = desc
+        self.schema = schema
+        self.tag = tag
+        self.relation = relation
+
+    def to_dict(self):
+        return {"line": self.line, "dump_id": self.dump_id, "desc": self.desc, "schema": self.schema, "tag": self.tag, "relation": self.relation}
+
+
+def parse_toc_line(line: str):
+    match = TOC_LINE.match(line)
+    if not match:
+        return None
+    rest = match.group(4)
+    desc = next((d for d in TOC_DESCRIPTIONS if rest == d or rest.startswith(f"{d} ")), None)
+    if desc is None:
+        # An object type this module does not know; it is kept unless the selection narrows
+        desc, _, rest = rest.partition(" ")
+        return TocEntry(line, int(match.group(1)), desc, None, rest)
+    schema, _, tag = rest[len(desc) + 1:].partition(" ")
+    schema = None if schema == "-" else schema
+    entry = TocEntry(line, int(match.group(1)), desc, schema, tag)
+
+    # Tags end with the owner's name; object names with spaces in them are not supported
+    words = tag.split(" ")
+    if desc in RELATION_ENTRIES or desc in RELATION_MEMBER_ENTRIES:
+        entry.relation = [schema, words[0]]
+    elif desc in OBJECT_LABEL_ENTRIES and schema and len(words) >= 2:
+        kind, label = words[0], words[1:]
+        # Index and sequence labels are moved to their table once definitions are resolved
+        if kind in ("TABLE", "VIEW", "SEQUENCE", "INDEX"):
+            entry.relation = [schema, label[0]]
+        elif kind in ("MATERIALIZED", "FOREIGN") and len(label) >= 2:
+            entry.relation = [schema, label[1]]
+        elif kind == "COLUMN":
+            entry.relation = [schema, label[0].rsplit(".", 1)[0]]
+        elif kind in ("CONSTRAINT", "TRIGGER", "POLICY", "RULE") and "ON" in label[1:-1]:
+            # e.g. "CONSTRAINT orders_pkey ON orders"
+            entry.relation = [schema, label[label.index("ON", 1) + 1]]
+    return entry
+
+
+def _resolve_definitions(entries: list, archive: Path, pg_restore_command: list, env: dict, tmp: str):
+    """
+    Find the tables of indexes, extended statistics and sequences, whose tags do not name
+    them, by printing just those entries' SQL with pg_restore once. Owned and identity
+    sequences then follow their table, and index attachments and statistics their index.
+    """
+    pending = [e for e in entries if e.desc in DEFINITION_PATTERNS]
+    if not pending:
+        return
+    list_file = Path(tmp) / "definitions.list"
+    list_file.write_text("\n".join(e.line for e in pending) + "\n")
+    sql_file = Path(tmp) / "definitions.sql"
+    run_process(pg_restore_command + ["-L", str(list_file), "-f", str(sql_file), str(archive)], "Table of contents lookup", env=env, logger=logger)
+    text = sql_file.read_text(errors="replace")
+
+    by_name = {(e.desc, e.schema, e.tag.split(" ")[0]): e for e in pending}
+    headers = list(ENTRY_HEADER.finditer(text))
+    for header, following in zip(headers, headers[1:] + [None]):
+        entry = by_name.get((header.group(2), None if header.group(3) == "-" else header.group(3), header.group(1).split(" ")[0]))
+        if entry is None:
+            continue
+        found = DEFINITION_PATTERNS[entry.desc].search(text, header.end(), following.start() if following else len(text))
+        if found:
+            schema, _, name = found.group(1).partition(".")
+            entry.relation = [_unquote(schema), _unquote(name)]
+
+    owners = {
+        (e.schema, e.tag.split(" ")[0]): e.relation
+        for e in pending if e.relation and e.desc in ("INDEX", "SEQUENCE", "SEQUENCE OWNED BY")
+    }
+    for entry in entries:
+        if entry.relation and tuple(entry.relation) in owners:
+            entry.relation = owners[tuple(entry.relation)]
+
+
+def _archive_fingerprint(archive: Path):
+    # A directory archive's TOC lives in toc.dat; a custom archive is one file
+    stat = (archive / "toc.dat" if archive.is_dir() else archive).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def toc_cache_path(archive: Path):
+    archive = Path(archive)
+    return archive.with_name(f"{archive.name}{TOC_CACHE_SUFFIX}")
+
+
+def read_toc(archive: Path, pg_restore_command: list, env: dict, cache: Path = None):
+    """
+    Table of contents of a custom or directory archive. pg_restore --list and the definition
+    lookup run once; later restores from the same archive read the cached result, kept in
+    `cache` (by default next to the archive).
+    """
+    archive = Path(archive)
+    cache = Path(cache) if cache else toc_cache_path(archive)
+    fingerprint = _archive_fingerprint(archive)
+    if cache.exists():
+        try:
+            cached = json.loads(cache.read_text())
+            if cached["fingerprint"] == fingerprint:
+                return [TocEntry(**entry) for entry in cached["entries"]]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring unreadable table of contents cache '{cache.name}'.")
+
+    with tempfile.TemporaryDirectory(prefix="pgtoc-") as tmp:
+        listing = Path(tmp) / "toc.list"
+        run_process(pg_restore_command + ["--list", "-f", str(listing), str(archive)], "Table of contents read", env=env, logger=logger)
+        entries = [entry for entry in map(parse_toc_line, listing.read_text(errors="replace").splitlines()) if entry]
+        _resolve_definitions(entries, archive, pg_restore_command, env, tmp)
+    try:
+        atomic_write_text(cache, json.dumps({"fingerprint": fingerprint, "entries": [e.to_dict() for e in entries]}))
+    except OSError as e:
+        logger.warning(f"Could not cache the table of contents of '{archive.name}': {e}")
+    return entries
+
+
+def select_entries(entries: list, selection: TableSelection):
+    """
+    The entries a selective restore keeps, following pg_dump: the selected relations with
+    everything that belongs to them; with --schema (and no --include-table) also the other
+    objects of those schemas. Objects outside any schema, such as extensions, are kept only
+    when the selection does not narrow the archive.
+    """
+    kept = []
+    for entry in entries:
+        if entry.relation:
+            schema, name = entry.relation
+            keep = selection.includes_data(schema, name) if entry.desc in DATA_ENTRIES else selection.includes(schema, name)
+        elif entry.desc == "SCHEMA":
+            keep = not selection.include_tables and selection.includes_schema(entry.tag.split(" ")[0])
+        elif entry.schema:
+            keep = not selection.include_tables and selection.includes_schema(entry.schema)
+        else:
+            keep = not selection.narrowed or entry.desc in ("ENCODING", "STDSTRINGS", "SEARCHPATH")
+        if keep:
+            kept.append(entry)
+    return kept
+
+
+def write_list_file(entries: list, directory: str):
+    """
+    pg_restore -L file restoring exactly these entries.
+    """
+    fd, path = tempfile.mkstemp(prefix="restore-", suffix=".list", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(entry.line for entry in entries) + "\n")
+    return path
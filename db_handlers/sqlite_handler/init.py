@@ -0,0 +1,2 @@
+from .methods import *
+from .sqlite import *
\ No newline at end of file
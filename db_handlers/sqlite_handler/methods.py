@@ -0,0 +1,104 @@
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+from logger import setup_logger
+from .sqlite import SqliteHandler
+from .snapshot import SQLITE_HEADER
+from compression import parse_compression
+from catalog import Catalog, artifact_size
+from metrics import track_run, phase
+
+logger = setup_logger("sqlite_tasks")
+
+
+def sqlite_path(database_url: str = None, db_name: str = None):
+    """
+    Database file from a sqlite:///relative/path or sqlite:////absolute/path URL, or the
+    path given as the database name.
+    """
+    if database_url:
+        parsed = urlparse(database_url)
+        if parsed.scheme != "sqlite" or not parsed.path.strip("/"):
+            raise ValueError(f"Invalid SQLite URL '{database_url}'. Use sqlite:///relative/path.db or sqlite:////absolute/path.db.")
+        return Path(parsed.path[1:])
+    if not db_name or not db_name.strip():
+        raise ValueError("Give the SQLite database file with --database-url sqlite:///path.db or --db-name path.db.")
+    return Path(db_name)
+
+
+def fetch_sqlite_params_and_validate(database_url: str, db_name: str, backup_file: str = None, compress: str = None, repo: str = None, storage: str = None, incremental_base: str = None, pages: int = None, sleep: float = None, compact: bool = False):
+    db_path = sqlite_path(database_url, db_name)
+
+    if backup_file:
+        if not Path(backup_file).is_file():
+            raise FileNotFoundError(f"Backup file '{backup_file}' does not exist.")
+    else:
+        if not db_path.is_file():
+            raise FileNotFoundError(f"SQLite database '{db_path}' does not exist.")
+        with open(db_path, "rb") as f:
+            if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                raise ValueError(f"'{db_path}' is not a SQLite database.")
+
+    if repo or storage:
+        raise ValueError("SQLite backups are written to --output. --repo and --storage are not supported for SQLite.")
+    if compress:
+        parse_compression(compress)
+
+    if pages is not None and (not isinstance(pages, int) or (pages <= 0 and pages != -1)):
+        raise ValueError("Pages must be a positive integer, or -1 to copy the database in one step.")
+    if sleep is not None and sleep < 0:
+        raise ValueError("Sleep must be zero or a positive number of seconds.")
+
+    if incremental_base:
+        if not Path(incremental_base).is_file():
+            raise ValueError("SQLite incremental snapshots need a full backup file as their base.")
+        if compact:
+            raise ValueError("--compact renumbers the database's pages, so it cannot be combined with --incremental.")
+    return db_path
+
+
+def backup_sqlite_database(database_url: str = None, db_name: str = None, output: str = None, compress: str = None, repo: str = None, storage: str = None, incremental_base: str = None, pages: int = None, sleep: float = None, compact: bool = False, metrics: str = None):
+    db_path = fetch_sqlite_params_and_validate(database_url=database_url, db_name=db_name, compress=compress, repo=repo, storage=storage, incremental_base=incremental_base, pages=pages, sleep=sleep, compact=compact)
+
+    with track_run("backup", "sqlite", db_path.name, sink=metrics) as run:
+        handler = SqliteHandler(db_path=db_path, output_dir=output, compress=compress, pages=pages, sleep=sleep, compact=compact)
+        with phase("connect"):
+            handler.test_connection()
+
+        logger.info(f"Started taking backup of '{db_path}'......")
+        start_time = time.time()
+        if incremental_base:
+            backup_file = handler.backup_incremental(incremental_base)
+        else:
+            backup_file = handler.backup()
+        end_time = time.time()
+        size = handler.upload.size if handler.upload else artifact_size(backup_file)
+        run.count("bytes", size)
+        relative_path_str = f"{Path(backup_file).parent.name}\\{Path(backup_file).name}"
+        logger.info(f"Backup completed. Saved to {relative_path_str}. Time: {round((end_time-start_time)/60, 3)} minutes ({size / max(end_time - start_time, 1e-6) / (1024 * 1024):.2f} MB/s).")
+        # Snapshots belong to their full backup's entry; only full backups are catalogued
+        if not incremental_base:
+            try:
+                with phase("catalog"):
+                    Catalog().record(
+                        "sqlite", db_path.name, backup_file, format="db", engine="vacuum" if compact else "online", compression=compress,
+                        duration=end_time - start_time, size=size, checksum=handler.upload.checksum if handler.upload else None,
+                    )
+            except Exception as e:
+                logger.warning(f"Could not record the backup in the catalog: {e}")
+        return backup_file
+
+
+def restore_sqlite_database(database_url: str = None, db_name: str = None, backup_file: str = None, until=None, pages: int = None, sleep: float = None, metrics: str = None):
+    if not backup_file:
+        raise ValueError("Give the SQLite backup to restore with --file-path, --latest or --at.")
+    db_path = fetch_sqlite_params_and_validate(database_url=database_url, db_name=db_name, backup_file=backup_file, pages=pages, sleep=sleep)
+
+    with track_run("restore", "sqlite", db_path.name, sink=metrics) as run:
+        handler = SqliteHandler(db_path=db_path, pages=pages, sleep=sleep)
+        logger.info(f"Restoring '{Path(backup_file).name}' into '{db_path}'...")
+        start_time = time.time()
+        handler.restore(backup_file, until=until)
+        end_time = time.time()
+        run.count("bytes", artifact_size(backup_file))
+        logger.info(f"Restore completed successfully in {round((end_time-start_time)/60, 3)} minutes.")
@@ -0,0 +1,203 @@
+import json
+import os
+import struct
+from datetime import datetime
+from hashlib import blake2b
+from pathlib import Path
+from logger import setup_logger
+from checkpoint import atomic_write_text
+from compression import detect_compression
+from integrity import HashingWriter, record_checksums
+from pipeline import BLOCK_SIZE, run_pipeline, check_pipeline
+
+logger = setup_logger("logs")
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Incremental snapshots of a full backup live next to it in `<backup>.deltas/`
+DELTAS_SUFFIX = ".deltas"
+CHAIN_FILE = "chain.json"
+HASHES_FILE = "page_hashes.bin"
+
+# Delta file: magic, page size and page count of the database, then (page number, page) records
+DELTA_MAGIC = b"SQLPGDL1"
+DELTA_HEADER = struct.Struct("<II")
+PAGE_NUMBER = struct.Struct("<I")
+PAGE_HASH_SIZE = 16
+WRITE_BUFFER_SIZE = 1024 * 1024
+# A delta holding more than this share of the pages is no cheaper than a new full backup
+FULL_REWRITE_FRACTION = 0.5
+
+
+def deltas_path(backup_file):
+    backup_file = Path(backup_file)
+    return backup_file.with_name(f"{backup_file.name}{DELTAS_SUFFIX}")
+
+
+def page_size_of(header: bytes):
+    """
+    Page size from a database header; the value 1 stands for 65536.
+    """
+    if not header.startswith(SQLITE_HEADER):
+        raise ValueError("Not a SQLite database image.")
+    (size,) = struct.unpack_from(">H", header, 16)
+    return 65536 if size == 1 else size
+
+
+def page_hash(page):
+    return blake2b(page, digest_size=PAGE_HASH_SIZE).digest()
+
+
+class PageHasher:
+    """
+    Sink that splits a database image into pages and hashes each one.
+    """
+
+    def __init__(self):
+        self.page_size = None
+        self.hashes = bytearray()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if self.page_size is None:
+            if len(self.buffer) < 100:
+                return
+            self.page_size = page_size_of(bytes(self.buffer[:100]))
+        whole = len(self.buffer) - len(self.buffer) % self.page_size
+        with memoryview(self.buffer) as view:
+            for offset in range(0, whole, self.page_size):
+                self.hashes += page_hash(view[offset:offset + self.page_size])
+        del self.buffer[:whole]
+
+    def finish(self):
+        if self.buffer or self.page_size is None:
+            raise ValueError("The database image ends in the middle of a page; the backup is probably truncated.")
+        return self
+
+
+def hash_image(path: Path):
+    """
+    Page hashes of a backup file, decompressing it on the fly if needed.
+    """
+    hasher = PageHasher()
+    compression = detect_compression(path)
+    if compression:
+        check_pipeline(run_pipeline([compression.decompress_command()], input_path=str(path), sink=hasher, logger=logger), "Page hashing")
+    else:
+        with open(path, "rb") as f:
+            while block := f.read(BLOCK_SIZE):
+                hasher.write(block)
+    return hasher.finish()
+
+
+class PageChain:
+    """
+    Incremental snapshots of a full SQLite backup, diffed page by page.
+
+    The hash of every page as of the newest snapshot is kept in page_hashes.bin. A new
+    snapshot hashes the pages of the database file and writes only those whose
+    hash changed into `<backup>.deltas/<timestamp>.pages`; chain.json lists the deltas in
+    order. Restoring applies them to the full backup, oldest first.
+    """
+
+    def __init__(self, backup_file: Path):
+        self.backup_file = Path(backup_file)
+        self.directory = deltas_path(self.backup_file)
+        chain_file = self.directory / CHAIN_FILE
+        self.meta = json.loads(chain_file.read_text()) if chain_file.exists() else None
+
+    def deltas(self, until: datetime = None):
+        if not self.meta:
+            return []
+        return [d for d in self.meta["deltas"] if until is None or datetime.fromisoformat(d["created"]) <= until]
+
+    def _current_hashes(self):
+        if self.meta:
+            return self.meta["page_size"], (self.directory / HASHES_FILE).read_bytes()
+        logger.info(f"Hashing the pages of '{self.backup_file.name}' to start its incremental chain.")
+        hasher = hash_image(self.backup_file)
+        return hasher.page_size, bytes(hasher.hashes)
+
+    def capture(self, image: Path):
+        """
+        Write the pages of `image`, the database file under a read transaction or a copy of
+        it, that changed since the end of the chain into a new delta. Returns the delta's
+        chain entry.
+        """
+        page_size, hashes = self._current_hashes()
+        with open(image, "rb") as f:
+            if page_size_of(f.read(100)) != page_size:
+                raise Exception("The database's page size changed since the full backup. Take a new full backup.")
+
+        self.directory.mkdir(exist_ok=True)
+        # Microseconds keep two snapshots in the same second from sharing a delta file
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.pages"
+        delta_path = self.directory / name
+        if delta_path.exists():
+            raise FileExistsError(f"Delta '{delta_path}' already exists.")
+        tmp_path = delta_path.with_name(f"{name}.tmp")
+        new_hashes = bytearray()
+        changed = 0
+        try:
+            with open(image, "rb") as src, open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                page_count = os.fstat(src.fileno()).st_size // page_size
+                writer = HashingWriter(f)
+                writer.write(DELTA_MAGIC + DELTA_HEADER.pack(page_size, page_count))
+                for index in range(page_count):
+                    page = src.read(page_size)
+                    digest = page_hash(page)
+                    new_hashes += digest
+                    if hashes[index * PAGE_HASH_SIZE:(index + 1) * PAGE_HASH_SIZE] != digest:
+                        writer.write(PAGE_NUMBER.pack(index + 1))
+                        writer.write(page)
+                        changed += 1
+            os.replace(tmp_path, delta_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        entry = {
+            "file": name,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "page_count": page_count,
+            "changed_pages": changed,
+            "size": writer.size,
+            "checksum": writer.checksum,
+        }
+        # chain.json is the commit point. Hashes replaced after it can only be older than the
+        # chain, which makes the next delta larger than needed but never incomplete.
+        self.meta = self.meta or {"backup": self.backup_file.name, "page_size": page_size, "deltas": []}
+        self.meta["deltas"].append(entry)
+        atomic_write_text(self.directory / CHAIN_FILE, json.dumps(self.meta, indent=2))
+        hashes_tmp = self.directory / f"{HASHES_FILE}.tmp"
+        hashes_tmp.write_bytes(new_hashes)
+        os.replace(hashes_tmp, self.directory / HASHES_FILE)
+        record_checksums(delta_path, known={name: {"size": writer.size, "checksum": writer.checksum}})
+
+        if page_count and changed > page_count * FULL_REWRITE_FRACTION:
+            logger.warning(f"{changed} of {page_count} pages changed since the last snapshot. The database was probably vacuumed or the full backup was compacted; take a new full backup to keep deltas small.")
+        return entry
+
+    def apply(self, image: Path, until: datetime = None):
+        """
+        Apply the chain's deltas, oldest first, to a writable copy of the full backup.
+        Returns the number of deltas applied.
+        """
+        deltas = self.deltas(until)
+        with open(image, "r+b") as target:
+            for entry in deltas:
+                path = self.directory / entry["file"]
+                with open(path, "rb") as delta:
+                    header = delta.read(len(DELTA_MAGIC) + DELTA_HEADER.size)
+                    if not header.startswith(DELTA_MAGIC):
+                        raise ValueError(f"{path.name} is not a SQLite page delta.")
+                    page_size, page_count = DELTA_HEADER.unpack_from(header, len(DELTA_MAGIC))
+                    while number := delta.read(PAGE_NUMBER.size):
+                        page = delta.read(page_size)
+                        if len(number) != PAGE_NUMBER.size or len(page) != page_size:
+                            raise ValueError(f"{path.name} ends in the middle of a page; the delta is probably truncated.")
+                        target.seek((PAGE_NUMBER.unpack(number)[0] - 1) * page_size)
+                        target.write(page)
+                target.truncate(page_count * page_size)
+                logger.info(f"Applied delta {entry['file']} ({entry['changed_pages']} pages).")
+        return len(deltas)
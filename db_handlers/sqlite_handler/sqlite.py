@@ -0,0 +1,220 @@
+import shutil
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from logger import setup_logger
+from checkpoint import partial_path, finalize, discard
+from compression import parse_compression, detect_compression
+from integrity import HashingWriter, record_checksums
+from metrics import phase, count
+from pipeline import run_pipeline, check_pipeline
+from .snapshot import PageChain
+
+logger = setup_logger("logs")
+
+# Pages copied per step of the online backup, and the pause between steps in seconds. The
+# source is only locked while a step runs, so writers get in between steps.
+DEFAULT_PAGES = 256
+DEFAULT_SLEEP = 0.25
+# A write by another connection restarts a stepped copy from the first page. After this many
+# restarts the rest is copied in one step, which cannot be interrupted.
+MAX_RESTARTS = 3
+# Scratch copy of the live database diffed against the chain by an incremental snapshot, when
+# writers keep the database file itself from being read consistently
+SCRATCH_FILE = "image.db"
+
+
+class _CopyRestarted(Exception):
+    pass
+
+
+class SqliteHandler:
+    def __init__(self, db_path: str, output_dir: str = None, compress: str = None, pages: int = DEFAULT_PAGES, sleep: float = DEFAULT_SLEEP, compact: bool = False):
+        self.db_path = Path(db_path)
+        self.compression = parse_compression(compress)
+        self.pages = pages or DEFAULT_PAGES
+        self.sleep = DEFAULT_SLEEP if sleep is None else sleep
+        # VACUUM INTO instead of the online backup API: a defragmented copy without free pages
+        self.compact = compact
+        # Compressed backups are hashed while they are written; see methods.py
+        self.upload = None
+        if output_dir:
+            self.output_dir = Path(output_dir)
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def _connect(self, readonly: bool = False):
+        if readonly:
+            return sqlite3.connect(f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True)
+        return sqlite3.connect(self.db_path)
+
+    def test_connection(self):
+        try:
+            conn = self._connect(readonly=True)
+            try:
+                conn.execute("PRAGMA schema_version").fetchone()
+            finally:
+                conn.close()
+            return True
+        except sqlite3.DatabaseError as e:
+            raise Exception(f"Could not open SQLite database '{self.db_path}': {e}")
+
+    def _step_copy(self, source, target, action: str):
+        """
+        Copy `source` into `target` with the online backup API, `self.pages` pages at a time.
+        """
+        state = {"remaining": None, "restarts": 0, "reported": 0}
+
+        def progress(status, remaining, total):
+            if state["remaining"] is not None and remaining > state["remaining"]:
+                state["restarts"] += 1
+                logger.info(f"The database changed during the {action}; the copy started over ({state['restarts']}/{MAX_RESTARTS}).")
+                if state["restarts"] >= MAX_RESTARTS:
+                    raise _CopyRestarted()
+            state["remaining"] = remaining
+            done = (total - remaining) * 10 // max(total, 1)
+            if done > state["reported"]:
+                state["reported"] = done
+                logger.info(f"{action.capitalize()}: {done * 10}% of {total} pages copied.")
+
+        try:
+            source.backup(target, pages=self.pages, progress=progress, sleep=self.sleep)
+        except _CopyRestarted:
+            logger.warning(f"The database keeps changing during the {action}. Copying it in one step, which holds a read lock until it finishes.")
+            source.backup(target, pages=-1)
+        count("copy_restarts", state["restarts"])
+
+    def _copy_to(self, image: Path):
+        source = self._connect(readonly=True)
+        try:
+            if self.compact:
+                # One read transaction; writers are only blocked when the database is not in WAL mode
+                source.execute("VACUUM INTO ?", (str(image),))
+                return
+            target = sqlite3.connect(image)
+            try:
+                self._step_copy(source, target, "backup")
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def backup(self):
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        image_file = self.output_dir / f"{self.db_path.stem}_backup_{timestamp}.db"
+        backup_file = image_file.with_name(f"{image_file.name}{self.compression.extension}") if self.compression else image_file
+
+        try:
+            with phase("vacuum" if self.compact else "copy"):
+                self._copy_to(partial_path(image_file))
+            if not self.compression:
+                finalize(image_file)
+                with phase("checksum"):
+                    record_checksums(image_file)
+                return image_file
+
+            with phase("compress"):
+                with open(partial_path(backup_file), "wb") as f:
+                    self.upload = HashingWriter(f)
+                    processes = run_pipeline([self.compression.compress_command()], input_path=str(partial_path(image_file)), sink=self.upload, logger=logger)
+                check_pipeline(processes, "Backup")
+            discard(image_file)
+            finalize(backup_file)
+            record_checksums(backup_file, known={backup_file.name: {"size": self.upload.size, "checksum": self.upload.checksum}})
+            return backup_file
+        except BaseException:
+            discard(image_file)
+            discard(backup_file)
+            raise
+
+    def _begin_file_snapshot(self, conn):
+        """
+        Open a read transaction under which the database file itself is a consistent image.
+        In WAL mode committed pages may still be in the -wal file, so it is checkpointed first;
+        the snapshot holds if the WAL was still empty when the transaction began, as no
+        checkpoint can then write to the file until it ends. Returns False when writers kept
+        getting in between.
+        """
+        wal = self.db_path.with_name(f"{self.db_path.name}-wal")
+        wal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        for _ in range(MAX_RESTARTS):
+            if wal_mode:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("BEGIN")
+            conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            if not wal_mode or not wal.exists() or wal.stat().st_size == 0:
+                return True
+            conn.execute("ROLLBACK")
+        return False
+
+    def backup_incremental(self, base_file: str):
+        """
+        Snapshot the pages that changed since the last snapshot of the full backup `base_file`.
+        The pages are hashed straight from the database file under a read transaction, so only
+        the changed ones are copied; a scratch copy is only made when writers never let up.
+        """
+        chain = PageChain(base_file)
+        conn = self._connect()
+        try:
+            if self._begin_file_snapshot(conn):
+                with phase("diff"):
+                    entry = chain.capture(self.db_path)
+            else:
+                logger.warning("Other connections keep the WAL from being checkpointed; hashing a copy of the database instead of its file.")
+                chain.directory.mkdir(exist_ok=True)
+                image = chain.directory / SCRATCH_FILE
+                try:
+                    with phase("copy"):
+                        self._copy_to(image)
+                    with phase("diff"):
+                        entry = chain.capture(image)
+                finally:
+                    image.unlink(missing_ok=True)
+        finally:
+            conn.close()
+        count("changed_pages", entry["changed_pages"])
+        logger.info(f"Snapshot {entry['file']}: {entry['changed_pages']} of {entry['page_count']} pages changed.")
+        return chain.directory / entry["file"]
+
+    def restore(self, backup_file: str, until: datetime = None):
+        """
+        Rebuild the backup (plus its incremental snapshots up to `until`) in a scratch file
+        next to the database, check it, then copy it into the database with the online
+        backup API, so open connections see the new contents instead of a replaced file.
+        """
+        backup_file = Path(backup_file)
+        if not backup_file.is_file():
+            raise FileNotFoundError(f"Backup file '{backup_file}' does not exist.")
+        chain = PageChain(backup_file)
+        if until and not chain.meta:
+            raise ValueError("Point-in-time restore needs a SQLite backup with incremental snapshots.")
+        self.db_path.resolve().parent.mkdir(parents=True, exist_ok=True)
+        image = partial_path(self.db_path.with_name(f"{self.db_path.name}.restore"))
+        try:
+            compression = detect_compression(backup_file)
+            with phase("decompress" if compression else "copy"):
+                if compression:
+                    processes = run_pipeline([compression.decompress_command()], input_path=str(backup_file), output_path=str(image), logger=logger)
+                    check_pipeline(processes, "Restore")
+                else:
+                    shutil.copyfile(backup_file, image)
+
+            if chain.deltas(until):
+                with phase("apply"):
+                    applied = chain.apply(image, until)
+                logger.info(f"Applied {applied} incremental snapshot(s) of '{backup_file.name}'.")
+
+            source = sqlite3.connect(image)
+            try:
+                result = source.execute("PRAGMA quick_check").fetchone()[0]
+                if result != "ok":
+                    raise Exception(f"The restored database failed its integrity check: {result}")
+                target = self._connect()
+                try:
+                    with phase("restore"):
+                        self._step_copy(source, target, "restore")
+                finally:
+                    target.close()
+            finally:
+                source.close()
+        finally:
+            image.unlink(missing_ok=True)
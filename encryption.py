@@ -0,0 +1,223 @@
+import hashlib
+import os
+import secrets
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from logger import setup_logger
+from metrics import count
+
+logger = setup_logger("encryption")
+
+ENCRYPTED_EXTENSION = ".enc"
+PASSPHRASE_ENV = "BACKUP_PASSPHRASE"
+MAGIC = b"DBUAEAD1"
+# Plaintext bytes per chunk. Every chunk is sealed on its own, so chunks are encrypted and
+# decrypted on a thread pool and a reader never holds more than a few of them.
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+# scrypt cost of deriving the key from the passphrase (32 MiB of memory, ~0.1s), once per backup
+SCRYPT_LOG_N, SCRYPT_R, SCRYPT_P = 15, 8, 1
+SCRYPT_MAXMEM = 128 * 1024 * 1024
+# magic, scrypt log2(N), r, p, chunk size, salt, nonce prefix
+HEADER = struct.Struct(">8sBBBI16s7s")
+
+
+def load_passphrase(passphrase_file: str = None):
+    """
+    The encryption passphrase, from --passphrase-file or $BACKUP_PASSPHRASE.
+    """
+    if passphrase_file:
+        passphrase = Path(passphrase_file).read_text().rstrip("\r\n")
+    else:
+        passphrase = os.environ.get(PASSPHRASE_ENV, "")
+    if not passphrase:
+        raise ValueError(f"Encrypted backups need a passphrase. Set ${PASSPHRASE_ENV} or use --passphrase-file.")
+    return passphrase
+
+
+def is_encrypted(path):
+    return str(path).lower().endswith(ENCRYPTED_EXTENSION)
+
+
+def plain_name(path):
+    """
+    Name of a backup without the encryption extension, e.g. name.dump.zst for name.dump.zst.enc.
+    """
+    name = Path(str(path)).name
+    return name[:-len(ENCRYPTED_EXTENSION)] if is_encrypted(name) else name
+
+
+def _cipher(key: bytes):
+    # cryptography is only needed by encrypted backups
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise Exception("Encrypted backups need cryptography. Install it with: pip install cryptography")
+    return AESGCM(key)
+
+
+def _nonce(prefix: bytes, index: int, last: bool):
+    # The chunk number and a last-chunk flag are part of the nonce, so chunks cannot be
+    # reordered, dropped or cut off at the end without failing authentication
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+def _derive_key(passphrase: str, salt: bytes, log_n: int, r: int, p: int):
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=1 << log_n, r=r, p=p, maxmem=SCRYPT_MAXMEM, dklen=32)
+
+
+class Encryption:
+    """
+    Authenticated encryption of a backup stream with AES-256-GCM.
+
+    The stream is cut into CHUNK_SIZE chunks, each sealed with its own nonce and with the
+    file header as associated data. The key is derived from the passphrase with scrypt and a
+    random salt per backup, and the header stores the salt and scrypt cost, so the passphrase
+    is all a restore needs.
+    """
+
+    def __init__(self, passphrase: str, jobs: int = None, chunk_size: int = CHUNK_SIZE):
+        self.passphrase = passphrase
+        self.jobs = jobs or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def writer(self, writer):
+        """
+        Sink that encrypts what is written to it into `writer`.
+        """
+        return EncryptingWriter(writer, self.passphrase, jobs=self.jobs, chunk_size=self.chunk_size)
+
+    def decrypt(self, blocks, name: str = "backup"):
+        """
+        Yield the plaintext of an encrypted stream given as an iterable of bytes, in order,
+        decrypting up to `jobs` chunks at once.
+        """
+        buffer = bytearray()
+        blocks = iter(blocks)
+        for block in blocks:
+            buffer += block
+            if len(buffer) >= HEADER.size:
+                break
+        if len(buffer) < HEADER.size:
+            raise ValueError(f"'{name}' is too short to be an encrypted backup.")
+        header = bytes(buffer[:HEADER.size])
+        del buffer[:HEADER.size]
+        magic, log_n, r, p, chunk_size, salt, prefix = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"'{name}' is not an encrypted backup of this utility.")
+        aead = _cipher(_derive_key(self.passphrase, salt, log_n, r, p))
+        frame_size = chunk_size + TAG_SIZE
+
+        def open_chunk(index: int, frame: bytes, last: bool):
+            try:
+                return aead.decrypt(_nonce(prefix, index, last), frame, header)
+            except Exception:
+                raise ValueError(f"Could not decrypt chunk {index} of '{name}': wrong passphrase, or the backup was modified or truncated.")
+
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="decrypt") as executor:
+            pending = deque()
+            index = 0
+            for block in blocks:
+                buffer += block
+                # Only a full frame is ever followed by another one; the last chunk is shorter
+                while len(buffer) > frame_size:
+                    if len(pending) >= self.jobs * 2:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(open_chunk, index, bytes(buffer[:frame_size]), False))
+                    del buffer[:frame_size]
+                    index += 1
+            if len(buffer) == frame_size:
+                pending.append(executor.submit(open_chunk, index, bytes(buffer), False))
+                buffer.clear()
+                index += 1
+            if len(buffer) < TAG_SIZE:
+                raise ValueError(f"'{name}' is truncated: its last chunk is missing.")
+            pending.append(executor.submit(open_chunk, index, bytes(buffer), True))
+            while pending:
+                yield pending.popleft().result()
+        count("chunks_decrypted", index + 1)
+
+
+class EncryptingWriter:
+    """
+    Sink that encrypts a stream chunk by chunk on a thread pool while it is produced and
+    writes the sealed chunks, in order, to another sink (a storage writer). At most two
+    chunks per thread are in flight, so a slow pool slows the dump down instead of buffering.
+    The sink's size and checksum are those of the encrypted file.
+    """
+
+    def __init__(self, writer, passphrase: str, jobs: int, chunk_size: int = CHUNK_SIZE):
+        self.writer = writer
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        salt = secrets.token_bytes(16)
+        self.prefix = secrets.token_bytes(7)
+        self.header = HEADER.pack(MAGIC, SCRYPT_LOG_N, SCRYPT_R, SCRYPT_P, chunk_size, salt, self.prefix)
+        self.aead = _cipher(_derive_key(passphrase, salt, SCRYPT_LOG_N, SCRYPT_R, SCRYPT_P))
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="encrypt")
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.chunks = 0
+        self.writer.write(self.header)
+
+    @property
+    def size(self):
+        return self.writer.size
+
+    @property
+    def checksum(self):
+        return self.writer.checksum
+
+    def _seal(self, index: int, data: bytes, last: bool):
+        return self.aead.encrypt(_nonce(self.prefix, index, last), data, self.header)
+
+    def _submit(self, data: bytes, last: bool = False):
+        if len(self.pending) >= self.jobs * 2:
+            self.writer.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self._seal, self.chunks, data, last))
+        self.chunks += 1
+
+    def write(self, data: bytes):
+        self.buffer += data
+        # A full chunk is only sealed once more data follows, so the last chunk is always short
+        while len(self.buffer) > self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            self._submit(chunk)
+
+    def commit(self):
+        if len(self.buffer) == self.chunk_size:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        self._submit(bytes(self.buffer), last=True)
+        self.buffer.clear()
+        while self.pending:
+            self.writer.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        count("chunks_encrypted", self.chunks)
+        logger.info(f"Encrypted the backup with AES-256-GCM in {self.chunks} chunk(s).")
+        return self.writer.commit()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.writer.abort()
+
+
+def check_encrypted_layout(path: Path):
+    """
+    Structure check of an encrypted backup that needs no passphrase: the header is ours and
+    the file splits into whole chunks. Returns 0, as it hashes nothing.
+    """
+    size = path.stat().st_size
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path.name}: not an encrypted backup of this utility.")
+    chunk_size = HEADER.unpack(header)[4]
+    frame_size = chunk_size + TAG_SIZE
+    # Every chunk but the last is a full frame, and the shorter last one holds at least its tag
+    if size < HEADER.size or (size - HEADER.size) % frame_size < TAG_SIZE:
+        raise ValueError(f"{path.name}: truncated encrypted chunk at the end.")
+    return 0
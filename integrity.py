@@ -0,0 +1,456 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from logger import setup_logger
+from checkpoint import atomic_write_text
+from chunk_store import ChunkStore
+from compression import detect_compression
+from encryption import is_encrypted, check_encrypted_layout
+from pipeline import run_pipeline, check_pipeline
+
+try:
+    import blake3
+except ImportError:
+    # BLAKE2b from hashlib is the fallback; blake3 is several times faster on large files
+    blake3 = None
+
+logger = setup_logger("integrity")
+
+CHECKSUM_ALGORITHM = "blake3" if blake3 else "blake2b"
+# Written next to every local backup artifact: <artifact>.checksum.json
+SIDECAR_SUFFIX = ".checksum.json"
+# Files that change after a backup is taken and are therefore not checksummed
+MUTABLE_FILES = ("backup_meta.json",)
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PGCOPY_TRAILER = b"\xff\xff"
+MONGO_ARCHIVE_MAGIC = struct.pack("<I", 0x8199E26D)
+SQL_DUMP_FOOTER = b"PostgreSQL database dump complete"
+SQLITE_HEADER = b"SQLite format 3\x00"
+SQLITE_DELTA_MAGIC = b"SQLPGDL1"
+
+
+def new_hasher(algorithm: str = CHECKSUM_ALGORITHM):
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise Exception("This checksum was made with BLAKE3. Install it with: pip install blake3")
+        return blake3.blake3()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(f"Unsupported checksum algorithm '{algorithm}'.")
+
+
+def format_checksum(algorithm: str, hexdigest: str):
+    return f"{algorithm}:{hexdigest}"
+
+
+def parse_checksum(checksum: str):
+    """
+    (algorithm, hex digest). Checksums recorded before algorithms were named are BLAKE2b.
+    """
+    algorithm, _, hexdigest = checksum.rpartition(":")
+    return algorithm or "blake2b", hexdigest
+
+
+class HashingWriter:
+    """
+    File wrapper that checksums everything written through it, so an artifact is hashed
+    while it is produced instead of being read back afterwards.
+    """
+
+    def __init__(self, file, algorithm: str = CHECKSUM_ALGORITHM):
+        self.file = file
+        self.algorithm = algorithm
+        self.hasher = new_hasher(algorithm)
+        self.size = 0
+
+    @property
+    def checksum(self):
+        return format_checksum(self.algorithm, self.hasher.hexdigest())
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+
+def hash_file(path: Path, algorithm: str = CHECKSUM_ALGORITHM):
+    """
+    (checksum, size) of a file read through a memory map. The hashers release the GIL while
+    they work, so files hashed on a thread pool are hashed in parallel.
+    """
+    hasher = new_hasher(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                for offset in range(0, size, HASH_BLOCK_SIZE):
+                    hasher.update(view[offset:offset + HASH_BLOCK_SIZE])
+    return format_checksum(algorithm, hasher.hexdigest()), size
+
+
+def combine_checksums(files: dict, algorithm: str = CHECKSUM_ALGORITHM):
+    """
+    Checksum of a directory: the hash of its sorted file names and file checksums.
+    """
+    hasher = new_hasher(algorithm)
+    for name in sorted(files):
+        hasher.update(f"{name}\0{files[name]['checksum']}\n".encode())
+    return format_checksum(algorithm, hasher.hexdigest())
+
+
+def sidecar_path(artifact):
+    artifact = Path(artifact)
+    return artifact.with_name(f"{artifact.name}{SIDECAR_SUFFIX}")
+
+
+def sidecar_manifest(name: str, files: dict, directory: bool = False, algorithm: str = CHECKSUM_ALGORITHM):
+    """
+    Sidecar contents for an artifact. `files` maps each file (relative to a directory
+    artifact, or the artifact's own name) to its size and checksum.
+    """
+    return {
+        "artifact": name,
+        "type": "directory" if directory else "file",
+        "algorithm": algorithm,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "size": sum(entry["size"] for entry in files.values()),
+        "checksum": combine_checksums(files, algorithm) if directory else next(iter(files.values()))["checksum"],
+        "files": files,
+    }
+
+
+def read_sidecar(artifact):
+    path = sidecar_path(artifact)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def _tree_files(directory: Path):
+    return sorted(
+        f for f in directory.rglob("*")
+        if f.is_file() and f.name not in MUTABLE_FILES
+    )
+
+
+def record_checksums(artifact, known: dict = None, jobs: int = None):
+    """
+    Write the sidecar of a finished local artifact and return it. Checksums in `known`
+    (relative path -> size and checksum) were computed while the files were written; the
+    rest, written by pg_dump or mongodump themselves, are hashed here on a thread pool.
+    """
+    artifact = Path(artifact)
+    known = dict(known or {})
+    if artifact.is_dir():
+        pending = [f for f in _tree_files(artifact) if str(f.relative_to(artifact)) not in known]
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count(), thread_name_prefix="checksum") as executor:
+            for path, (checksum, size) in zip(pending, executor.map(hash_file, pending)):
+                known[str(path.relative_to(artifact))] = {"size": size, "checksum": checksum}
+        manifest = sidecar_manifest(artifact.name, known, directory=True)
+    else:
+        if artifact.name not in known:
+            checksum, size = hash_file(artifact)
+            known[artifact.name] = {"size": size, "checksum": checksum}
+        manifest = sidecar_manifest(artifact.name, known)
+    atomic_write_text(sidecar_path(artifact), json.dumps(manifest, indent=2))
+    return manifest
+
+
+def add_to_sidecar(artifact, name: str, size: int, checksum: str):
+    """
+    Add a file written into a directory artifact after it was taken, such as an incremental delta.
+    """
+    manifest = read_sidecar(artifact)
+    if manifest is None:
+        return
+    manifest["files"][name] = {"size": size, "checksum": checksum}
+    manifest["size"] = sum(entry["size"] for entry in manifest["files"].values())
+    manifest["checksum"] = combine_checksums(manifest["files"], manifest["algorithm"])
+    atomic_write_text(sidecar_path(artifact), json.dumps(manifest, indent=2))
+
+
+## VERIFICATION
+class VerifyResult:
+    def __init__(self, path):
+        self.path = str(path)
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def _check_file(path: Path, expected: dict, algorithm: str):
+    if not path.exists():
+        raise FileNotFoundError(f"{path.name} is missing.")
+    if path.stat().st_size != expected["size"]:
+        raise ValueError(f"{path.name} is {path.stat().st_size} bytes, expected {expected['size']}.")
+    checksum, size = hash_file(path, algorithm)
+    if checksum != expected["checksum"]:
+        raise ValueError(f"{path.name} does not match its checksum.")
+    return size
+
+
+def _check_chunk(store, digest: str):
+    # get_chunk raises on a missing or corrupt chunk
+    return len(store.get_chunk(digest))
+
+
+def _check_remote(storage, key: str):
+    """
+    Stream an object from its storage backend and compare it with its sidecar object.
+    """
+    manifest = json.loads(b"".join(storage.reader(f"{key}{SIDECAR_SUFFIX}")))
+    hasher = new_hasher(manifest["algorithm"])
+    size = 0
+    for block in storage.reader(key):
+        hasher.update(block)
+        size += len(block)
+    if format_checksum(manifest["algorithm"], hasher.hexdigest()) != manifest["checksum"]:
+        raise ValueError(f"{key} does not match its checksum.")
+    return size
+
+
+def _pg_restore_list(path: Path):
+    """
+    Read the archive's table of contents, which fails on a truncated or corrupt custom or directory archive.
+    """
+    from shutil import which
+    pg_restore = which("pg_restore")
+    if not pg_restore:
+        raise FileNotFoundError("pg_restore not found. Structure checks of Postgres archives need it in your PATH.")
+    compression = detect_compression(path)
+    if compression:
+        results = run_pipeline([compression.decompress_command(), [pg_restore, "--list"]], input_path=str(path), output_path=os.devnull, logger=logger)
+    else:
+        results = run_pipeline([[pg_restore, "--list", str(path)]], output_path=os.devnull, logger=logger)
+    check_pipeline(results, "Structure check")
+    return 0
+
+
+class _HeadTail:
+    """
+    Sink that keeps only the first and last bytes of a stream.
+    """
+
+    def __init__(self, keep: int = 4096):
+        self.keep = keep
+        self.head = b""
+        self.tail = b""
+
+    def write(self, data: bytes):
+        if len(self.head) < self.keep:
+            self.head += data[:self.keep - len(self.head)]
+        self.tail = (self.tail + data)[-self.keep:]
+
+
+def _head_tail(path: Path):
+    compression = detect_compression(path)
+    if compression:
+        # Decompressing the whole stream also checks the compressed framing
+        sink = _HeadTail()
+        check_pipeline(run_pipeline([compression.decompress_command()], input_path=str(path), sink=sink, logger=logger), "Structure check")
+        return sink.head, sink.tail
+    with open(path, "rb") as f:
+        head = f.read(4096)
+        f.seek(max(os.fstat(f.fileno()).st_size - 4096, 0))
+        return head, f.read()
+
+
+def _check_sql(path: Path):
+    _, tail = _head_tail(path)
+    if SQL_DUMP_FOOTER not in tail:
+        raise ValueError(f"{path.name} does not end with pg_dump's completion marker; it is probably truncated.")
+    return 0
+
+
+def _check_mongo_archive(path: Path):
+    head, _ = _head_tail(path)
+    if not head.startswith(MONGO_ARCHIVE_MAGIC):
+        raise ValueError(f"{path.name} does not start with the mongodump archive header.")
+    return 0
+
+
+def _check_sqlite(path: Path):
+    head, _ = _head_tail(path)
+    if not head.startswith(SQLITE_HEADER):
+        raise ValueError(f"{path.name} does not start with the SQLite database header.")
+    return 0
+
+
+def _check_sqlite_delta(path: Path):
+    with open(path, "rb") as f:
+        if f.read(len(SQLITE_DELTA_MAGIC)) != SQLITE_DELTA_MAGIC:
+            raise ValueError(f"{path.name} is not a SQLite page delta.")
+    return 0
+
+
+def _check_tsv(path: Path, columns: int):
+    """
+    LOAD DATA text of a native MySQL backup: whole lines of `columns` tab-separated fields.
+    """
+    head, tail = _head_tail(path)
+    if tail and not tail.endswith(b"\n"):
+        raise ValueError(f"{path.name} ends in the middle of a row; it is probably truncated.")
+    if b"\n" in head and head.split(b"\n", 1)[0].count(b"\t") != columns - 1:
+        raise ValueError(f"{path.name} does not hold rows of {columns} columns.")
+    return 0
+
+
+def _check_json(path: Path):
+    json.loads(path.read_text())
+    return 0
+
+
+def _check_pgcopy(path: Path):
+    with open(path, "rb") as f:
+        if f.read(len(PGCOPY_SIGNATURE)) != PGCOPY_SIGNATURE:
+            raise ValueError(f"{path.name} is not a binary COPY file.")
+        f.seek(-len(PGCOPY_TRAILER), os.SEEK_END)
+        if f.read() != PGCOPY_TRAILER:
+            raise ValueError(f"{path.name} is missing the binary COPY trailer; it is probably truncated.")
+    return 0
+
+
+def _check_bson(path: Path):
+    """
+    Walk a .bson file's length prefixes without decoding any document.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset < size:
+                if offset + 4 > size:
+                    raise ValueError(f"{path.name}: truncated document at offset {offset}.")
+                (length,) = struct.unpack_from("<i", mm, offset)
+                if length < 5 or offset + length > size or mm[offset + length - 1] != 0:
+                    raise ValueError(f"{path.name}: corrupt document of length {length} at offset {offset}.")
+                offset += length
+    return 0
+
+
+def _structure_checks(artifact: Path):
+    """
+    Format checks for an artifact, chosen from its layout and name.
+    """
+    if artifact.is_dir():
+        if (artifact / "toc.dat").exists():
+            return [lambda: _pg_restore_list(artifact)]
+        manifest_path = artifact / "manifest.json"
+        if manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text())
+            if manifest.get("db_type") == "mysql":
+                return [
+                    (lambda f=f, n=len(table["columns"]): _check_tsv(artifact / "data" / f, n))
+                    for table in manifest["tables"] for f in table["files"]
+                ]
+            checks = [lambda: _pg_restore_list(artifact / manifest["schema"])]
+            for table in manifest["tables"]:
+                checks.extend((lambda f=f: _check_pgcopy(artifact / "data" / f)) for f in table["files"])
+            return checks
+        checks = [(lambda f=f: _check_bson(f)) for f in artifact.rglob("*.bson")]
+        checks.extend((lambda f=f: _check_json(f)) for f in artifact.rglob("*.metadata.json"))
+        return checks
+    if is_encrypted(artifact):
+        # The contents need the passphrase; only the chunk layout can be checked
+        return [lambda: check_encrypted_layout(artifact)]
+    compression = detect_compression(artifact)
+    name = artifact.name[:-len(compression.extension)] if compression else artifact.name
+    if name.endswith(".dump"):
+        return [lambda: _pg_restore_list(artifact)]
+    if name.endswith(".sql"):
+        return [lambda: _check_sql(artifact)]
+    if name.endswith(".archive"):
+        return [lambda: _check_mongo_archive(artifact)]
+    if name.endswith(".db"):
+        return [lambda: _check_sqlite(artifact)]
+    if name.endswith(".pages"):
+        return [lambda: _check_sqlite_delta(artifact)]
+    return []
+
+
+def _checks(location: str, structure: bool):
+    """
+    Independent checks of one artifact, each a callable that raises on failure and returns
+    the number of bytes it hashed.
+    """
+    # storage computes its checksums with this module, so it is imported here
+    from storage import is_storage_url, split_location
+    if is_storage_url(location):
+        storage, key = split_location(location)
+        return [lambda: _check_remote(storage, key)]
+
+    artifact = Path(location)
+    if artifact.suffix == ".json" and artifact.parent.name == "snapshots":
+        store = ChunkStore(artifact.parent.parent)
+        manifest = store.load_manifest(artifact.stem)
+        return [(lambda d=d: _check_chunk(store, d)) for d in dict.fromkeys(manifest["chunks"])]
+
+    if not artifact.exists():
+        raise FileNotFoundError(f"'{artifact}' does not exist.")
+    manifest = read_sidecar(artifact)
+    if manifest is None:
+        raise FileNotFoundError(f"'{artifact}' has no {SIDECAR_SUFFIX} sidecar to verify against.")
+
+    algorithm = manifest["algorithm"]
+    if manifest["type"] == "directory":
+        checks = [(lambda n=n, e=e: _check_file(artifact / n, e, algorithm)) for n, e in manifest["files"].items()]
+        unexpected = {str(f.relative_to(artifact)) for f in _tree_files(artifact)} - set(manifest["files"])
+        if unexpected:
+            raise ValueError(f"Files not covered by the checksums: {', '.join(sorted(unexpected))}.")
+    else:
+        checks = [lambda: _check_file(artifact, manifest["files"][artifact.name], algorithm)]
+    if structure:
+        checks.extend(_structure_checks(artifact))
+    return checks
+
+
+def verify_artifacts(locations: list, jobs: int = None, structure: bool = False):
+    """
+    Verify backups against their checksums, and optionally their format, on one thread pool
+    shared by every file of every artifact. Returns one VerifyResult per artifact, in order.
+    """
+    results = [VerifyResult(location) for location in locations]
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count(), thread_name_prefix="verify") as executor:
+        futures = []
+        for result in results:
+            try:
+                checks = _checks(result.path, structure)
+            except Exception as e:
+                result.errors.append(str(e))
+                continue
+            futures.extend((result, executor.submit(check)) for check in checks)
+        for result, future in futures:
+            try:
+                checked = future.result()
+                result.files += 1
+                result.bytes += checked
+            except Exception as e:
+                result.errors.append(str(e))
+    return results
+
+
+def format_verification(results: list, elapsed: float):
+    lines = []
+    for r in results:
+        status = "ok" if r.ok else "FAILED"
+        lines.append(f"{status:6}  {r.bytes / (1024 * 1024):10.1f} MB  {r.path}")
+        lines.extend(f"        - {error}" for error in r.errors)
+    failed = sum(1 for r in results if not r.ok)
+    total = sum(r.bytes for r in results)
+    elapsed = max(elapsed, 1e-6)
+    lines.append(f"{len(results) - failed}/{len(results)} verified, {total / (1024 * 1024):.1f} MB hashed in {elapsed:.1f}s ({total / elapsed / (1024 * 1024):.1f} MB/s).")
+    return "\n".join(lines)
@@ -1,24 +1,35 @@
 import logging
 from pathlib import Path
 
+
+class LazyFileHandler(logging.FileHandler):
+    """
+    File handler that creates the log directory and opens the file on the first record,
+    so importing a module that sets up a logger touches no files.
+    """
+
+    def __init__(self, log_path: Path):
+        super().__init__(log_path, delay=True)
+
+    def _open(self):
+        Path(self.baseFilename).parent.mkdir(parents=True, exist_ok=True)
+        return super()._open()
+
+
 def setup_logger(name: str, log_file: str = "backup.log", level=logging.INFO):
-    logs_dir = Path("logs")
-    logs_dir.mkdir(exist_ok=True)
-    log_path = logs_dir / log_file
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if logger.handlers:
+        return logger
 
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-    file_handler = logging.FileHandler(log_path)
+    file_handler = LazyFileHandler(Path("logs") / log_file)
     file_handler.setFormatter(formatter)
 
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-
-    if not logger.handlers:
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
-
+    logger.addHandler(file_handler)
+    logger.addHandler(stream_handler)
     return logger
@@ -0,0 +1,228 @@
+import contextvars
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from logger import setup_logger
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; resource figures are left out there
+    resource = None
+
+logger = setup_logger("metrics")
+
+# Used when a run is not given a sink explicitly, e.g. jsonl:/var/log/db-backup/metrics.jsonl
+DEFAULT_METRICS_SINK = os.environ.get("BACKUP_METRICS")
+PROMETHEUS_PREFIX = "db_backup"
+
+# The run being measured in this thread, so handlers can record phases without passing it around
+_current_run = contextvars.ContextVar("current_run", default=None)
+
+
+def _usage():
+    """
+    (cpu seconds, peak RSS bytes) for this process and for its waited-for children.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu": own.ru_utime + own.ru_stime,
+        "rss": own.ru_maxrss * scale,
+        "child_cpu": children.ru_utime + children.ru_stime,
+        "child_rss": children.ru_maxrss * scale,
+    }
+
+
+class RunMetrics:
+    """
+    Measurements of one backup or restore: wall time per phase, data volume and resource use.
+
+    CPU time is the difference of getrusage() between start and finish, so when several runs
+    share the process (backup-many, the scheduler) the CPU and child CPU figures include the
+    work of runs that overlapped with this one. Peak RSS is the process-wide high-water mark.
+    """
+
+    def __init__(self, operation: str, db_type: str, db_name: str):
+        self.operation = operation
+        self.db_type = db_type
+        self.db_name = db_name
+        self.phases = {}
+        self.counters = {"bytes": 0, "rows": 0, "documents": 0}
+        self.status = "running"
+        self.error = None
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._start_usage = _usage()
+        self.duration = 0.0
+        self.usage = {}
+
+    def add_phase(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, error: Exception = None):
+        self.duration = time.perf_counter() - self._start
+        self.status = "failed" if error else "ok"
+        self.error = str(error) if error else None
+        end_usage = _usage()
+        if end_usage:
+            self.usage = {
+                "cpu_seconds": round(end_usage["cpu"] - self._start_usage["cpu"], 3),
+                "child_cpu_seconds": round(end_usage["child_cpu"] - self._start_usage["child_cpu"], 3),
+                "peak_rss_bytes": end_usage["rss"],
+                "child_peak_rss_bytes": end_usage["child_rss"],
+            }
+
+    def to_dict(self):
+        duration = max(self.duration, 1e-9)
+        return {
+            "timestamp": self.started_at.isoformat(timespec="seconds"),
+            "operation": self.operation,
+            "db_type": self.db_type,
+            "db_name": self.db_name,
+            "status": self.status,
+            "error": self.error,
+            "duration_seconds": round(self.duration, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            **self.counters,
+            "mb_per_second": round(self.counters["bytes"] / duration / (1024 * 1024), 3),
+            "rows_per_second": round(self.counters["rows"] / duration, 1),
+            "documents_per_second": round(self.counters["documents"] / duration, 1),
+            **self.usage,
+        }
+
+
+class JsonLinesSink:
+    """
+    Append one JSON object per run to a file.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def emit(self, run: RunMetrics):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(run.to_dict()) + "\n")
+
+
+class PrometheusTextfileSink:
+    """
+    Write the latest run of each operation and database as a .prom file for the node_exporter
+    textfile collector. Files are replaced atomically so the collector never reads half a file.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def _lines(self, run: RunMetrics):
+        record = run.to_dict()
+        labels = f'operation="{run.operation}",db_type="{run.db_type}",db_name="{self._escape(run.db_name)}"'
+        gauges = [
+            ("success", "1 if the last run succeeded", 1 if run.status == "ok" else 0),
+            ("last_run_timestamp_seconds", "Start of the last run", int(run.started_at.timestamp())),
+            ("duration_seconds", "Wall time of the last run", record["duration_seconds"]),
+            ("bytes", "Bytes written or read by the last run", record["bytes"]),
+            ("rows", "Rows copied by the last run", record["rows"]),
+            ("documents", "Documents copied by the last run", record["documents"]),
+        ]
+        for key in ("cpu_seconds", "child_cpu_seconds", "peak_rss_bytes", "child_peak_rss_bytes"):
+            if key in record:
+                gauges.append((key, f"{key.replace('_', ' ').capitalize()} of the last run", record[key]))
+
+        lines = []
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{labels}}} {value}")
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_phase_seconds Wall time per phase of the last run")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_phase_seconds gauge")
+        for phase_name, seconds in record["phases"].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_phase_seconds{{{labels},phase="{phase_name}"}} {seconds}')
+        return lines
+
+    def emit(self, run: RunMetrics):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", run.db_name)
+        path = self.directory / f"{PROMETHEUS_PREFIX}_{run.operation}_{run.db_type}_{safe_name}.prom"
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text("\n".join(self._lines(run)) + "\n")
+        os.replace(tmp_path, path)
+
+
+def open_sink(spec: str):
+    """
+    Metrics sink for `jsonl:PATH` or `prometheus:DIRECTORY`.
+    """
+    kind, separator, target = spec.partition(":")
+    if not separator or not target:
+        raise ValueError(f"Invalid metrics sink '{spec}'. Use jsonl:PATH or prometheus:DIRECTORY.")
+    if kind == "jsonl":
+        return JsonLinesSink(target)
+    if kind in ("prometheus", "prom"):
+        return PrometheusTextfileSink(target)
+    raise ValueError(f"Unsupported metrics sink '{kind}'. Use jsonl or prometheus.")
+
+
+@contextmanager
+def track_run(operation: str, db_type: str, db_name: str, sink: str = None):
+    """
+    Measure a backup or restore run and emit it to the metrics sink, whether it succeeds or fails.
+    """
+    spec = sink or DEFAULT_METRICS_SINK
+    target = open_sink(spec) if spec else None
+    run = RunMetrics(operation, db_type, db_name)
+    token = _current_run.set(run)
+    error = None
+    try:
+        yield run
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _current_run.reset(token)
+        run.finish(error)
+        if target:
+            try:
+                target.emit(run)
+            except Exception as e:
+                logger.warning(f"Could not write metrics to {spec}: {e}")
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Add the wall time of the enclosed block to a phase of the current run, if one is tracked.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run = _current_run.get()
+        if run is not None:
+            run.add_phase(name, time.perf_counter() - start)
+
+
+def count(name: str, value: int):
+    """
+    Add to a counter (bytes, rows, documents) of the current run, if one is tracked.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.count(name, value)
@@ -0,0 +1,194 @@
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from urllib.parse import urlparse
+from logger import setup_logger
+from catalog import artifact_size
+import db_handlers.init as handlers
+
+logger = setup_logger("orchestrator")
+
+URL_SCHEMES = {
+    "postgres": "postgres",
+    "postgresql": "postgres",
+    "mongodb": "mongodb",
+    "mongodb+srv": "mongodb",
+    "sqlite": "sqlite",
+    "mysql": "mysql",
+    "mariadb": "mysql",
+}
+
+# Options a target may set; anything missing falls back to the command-line defaults
+TARGET_OPTIONS = ["database_url", "host", "port", "user", "password", "db_name", "collection_name", "format", "jobs", "compress", "repo", "output", "engine", "batch_size", "storage", "metrics", "resume", "include_tables", "exclude_tables", "schemas", "exclude_table_data", "max_rate", "io_priority", "adaptive", "pages", "sleep", "compact"]
+
+
+class BackupTarget:
+    def __init__(self, db_type: str = None, name: str = None, **options):
+        unknown = set(options) - set(TARGET_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown target option(s): {', '.join(sorted(unknown))}.")
+
+        self.options = options
+        database_url = options.get("database_url")
+        if not db_type and database_url:
+            db_type = URL_SCHEMES.get(urlparse(database_url).scheme)
+        if db_type not in ("postgres", "mongodb", "sqlite", "mysql"):
+            raise ValueError(f"Unsupported or missing db_type '{db_type}' for target {name or database_url}. Use postgres, mongodb, sqlite or mysql.")
+        self.db_type = db_type
+
+        parsed = urlparse(database_url) if database_url else None
+        self.host = (parsed.hostname if parsed else options.get("host")) or "localhost"
+        if db_type == "sqlite":
+            db_name = str(handlers.sqlite_path(database_url, options.get("db_name")))
+        else:
+            db_name = parsed.path.lstrip("/") if parsed else options.get("db_name")
+        self.database = f"{self.db_type}:{self.host}/{db_name}"
+        if options.get("collection_name"):
+            db_name = f"{db_name}.{options['collection_name']}"
+        self.name = name or f"{self.db_type}:{self.host}/{db_name}"
+
+
+class TargetResult:
+    def __init__(self, target: BackupTarget):
+        self.target = target
+        self.path = None
+        self.size = 0
+        self.duration = 0.0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def throughput(self):
+        """
+        MB/s of backup output written.
+        """
+        return self.size / self.duration / (1024 * 1024) if self.duration else 0.0
+
+
+def load_targets(config_file: str = None, urls: list = None):
+    """
+    Build targets from a JSON config file and/or a list of database URLs.
+
+    Config file format:
+        {"max_workers": 4, "max_per_host": 2, "targets": [{"database_url": "...", "format": "sql"}, ...]}
+    Returns (targets, settings) where settings holds the optional pool limits from the file.
+    """
+    targets, settings = [], {}
+    if config_file:
+        config = json.loads(Path(config_file).read_text())
+        if isinstance(config, list):
+            config = {"targets": config}
+        settings = {key: config[key] for key in ("max_workers", "max_per_host") if key in config}
+        targets.extend(BackupTarget(**entry) for entry in config.get("targets", []))
+    for url in urls or []:
+        targets.append(BackupTarget(database_url=url))
+    if not targets:
+        raise ValueError("No backup targets given. Use --config and/or --target.")
+    return targets, settings
+
+
+def run_target(target: BackupTarget, defaults: dict):
+    """
+    Back up a single target in the calling thread with the existing handler functions.
+    """
+    options = {**defaults, **target.options}
+    if target.db_type == "postgres":
+        return handlers.backup_postgres_database(
+            db_type=target.db_type, database_url=options.get("database_url"), host=options.get("host", "localhost"),
+            port=options.get("port", 5432), password=options.get("password"), db_name=options.get("db_name"),
+            format=options.get("format", "dump"), user=options.get("user", "postgres"), output=options.get("output"),
+            jobs=options.get("jobs", 1), compress=options.get("compress"), repo=options.get("repo"),
+            engine=options.get("engine", "tool"), storage=options.get("storage"), metrics=options.get("metrics"), resume=options.get("resume", False),
+            include_tables=options.get("include_tables"), exclude_tables=options.get("exclude_tables"),
+            schemas=options.get("schemas"), exclude_table_data=options.get("exclude_table_data"),
+            max_rate=options.get("max_rate"), io_priority=options.get("io_priority"), adaptive=options.get("adaptive", False),
+        )
+    if target.db_type == "sqlite":
+        return handlers.backup_sqlite_database(
+            database_url=options.get("database_url"), db_name=options.get("db_name"), output=options.get("output"),
+            compress=options.get("compress"), repo=options.get("repo"), storage=options.get("storage"),
+            pages=options.get("pages"), sleep=options.get("sleep"), compact=options.get("compact", False), metrics=options.get("metrics"),
+        )
+    if target.db_type == "mysql":
+        return handlers.backup_mysql_database(
+            database_url=options.get("database_url"), host=options.get("host", "localhost"), port=options.get("port"),
+            user=options.get("user"), password=options.get("password"), db_name=options.get("db_name"), output=options.get("output"),
+            jobs=options.get("jobs", 1), compress=options.get("compress"), repo=options.get("repo"), storage=options.get("storage"),
+            resume=options.get("resume", False), metrics=options.get("metrics"),
+        )
+    return handlers.backup_mongo_database(
+        database_url=options.get("database_url"), collection_name=options.get("collection_name"),
+        output=options.get("output"), compress=options.get("compress"), repo=options.get("repo"),
+        engine=options.get("engine", "tool"), jobs=options.get("jobs", 1), batch_size=options.get("batch_size"),
+        storage=options.get("storage"), metrics=options.get("metrics"), resume=options.get("resume", False),
+        max_rate=options.get("max_rate"), io_priority=options.get("io_priority"), adaptive=options.get("adaptive", False),
+    )
+
+
+def run_targets(targets: list, defaults: dict, max_workers: int = 4, max_per_host: int = 2):
+    """
+    Back up all targets through a bounded worker pool, running at most `max_workers`
+    backups overall and at most `max_per_host` against any single host.
+    Returns one TargetResult per target, in input order.
+    """
+    if max_workers <= 0 or max_per_host <= 0:
+        raise ValueError("Worker limits must be positive integers.")
+
+    def worker(result):
+        target = result.target
+        logger.info(f"[{target.name}] Starting backup.")
+        start_time = time.time()
+        try:
+            result.path = run_target(target, defaults)
+            result.size = artifact_size(result.path) if result.path else 0
+        except Exception as e:
+            result.error = str(e)
+            logger.error(f"[{target.name}] Backup failed: {e}")
+        result.duration = time.time() - start_time
+
+    logger.info(f"Backing up {len(targets)} targets with {max_workers} workers, at most {max_per_host} per host.")
+    results = [TargetResult(target) for target in targets]
+    waiting = list(range(len(targets)))
+    running = {}
+    per_host = Counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="backup") as executor:
+        while waiting or running:
+            # A target is only handed to the pool once its host has a free slot, so targets
+            # queued behind a busy host never hold a worker that another host could use
+            for index in list(waiting):
+                if len(running) >= max_workers:
+                    break
+                host = targets[index].host
+                if per_host[host] < max_per_host:
+                    waiting.remove(index)
+                    per_host[host] += 1
+                    running[executor.submit(worker, results[index])] = host
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                per_host[running.pop(future)] -= 1
+                future.result()
+    return results
+
+
+def format_summary(results: list):
+    """
+    Render a per-target summary table plus totals.
+    """
+    width = max([len(r.target.name) for r in results] + [6])
+    lines = [f"{'TARGET'.ljust(width)}  {'STATUS':6}  {'TIME (s)':>9}  {'SIZE (MB)':>10}  {'MB/s':>8}"]
+    for r in results:
+        lines.append(
+            f"{r.target.name.ljust(width)}  {'ok' if r.ok else 'FAILED':6}  {r.duration:9.1f}  "
+            f"{r.size / (1024 * 1024):10.1f}  {r.throughput:8.2f}"
+        )
+    failures = [r for r in results if not r.ok]
+    total_size = sum(r.size for r in results)
+    lines.append(f"{len(results) - len(failures)}/{len(results)} succeeded, {total_size / (1024 * 1024):.1f} MB written.")
+    for r in failures:
+        lines.append(f"FAILED {r.target.name}: {r.error}")
+    return "\n".join(lines)
@@ -0,0 +1,94 @@
+import subprocess
+import threading
+from process_runner import StreamingProcess, ProcessError
+
+# Size of the blocks pumped between Python and the child processes
+BLOCK_SIZE = 1024 * 1024
+
+
+def _feed(source, stream, errors: list):
+    """
+    Write every block produced by `source` into a child's stdin, then close it.
+    """
+    try:
+        with stream:
+            for block in source:
+                stream.write(block)
+    except BrokenPipeError:
+        # The consumer exited early; its exit code tells the real story
+        pass
+    except Exception as e:
+        errors.append(e)
+
+
+def run_pipeline(commands: list, env: dict = None, input_path: str = None, output_path: str = None, logger=None, source=None, sink=None):
+    """
+    Run commands connected stdout -> stdin through OS pipes, like `a | b | c` in a shell.
+
+    `input_path` or `source` (an iterable of bytes) is fed to the first command, and the last
+    command writes to `output_path` or to `sink` (any object with a `write(bytes)` method).
+    Between the commands the data never passes through Python. Returns one StreamingProcess
+    per command, in order.
+    """
+    processes = []
+    feeder = None
+    feed_errors = []
+    stdin = open(input_path, "rb") if input_path else None
+    stdout = open(output_path, "wb") if output_path else None
+
+    try:
+        previous = subprocess.PIPE if source is not None else stdin
+        for index, command in enumerate(commands):
+            is_last = index == len(commands) - 1
+            if is_last:
+                last_stdout = subprocess.PIPE if sink is not None else stdout
+            process = StreamingProcess(
+                command,
+                env=env,
+                stdin=previous,
+                stdout=last_stdout if is_last else subprocess.PIPE,
+                logger=logger,
+            )
+            # Close our copy of the read end so the producer gets SIGPIPE if the consumer dies
+            if previous not in (None, stdin, subprocess.PIPE):
+                previous.close()
+            previous = process.stdout
+            processes.append(process)
+
+        if source is not None:
+            feeder = threading.Thread(target=_feed, args=(source, processes[0].process.stdin, feed_errors), daemon=True)
+            feeder.start()
+
+        if sink is not None:
+            with processes[-1].stdout as stream:
+                while True:
+                    block = stream.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    sink.write(block)
+
+        for process in processes:
+            process.wait()
+        if feeder:
+            feeder.join()
+        if feed_errors:
+            raise feed_errors[0]
+        return processes
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if stdin:
+            stdin.close()
+        if stdout:
+            stdout.close()
+
+
+def check_pipeline(processes: list, action: str):
+    """
+    Raise if any stage of a pipeline failed, naming the failing tool.
+    """
+    for process in processes:
+        if process.returncode != 0:
+            raise ProcessError(action, process)
@@ -0,0 +1,111 @@
+import subprocess
+import threading
+from collections import deque
+from pathlib import Path
+
+# Longest line read from a child pipe in one go; longer lines are split rather than buffered whole
+MAX_LINE_BYTES = 64 * 1024
+# Number of trailing output lines kept for error reports
+TAIL_LINES = 50
+# Commands may be prefixed with these to lower their priority
+PRIORITY_WRAPPERS = ("ionice", "nice")
+
+
+def tool_name(command: list):
+    """
+    Name of the tool a command runs, looking past ionice/nice prefixes.
+    """
+    args = list(command)
+    while args and Path(args[0]).name in PRIORITY_WRAPPERS:
+        args = args[1:]
+        while args and args[0].startswith("-"):
+            args = args[1:]
+    return Path(args[0] if args else command[0]).name
+
+
+class ProcessError(Exception):
+    def __init__(self, action: str, process):
+        self.returncode = process.returncode
+        self.tail = list(process.tail)
+        super().__init__(
+            f"{action} failed in {process.name} (exit code {process.returncode}):\n"
+            f"OUTPUT (last {len(self.tail)} lines):\n{process.tail_text}"
+        )
+
+
+class StreamingProcess:
+    """
+    Run a command and read its stderr (and stdout, unless it is redirected) incrementally
+    on background threads. Each line is forwarded to the logger as it arrives and only the
+    last `tail_lines` lines are kept, so memory stays flat however much the tool prints.
+    """
+
+    def __init__(self, command: list, env: dict = None, stdin=None, stdout=None, logger=None, tail_lines: int = TAIL_LINES):
+        self.args = command
+        self.name = tool_name(command)
+        self.logger = logger
+        self.tail = deque(maxlen=tail_lines)
+
+        # stdout=None means "log it"; anything else (a file or subprocess.PIPE) is passed through
+        log_stdout = stdout is None
+        self.process = subprocess.Popen(
+            command,
+            env=env,
+            stdin=stdin,
+            stdout=subprocess.PIPE if log_stdout else stdout,
+            stderr=subprocess.PIPE,
+        )
+        self.stdout = None if log_stdout else self.process.stdout
+        self._threads = [self._drain(self.process.stderr)]
+        if log_stdout:
+            self._threads.append(self._drain(self.process.stdout))
+
+    def _drain(self, stream):
+        def pump():
+            with stream:
+                while True:
+                    line = stream.readline(MAX_LINE_BYTES)
+                    if not line:
+                        break
+                    text = line.decode(errors="replace").rstrip()
+                    if not text:
+                        continue
+                    self.tail.append(text)
+                    if self.logger:
+                        self.logger.info(f"[{self.name}] {text}")
+
+        thread = threading.Thread(target=pump, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def tail_text(self):
+        return "\n".join(self.tail)
+
+    def poll(self):
+        return self.process.poll()
+
+    def kill(self):
+        self.process.kill()
+
+    def wait(self):
+        self.process.wait()
+        for thread in self._threads:
+            thread.join()
+        return self.process.returncode
+
+
+def run_process(command: list, action: str, env: dict = None, logger=None, check: bool = True):
+    """
+    Run a command to completion while streaming its output to the logger.
+    Raises ProcessError on a non-zero exit code unless `check` is False.
+    """
+    process = StreamingProcess(command, env=env, logger=logger)
+    process.wait()
+    if check and process.returncode != 0:
+        raise ProcessError(action, process)
+    return process
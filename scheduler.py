@@ -0,0 +1,265 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from logger import setup_logger
+from orchestrator import BackupTarget, run_target
+
+logger = setup_logger("scheduler")
+
+CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTH_NAMES = {name: index for index, name in enumerate(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+DAY_NAMES = {name: index for index, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+
+# Longest wait between two wake-ups, so a changed wall clock is noticed eventually
+MAX_SLEEP_SECONDS = 300
+
+
+class CronExpression:
+    """
+    Standard 5-field cron expression: minute hour day-of-month month day-of-week.
+    Supports `*`, lists, ranges, steps, month/day names and the @daily style aliases.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression.strip()
+        fields = CRON_ALIASES.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields: minute hour day month weekday.")
+
+        self.minutes = self._parse_field(fields[0], 0, 59)
+        self.hours = self._parse_field(fields[1], 0, 23)
+        self.days = self._parse_field(fields[2], 1, 31)
+        self.months = self._parse_field(fields[3], 1, 12, MONTH_NAMES)
+        # 7 is an alias for Sunday
+        self.weekdays = {day % 7 for day in self._parse_field(fields[4], 0, 7, DAY_NAMES)}
+        # Restricted means the field leaves days out; */1 or 1-31 restrict nothing, */2 does
+        self.days_restricted = self.days != set(range(1, 32))
+        self.weekdays_restricted = self.weekdays != set(range(7))
+
+    def __str__(self):
+        return self.expression
+
+    def _parse_field(self, field: str, low: int, high: int, names: dict = None):
+        def value(text):
+            text = text.lower()
+            if names and text in names:
+                return names[text]
+            if not text.isdigit():
+                raise ValueError(f"Invalid value '{text}' in cron expression '{self.expression}'.")
+            return int(text)
+
+        values = set()
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            step = value(step) if step else 1
+            if step <= 0:
+                raise ValueError(f"Invalid step in cron expression '{self.expression}'.")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (value(p) for p in part.split("-", 1))
+            else:
+                start = value(part)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high:
+                raise ValueError(f"Field '{field}' is out of range {low}-{high} in cron expression '{self.expression}'.")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        # Like cron: when both day fields are restricted, either one matching is enough
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, moment: datetime):
+        """
+        First fire time strictly after `moment`.
+        """
+        t = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                later = [m for m in self.minutes if m > t.minute]
+                t = t.replace(minute=later[0]) if later else t.replace(minute=0) + timedelta(hours=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression '{self.expression}' never fires.")
+
+
+class ScheduledJob:
+    def __init__(self, cron: str, target: BackupTarget):
+        self.cron = CronExpression(cron)
+        self.target = target
+        self.name = target.name
+        self.running = False
+
+
+def load_jobs(config_file: str):
+    """
+    Build jobs from a JSON file:
+        {"max_workers": 4, "max_per_database": 1, "jobs": [{"cron": "0 2 * * *", "database_url": "..."}, ...]}
+    Each job takes the same options as a backup-many target. Returns (jobs, settings).
+    """
+    config = json.loads(Path(config_file).read_text())
+    settings = {key: config[key] for key in ("max_workers", "max_per_database", "state_file") if key in config}
+    jobs = []
+    for entry in config.get("jobs", []):
+        entry = dict(entry)
+        cron = entry.pop("cron", None)
+        if not cron:
+            raise ValueError(f"Job {entry.get('name') or entry.get('database_url')} has no cron expression.")
+        jobs.append(ScheduledJob(cron, BackupTarget(**entry)))
+    if not jobs:
+        raise ValueError(f"No jobs found in '{config_file}'.")
+    return jobs, settings
+
+
+class Scheduler:
+    """
+    Long-running backup scheduler.
+
+    Next fire times live in a heap, so the loop sleeps exactly until the earliest one is due
+    instead of polling. Due jobs run in-process on a thread pool, limited per database, and the
+    last completed fire time of every job is kept in a state file so missed runs are caught up
+    (once, not once per missed slot) after a restart. Due jobs wait in the scheduler, not in the
+    pool, until their database has a free slot, so a busy database never holds up the others.
+    """
+
+    def __init__(self, jobs: list, defaults: dict = None, max_workers: int = 4, max_per_database: int = 1, state_file: str = None, catch_up: bool = True):
+        if max_workers <= 0 or max_per_database <= 0:
+            raise ValueError("Worker limits must be positive integers.")
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError("Scheduled jobs must have unique names. Set 'name' on jobs that back up the same target.")
+
+        self.jobs = jobs
+        self.defaults = defaults or {}
+        self.max_workers = max_workers
+        self.max_per_database = max_per_database
+        self.state_file = Path(state_file) if state_file else None
+        self.catch_up = catch_up
+        self.state = json.loads(self.state_file.read_text()) if self.state_file and self.state_file.exists() else {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._state_lock = threading.Lock()
+        # Due jobs waiting for a worker or for their database, and what is running per database
+        self._queued = []
+        self._running = Counter()
+        self._active = 0
+        self._slots_lock = threading.Lock()
+        # Set by stop() and by finished jobs, so the loop starts queued jobs right away
+        self._wake = threading.Event()
+
+    def _push(self, fire_at: datetime, job: ScheduledJob):
+        heapq.heappush(self._heap, (fire_at, next(self._counter), job))
+
+    def _seed(self, now: datetime):
+        for job in self.jobs:
+            last_run = self.state.get(job.name)
+            if self.catch_up and last_run:
+                missed = job.cron.next_after(datetime.fromisoformat(last_run))
+                if missed <= now:
+                    # All missed slots collapse into a single run, recorded as happening now
+                    logger.info(f"[{job.name}] Missed run at {missed.isoformat()}, catching up now.")
+                    self._push(now, job)
+                    continue
+            self._push(job.cron.next_after(now), job)
+
+    def _save_state(self, job: ScheduledJob, fire_at: datetime):
+        if not self.state_file:
+            return
+        with self._state_lock:
+            self.state[job.name] = fire_at.isoformat()
+            tmp_path = self.state_file.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self.state, indent=2))
+            os.replace(tmp_path, self.state_file)
+
+    def _run(self, job: ScheduledJob, fire_at: datetime):
+        try:
+            logger.info(f"[{job.name}] Running backup scheduled for {fire_at.isoformat()}.")
+            path = run_target(job.target, self.defaults)
+            logger.info(f"[{job.name}] Backup finished: {path}")
+            self._save_state(job, fire_at)
+        except Exception as e:
+            logger.error(f"[{job.name}] Scheduled backup failed: {e}")
+        finally:
+            with self._slots_lock:
+                self._running[job.target.database] -= 1
+                self._active -= 1
+                job.running = False
+            self._wake.set()
+
+    def _dispatch(self, job: ScheduledJob, fire_at: datetime):
+        if job.running:
+            logger.warning(f"[{job.name}] Previous run is still queued or active, skipping the run scheduled for {fire_at.isoformat()}.")
+            return
+        job.running = True
+        self._queued.append((job, fire_at))
+
+    def _start_ready(self, executor: ThreadPoolExecutor):
+        """
+        Hand queued jobs to the pool, oldest first, while workers are free and their database
+        is below max_per_database.
+        """
+        with self._slots_lock:
+            for entry in list(self._queued):
+                if self._active >= self.max_workers:
+                    break
+                job, fire_at = entry
+                if self._running[job.target.database] < self.max_per_database:
+                    self._queued.remove(entry)
+                    self._running[job.target.database] += 1
+                    self._active += 1
+                    executor.submit(self._run, job, fire_at)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        """
+        Run until stop() is called. Waits for running backups before returning.
+        """
+        self._seed(datetime.now())
+        for fire_at, _, job in sorted(self._heap):
+            logger.info(f"[{job.name}] '{job.cron}' next run at {fire_at.isoformat()}.")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="scheduled") as executor:
+            while not self._stop.is_set():
+                self._start_ready(executor)
+                fire_at, _, job = self._heap[0]
+                delay = (fire_at - datetime.now()).total_seconds()
+                if delay > 0:
+                    self._wake.wait(min(delay, MAX_SLEEP_SECONDS))
+                    self._wake.clear()
+                    continue
+
+                heapq.heappop(self._heap)
+                self._dispatch(job, fire_at)
+                # Coalesce: if we fell behind, the next run is the next slot after now, not after fire_at
+                self._push(job.cron.next_after(max(fire_at, datetime.now())), job)
+        logger.info("Scheduler stopped.")
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+from logger import setup_logger
+from checkpoint import partial_path, atomic_write_text
+from integrity import CHECKSUM_ALGORITHM, SIDECAR_SUFFIX, new_hasher, format_checksum, sidecar_manifest, sidecar_path
+
+logger = setup_logger("storage")
+
+# Upload part / download range size. S3 needs at least 5 MiB for every part but the last.
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# A multipart upload holds at most MAX_PARTS parts and the stream's size is not known up front, so
+# the part size doubles every PARTS_PER_SIZE parts: 16 MiB parts reach ~16 TiB (S3 stops at 5 TiB)
+MAX_PARTS = 10000
+PARTS_PER_SIZE = 1000
+# Parts uploaded (or ranges downloaded) at once; together with the part size this bounds memory use
+DEFAULT_CONCURRENCY = 4
+READ_BLOCK_SIZE = 1024 * 1024
+
+STORAGE_SCHEMES = ("s3", "file")
+
+
+def is_storage_url(path):
+    """
+    True for s3://bucket/key and file:///path locations, False for plain local paths.
+    """
+    return isinstance(path, str) and urlparse(path).scheme in STORAGE_SCHEMES
+
+
+class FilesystemWriter:
+    """
+    Sink that streams into `<path>.partial` and renames it into place on commit, so a
+    half-written backup is never mistaken for a finished one. The stream is checksummed as
+    it is written and the checksum saved in a sidecar next to the backup.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = partial_path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.tmp_path, "wb", buffering=READ_BLOCK_SIZE)
+        self.digest = new_hasher()
+        self.size = 0
+
+    @property
+    def checksum(self):
+        return format_checksum(CHECKSUM_ALGORITHM, self.digest.hexdigest())
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        manifest = sidecar_manifest(self.path.name, {self.path.name: {"size": self.size, "checksum": self.checksum}})
+        atomic_write_text(sidecar_path(self.path), json.dumps(manifest, indent=2))
+        return str(self.path)
+
+    def abort(self):
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+class FilesystemStorage:
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def location(self, key: str):
+        return str(self.root / key)
+
+    def writer(self, key: str):
+        return FilesystemWriter(self.root / key)
+
+    def reader(self, key: str):
+        with open(self.root / key, "rb") as f:
+            while block := f.read(READ_BLOCK_SIZE):
+                yield block
+
+    def size(self, key: str):
+        return (self.root / key).stat().st_size
+
+    def delete(self, key: str):
+        (self.root / key).unlink(missing_ok=True)
+        sidecar_path(self.root / key).unlink(missing_ok=True)
+
+
+class MultipartUploadWriter:
+    """
+    Sink that uploads a stream to S3 as a multipart upload while it is still being produced.
+
+    Data is cut into parts of `part_size`, doubling every PARTS_PER_SIZE parts, that are
+    uploaded by a thread pool. At most `concurrency` parts are in flight; a further write
+    blocks until one finishes, which slows the dump down to the upload speed instead of
+    buffering without bound.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int = DEFAULT_PART_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload")
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.buffer = bytearray()
+        self.futures = []
+        self.error = None
+        self.digest = new_hasher()
+        self.size = 0
+
+    @property
+    def checksum(self):
+        return format_checksum(CHECKSUM_ALGORITHM, self.digest.hexdigest())
+
+    def _upload_part(self, number: int, body: bytes):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body)
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.slots.release()
+
+    def _submit(self, body: bytes):
+        if len(self.futures) >= MAX_PARTS:
+            raise Exception(f"Upload of s3://{self.bucket}/{self.key} has {MAX_PARTS} parts after {self.size} bytes, the most a multipart upload can hold.")
+        self.slots.acquire()
+        if self.error:
+            self.slots.release()
+            raise Exception(f"Upload of s3://{self.bucket}/{self.key} failed: {self.error}")
+        self.futures.append(self.executor.submit(self._upload_part, len(self.futures) + 1, body))
+        if len(self.futures) % PARTS_PER_SIZE == 0:
+            self.part_size = min(self.part_size * 2, MAX_PART_SIZE)
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.digest.update(data)
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+
+    def commit(self):
+        if self.buffer or not self.futures:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        parts = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts})
+        name = self.key.rpartition("/")[2]
+        manifest = sidecar_manifest(name, {name: {"size": self.size, "checksum": self.checksum}})
+        self.client.put_object(Bucket=self.bucket, Key=f"{self.key}{SIDECAR_SUFFIX}", Body=json.dumps(manifest, indent=2).encode())
+        logger.info(f"Uploaded {self.size} bytes to s3://{self.bucket}/{self.key} in {len(parts)} part(s).")
+        return f"s3://{self.bucket}/{self.key}"
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.warning(f"Could not abort the upload of s3://{self.bucket}/{self.key}: {e}")
+
+
+class S3Storage:
+    """
+    S3 or S3-compatible object storage (MinIO, Ceph, ...). Credentials and the endpoint come
+    from the usual AWS configuration; AWS_ENDPOINT_URL points it at a non-AWS server.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", part_size: int = DEFAULT_PART_SIZE, concurrency: int = DEFAULT_CONCURRENCY):
+        # boto3 takes a noticeable part of a second to import; only S3 runs pay for it
+        try:
+            import boto3
+        except ImportError:
+            raise Exception("S3 storage needs boto3. Install it with: pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.client = boto3.client("s3", endpoint_url=os.environ.get("AWS_ENDPOINT_URL"))
+
+    def _key(self, key: str):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def location(self, key: str):
+        return f"s3://{self.bucket}/{self._key(key)}"
+
+    def writer(self, key: str):
+        return MultipartUploadWriter(self.client, self.bucket, self._key(key), part_size=self.part_size, concurrency=self.concurrency)
+
+    def size(self, key: str):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+
+    def _get_range(self, key: str, start: int, end: int):
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}")
+        return response["Body"].read()
+
+    def reader(self, key: str):
+        """
+        Yield an object's bytes in order, downloading up to `concurrency` ranges ahead.
+        """
+        key = self._key(key)
+        size = self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+        ranges = deque((start, min(start + self.part_size, size) - 1) for start in range(0, size, self.part_size))
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="download") as executor:
+            pending = deque()
+            while ranges or pending:
+                while ranges and len(pending) < self.concurrency:
+                    pending.append(executor.submit(self._get_range, key, *ranges.popleft()))
+                yield pending.popleft().result()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(f"{key}{SIDECAR_SUFFIX}"))
+
+
+def open_storage(url: str):
+    """
+    Storage backend for a backup destination: s3://bucket/prefix, file:///path or a plain directory.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        if not parsed.netloc:
+            raise ValueError(f"Storage URL '{url}' has no bucket. Use s3://bucket/prefix.")
+        return S3Storage(parsed.netloc, parsed.path)
+    if parsed.scheme == "file":
+        return FilesystemStorage(parsed.path)
+    if parsed.scheme:
+        raise ValueError(f"Unsupported storage URL '{url}'. Use s3://bucket/prefix, file:///path or a directory.")
+    return FilesystemStorage(url)
+
+
+def split_location(url: str):
+    """
+    (backend, key) for the location of a single stored backup, e.g. s3://bucket/prefix/name.dump.
+    """
+    parent, _, key = url.rstrip("/").rpartition("/")
+    if not key or parent.endswith(":/"):
+        raise ValueError(f"'{url}' does not name a stored backup.")
+    return open_storage(parent), key
@@ -0,0 +1,198 @@
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from logger import setup_logger
+from metrics import count
+
+logger = setup_logger("throttle")
+
+MB = 1024 * 1024
+# A full bucket lets this many seconds' worth of data through at once
+BURST_SECONDS = 1.0
+# Writers take tokens in batches of this size, so per-document writes do not each take the lock
+GRANULE_BYTES = 256 * 1024
+
+# Adaptive mode: how often the server is polled, how hard the rate drops when it is busy and
+# how fast it climbs back, as fractions of --max-rate (additive increase, multiplicative decrease)
+ADAPTIVE_INTERVAL = 5.0
+BACKOFF_FACTOR = 0.5
+RECOVERY_STEP = 0.1
+MIN_RATE_FRACTION = 0.1
+
+# --io-priority levels, run through ionice (Linux) and nice (any POSIX system)
+IO_PRIORITIES = ["normal", "low", "idle"]
+PRIORITY_LEVELS = {
+    "low": (["-c2", "-n7"], ["-n10"]),
+    "idle": (["-c3"], ["-n19"]),
+}
+
+
+def parse_rate(max_rate):
+    """
+    --max-rate in MB/s as bytes per second, or None when unlimited.
+    """
+    if max_rate is None:
+        return None
+    try:
+        rate = float(max_rate)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid --max-rate '{max_rate}'. Use a number of MB/s, e.g. 50.")
+    if rate <= 0:
+        raise ValueError("--max-rate must be a positive number of MB/s.")
+    return rate * MB
+
+
+def priority_prefix(io_priority: str = None):
+    """
+    Command prefix that runs a child tool at a lower CPU and I/O priority. The tool inherits
+    it, so pg_dump or mongodump competes less with the server for disk and CPU.
+    """
+    if not io_priority or io_priority == "normal":
+        return []
+    if io_priority not in PRIORITY_LEVELS:
+        raise ValueError(f"Unknown I/O priority '{io_priority}'. Use one of: {', '.join(IO_PRIORITIES)}.")
+    if os.name != "posix":
+        logger.warning("--io-priority needs ionice or nice, which this platform does not have. Running at normal priority.")
+        return []
+    ionice_args, nice_args = PRIORITY_LEVELS[io_priority]
+    prefix = []
+    ionice = shutil.which("ionice")
+    if ionice:
+        prefix += [ionice, *ionice_args]
+    else:
+        logger.warning("ionice not found; only the CPU priority of the backup tools is lowered.")
+    nice = shutil.which("nice")
+    if nice:
+        prefix += [nice, *nice_args]
+    return prefix
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by every writer of one backup. Writers take tokens for the bytes they
+    write and sleep once the bucket runs dry; the bucket refills at `rate` bytes per second.
+    Taking more than is left puts the bucket in debt, so concurrent writers queue up behind
+    each other and together never exceed the rate.
+    """
+
+    def __init__(self, rate: float):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, GRANULE_BYTES)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = max(rate * BURST_SECONDS, GRANULE_BYTES)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def consume(self, amount: int):
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledWriter:
+    """
+    Sink wrapper that paces writes through a token bucket. Slowing the sink down slows the
+    whole pipeline: the pipe to pg_dump or mongodump fills up and the tool blocks on it.
+    """
+
+    def __init__(self, sink, bucket: TokenBucket):
+        self.sink = sink
+        self.bucket = bucket
+        self.pending = 0
+
+    def write(self, data):
+        self.pending += len(data)
+        if self.pending >= GRANULE_BYTES:
+            self.bucket.consume(self.pending)
+            self.pending = 0
+        return self.sink.write(data)
+
+    def __getattr__(self, name):
+        # commit(), abort(), size, checksum... of the wrapped writer
+        return getattr(self.sink, name)
+
+
+class AdaptiveRate:
+    """
+    Background thread that polls a load probe and steers the bucket's rate between
+    MIN_RATE_FRACTION and all of `max_rate`: it halves the rate while the server is busy and
+    climbs back in steps of RECOVERY_STEP once it is not.
+    """
+
+    def __init__(self, bucket: TokenBucket, max_rate: float, probe, interval: float = ADAPTIVE_INTERVAL):
+        self.bucket = bucket
+        self.max_rate = max_rate
+        self.probe = probe
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="adaptive-rate", daemon=True)
+        self._probe_failed = False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                busy = self.probe()
+            except Exception as e:
+                if not self._probe_failed:
+                    logger.warning(f"Could not read the server load; keeping the current rate. ({e})")
+                    self._probe_failed = True
+                continue
+            rate = self.bucket.rate
+            if busy:
+                new_rate = max(rate * BACKOFF_FACTOR, self.max_rate * MIN_RATE_FRACTION)
+            else:
+                new_rate = min(rate + self.max_rate * RECOVERY_STEP, self.max_rate)
+            if new_rate != rate:
+                logger.info(f"Server {'busy' if busy else 'quiet'} ({busy or 'no load signal'}): backup rate {rate / MB:.1f} -> {new_rate / MB:.1f} MB/s.")
+                self.bucket.set_rate(new_rate)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+@contextmanager
+def rate_limit(max_rate, adaptive: bool = False, probe=None):
+    """
+    Yield the token bucket for a backup limited to `max_rate` MB/s (None when unlimited). In
+    adaptive mode `probe` is polled while the backup runs; it returns a truthy description of
+    the load signal when the server is busy. The time spent waiting is counted in the run metrics.
+    """
+    rate = parse_rate(max_rate)
+    if rate is None:
+        yield None
+        return
+    bucket = TokenBucket(rate)
+    controller = AdaptiveRate(bucket, rate, probe) if adaptive and probe else None
+    logger.info(f"Limiting the backup to {rate / MB:.1f} MB/s{' and backing off while the server is busy' if controller else ''}.")
+    if controller:
+        controller.start()
+    try:
+        yield bucket
+    finally:
+        if controller:
+            controller.stop()
+        count("throttled_seconds", round(bucket.waited, 3))
+        if bucket.waited:
+            logger.info(f"Throttling paused the backup for {bucket.waited:.1f}s in total.")
@@ -1,8 +1,11 @@
 import os
 from pathlib import Path
+from compression import parse_compression
+from storage import is_storage_url, open_storage
+from throttle import parse_rate, IO_PRIORITIES
 
 class Validation:
-    def __init__(self, host: str, port: int, user: str, password: str, db_name: str, format: str, collection_name: str = None, output_dir: str = None, backup_file: str = None, backup_dir: str = None):
+    def __init__(self, host: str, port: int, user: str, password: str, db_name: str, format: str, collection_name: str = None, output_dir: str = None, backup_file: str = None, backup_dir: str = None, jobs: int = 1, compress: str = None, repo: str = None, engine: str = "tool", batch_size: int = None, incremental_base: str = None, storage: str = None, resume: bool = False, max_rate: float = None, io_priority: str = None, adaptive: bool = False, encrypt: bool = False):
         self.host = host
         self.port = port
         self.user = user
@@ -10,10 +13,24 @@ class Validation:
         self.db_name = db_name
         self.format = format
         self.output_dir = Path(output_dir) if output_dir else None
-        self.backup_file = Path(backup_file) if backup_file else None
-        self.backup_dir = Path(backup_dir) if backup_dir else None
+        # Backups in object storage are addressed by URL and stay strings
+        self.backup_file = (backup_file if is_storage_url(backup_file) else Path(backup_file)) if backup_file else None
+        self.backup_dir = (backup_dir if is_storage_url(backup_dir) else Path(backup_dir)) if backup_dir else None
         self.collection_name = collection_name if collection_name else None
-        self.FORMATS = ['sql', 'dump', 'bson']
+        self.jobs = jobs
+        self.compress = compress
+        self.repo = Path(repo) if repo else None
+        self.engine = engine
+        self.batch_size = batch_size
+        self.incremental_base = Path(incremental_base) if incremental_base else None
+        self.storage = storage
+        self.resume = resume
+        self.max_rate = max_rate
+        self.io_priority = io_priority
+        self.adaptive = adaptive
+        self.encrypt = encrypt
+        self.ENGINES = ['tool', 'native', 'physical']
+        self.FORMATS = ['sql', 'dump', 'directory', 'bson']
 
         if self.output_dir:
             self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -46,16 +63,101 @@ class Validation:
         if not isinstance(self.format, str) or not self.format.strip() or self.format not in self.FORMATS:
             raise ValueError(f"format must be a non empty string and should be either {', '.join(self.FORMATS)}")
 
+        # jobs validation
+        if not isinstance(self.jobs, int) or self.jobs <= 0:
+            raise ValueError("Jobs must be a positive integer.")
+
+        if self.jobs > 1 and self.format == "sql":
+            raise ValueError("Parallel jobs are not supported for the sql format. Use dump or directory instead.")
+
+        if self.jobs > 1 and self.format == "dump" and self.output_dir:
+            raise ValueError("Parallel backup jobs need the directory format. Use --format directory.")
+
+        # compression validation
+        if self.compress:
+            parse_compression(self.compress)
+            if self.format == "directory":
+                raise ValueError("Compression is not supported for the directory format. pg_dump compresses directory archives itself.")
+
+        # engine validation
+        if self.engine not in self.ENGINES:
+            raise ValueError(f"engine must be either {', '.join(self.ENGINES)}")
+
+        if self.engine == "native" and (self.compress or self.repo):
+            raise ValueError("The native engine writes a directory of data files and cannot be combined with compression or a repository.")
+
+        if self.engine == "native" and self.format in ("sql", "dump"):
+            raise ValueError("The native engine writes a directory of COPY files. Use --format directory.")
+
+        if self.engine == "physical":
+            if self.format == "bson":
+                raise ValueError("The physical engine copies a PostgreSQL cluster. It is not available for MongoDB.")
+            if self.repo or self.storage or self.resume or self.incremental_base:
+                raise ValueError("Physical base backups are written to --output as a directory of tar files and cannot be combined with --repo, --storage, --resume or --incremental.")
+
+        if self.batch_size is not None and (not isinstance(self.batch_size, int) or self.batch_size <= 0):
+            raise ValueError("Batch size must be a positive integer.")
+
+        # incremental validation
+        if self.incremental_base:
+            if not self.incremental_base.is_dir():
+                raise FileNotFoundError(f"Incremental base backup directory '{self.incremental_base}' does not exist.")
+            if self.compress or self.repo:
+                raise ValueError("Incremental backups extend a directory backup and cannot be combined with compression or a repository.")
+
+        # resume validation
+        if self.resume:
+            if self.engine != "native":
+                raise ValueError("--resume needs --engine native, which exports each table or collection range as a separate unit that can be checkpointed.")
+            if self.incremental_base:
+                raise ValueError("--resume applies to full backups, not incremental ones.")
+
+        # throttling validation
+        parse_rate(self.max_rate)
+        if self.io_priority and self.io_priority not in IO_PRIORITIES:
+            raise ValueError(f"io_priority must be one of {', '.join(IO_PRIORITIES)}")
+        if self.adaptive and self.max_rate is None:
+            raise ValueError("Adaptive throttling steers the rate below --max-rate. Set --max-rate as well.")
+        if self.incremental_base and self.max_rate is not None:
+            raise ValueError("--max-rate applies to full backups, not incremental ones.")
+
+        # encryption validation
+        if self.encrypt and (self.format == "directory" or self.engine != "tool" or self.repo or self.incremental_base):
+            raise ValueError("--encrypt seals a single backup stream. It cannot be combined with the directory format, the native or physical engine, a repository or incremental backups.")
+
+        # storage validation
+        if self.storage:
+            open_storage(self.storage)
+            if self.format == "directory" or self.engine == "native":
+                raise ValueError("Storage backends receive a single backup stream. The directory format and the native engine cannot be uploaded.")
+            if self.repo or self.incremental_base:
+                raise ValueError("A storage backend cannot be combined with a repository or incremental backups.")
+
+        remote_backup = is_storage_url(self.backup_file) or is_storage_url(self.backup_dir)
+        if remote_backup and (self.format == "directory" or self.engine == "native"):
+            raise ValueError("Backups in object storage are single streams. They cannot be restored with the directory format or the native engine.")
+
+        # repository validation
+        if self.repo:
+            if self.format == "directory":
+                raise ValueError("The directory format cannot be stored in a repository. Use sql or dump instead.")
+            if self.compress:
+                raise ValueError("Compression cannot be combined with a repository, it would defeat chunk deduplication.")
+            if self.repo.exists() and not self.repo.is_dir():
+                raise ValueError(f"Repository '{self.repo}' must be a directory.")
+
         if self.output_dir:
             if not isinstance(self.output_dir, Path):
                 raise TypeError("Output directory must be a Path object.")
             if not self.output_dir.exists():
                 raise FileNotFoundError(f"Output directory '{self.output_dir}' does not exist.")
 
-        if self.backup_file:
+        if self.backup_file and not is_storage_url(self.backup_file):
             if not isinstance(self.backup_file, Path):
                 raise TypeError("backup_file must be a Path object.")
             if not self.backup_file.exists():
                 raise FileNotFoundError(f"backup_file '{self.backup_file}' does not exist.")
+            if self.format == "directory" and not self.backup_file.is_dir():
+                raise ValueError(f"backup_file '{self.backup_file}' must be a directory for the directory format.")
 
         return True